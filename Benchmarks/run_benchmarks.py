@@ -0,0 +1,283 @@
+'''
+    Benchmarks of the CHM generation and the global registration on synthetic data
+    (see synthetic_data.py).
+    Every stage runs in its own process, which reports its run time and accuracy; its peak
+    memory (maximum resident set size) is taken from the process' resource usage.
+    Results are written to a JSON file, and another results file can be given to compare with
+    (e.g. the results of the previous version of the code) and flag regressions.
+
+    python run_benchmarks.py --work-dir /tmp/bench --density 20 --extent 500 500
+    python run_benchmarks.py --work-dir /tmp/bench --compare baseline.json --out results.json
+'''
+
+import os, sys, json, time, subprocess
+
+import numpy as np
+
+DIR_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR_CHM = os.path.join(DIR_REPO, 'CHM_generation')
+DIR_REG = os.path.join(DIR_REPO, 'Global_registration')
+sys.path[:0] = [DIR_CHM, DIR_REG]
+
+STAGES = ['chm', 'chm_streaming', 'horizontal', 'transform_horizontal', 'vertical', 'transform_vertical']
+
+
+# region - Stages (run in a child process)
+def stage_chm(config, files, streaming=False):
+    import runpy
+
+    fn_out = os.path.join(config['work_dir'], 'chm_streaming.tif' if streaming else 'chm.tif')
+    argv = ['gen_chm.py', '--las', files['las'], '--out', fn_out, '--resolution', str(config['resolution'])]
+    if streaming:
+        argv += ['--max-memory', str(config['max_memory']), '--workers', str(config['workers'])]
+    sys.argv = argv
+    tic = time.perf_counter()
+    try:
+        runpy.run_path(os.path.join(DIR_CHM, 'gen_chm.py'), run_name='__main__')
+    except SystemExit:
+        pass
+    seconds = time.perf_counter() - tic
+
+    from osgeo import gdal
+    chm = gdal.Open(fn_out).ReadAsArray()
+    accuracy = {'valid_fraction': float(np.mean(chm != -9999))}
+    fn_chm = os.path.join(config['work_dir'], 'chm.tif')
+    if streaming and os.path.exists(fn_chm):
+        # the streaming mode must reproduce the in-memory CHM
+        accuracy['max_diff_vs_chm'] = float(np.max(np.abs(chm - gdal.Open(fn_chm).ReadAsArray())))
+    return {'seconds': seconds, 'items': files['n_points'], 'unit': 'points/s', 'accuracy': accuracy,
+            'ok': accuracy.get('max_diff_vs_chm', 0.) == 0.}
+
+
+def stage_horizontal(config, files):
+    from estimate_horizontal_shift import estimate_horizontal_shift
+
+    truth = files['truth']
+    tic = time.perf_counter()
+    shifts_h, lut = estimate_horizontal_shift(files['ref_chm'], files['sen_chm'], display=False,
+                                              search=config['search'], workers=config['workers'],
+                                              **config['horizontal'])
+    seconds = time.perf_counter() - tic
+    error = (shifts_h[0] - truth['shift_x'], shifts_h[1] - truth['shift_y'])
+    return {'seconds': seconds, 'items': truth['overlap_pixels'], 'unit': 'pixels/s',
+            'accuracy': {'shift_x': float(shifts_h[0]), 'shift_y': float(shifts_h[1]),
+                         'error_x': float(error[0]), 'error_y': float(error[1]), 'patches': len(lut)},
+            'ok': bool(max(abs(error[0]), abs(error[1])) <= truth['resolution'] / 2)}
+
+
+def stage_transform_horizontal(config, files):
+    from osgeo import gdal
+    from transform_image_horizontal import transform_image
+
+    truth = files['truth']
+    tic = time.perf_counter()
+    transform_image(files['sen_dtm'], files['sen_dtm_h'], (truth['shift_x'], truth['shift_y']),
+                    mode=config['transform_mode'])
+    seconds = time.perf_counter() - tic
+
+    gt_in, gt_out = gdal.Open(files['sen_dtm']).GetGeoTransform(), gdal.Open(files['sen_dtm_h']).GetGeoTransform()
+    error = max(abs(gt_out[0] - (gt_in[0] - truth['shift_x'])), abs(gt_out[3] - (gt_in[3] - truth['shift_y'])))
+    tmp_ds = gdal.Open(files['sen_dtm'])
+    return {'seconds': seconds, 'items': tmp_ds.RasterXSize * tmp_ds.RasterYSize, 'unit': 'pixels/s',
+            'accuracy': {'origin_error': float(error)}, 'ok': bool(error < 1e-6)}
+
+
+def stage_vertical(config, files):
+    from estimate_vertical_shift import estimate_vertical_shift
+
+    truth = files['truth']
+    if not os.path.exists(files['sen_dtm_h']):
+        stage_transform_horizontal(config, files)
+    tic = time.perf_counter()
+    shift_v, stats = estimate_vertical_shift(files['ref_dtm'], files['sen_dtm_h'], display=False, return_stats=True)
+    seconds = time.perf_counter() - tic
+    error = -float(shift_v[0]) - truth['shift_z']
+    return {'seconds': seconds, 'items': truth['overlap_pixels'], 'unit': 'pixels/s',
+            'accuracy': {'shift_z': -float(shift_v[0]), 'error_z': error, 'mode_z': -stats['mode'],
+                         'spread_z': stats['spread']},
+            # the histogram bins are 0.1 m wide
+            'ok': bool(abs(error) <= 0.05 + 1e-6)}
+
+
+def stage_transform_vertical(config, files):
+    from osgeo import gdal
+    from transform_image_vertical import transform_image_vertical
+
+    truth = files['truth']
+    if not os.path.exists(files['sen_dtm_h']):
+        stage_transform_horizontal(config, files)
+    tic = time.perf_counter()
+    transform_image_vertical(files['sen_dtm_h'], files['sen_dtm_hv'], truth['shift_z'], workers=config['workers'])
+    seconds = time.perf_counter() - tic
+
+    tmp_in, tmp_out = gdal.Open(files['sen_dtm_h']).ReadAsArray(), gdal.Open(files['sen_dtm_hv']).ReadAsArray()
+    valid = tmp_in != -9999
+    error = float(np.max(np.abs(tmp_out[valid] - (tmp_in[valid] - truth['shift_z']))))
+    return {'seconds': seconds, 'items': tmp_in.size, 'unit': 'pixels/s',
+            'accuracy': {'max_error': error, 'nodata_kept': bool(np.all(tmp_out[~valid] == -9999))},
+            'ok': bool(error < 1e-3 and np.all(tmp_out[~valid] == -9999))}
+
+
+def run_stage(stage, fn_config):
+    '''Run one stage in this process and print its result as the last line of stdout.'''
+    import matplotlib
+    matplotlib.use('Agg')
+
+    with open(fn_config) as f:
+        config = json.load(f)
+    files = config['files']
+    if stage == 'chm':
+        result = stage_chm(config, files)
+    elif stage == 'chm_streaming':
+        result = stage_chm(config, files, streaming=True)
+    else:
+        result = globals()['stage_%s' % stage](config, files)
+    print('\n' + json.dumps(result))
+# endregion
+
+
+def measure(stage, fn_config, log):
+    '''
+    Run a stage in a child process.
+
+    Returns
+    -------
+    dict: the stage's result with 'peak_rss_mb' and 'throughput' ('unit') added
+    '''
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-stage', stage, fn_config],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    log.write(output)
+
+    if process.returncode != 0:
+        return {'stage': stage, 'error': output.strip().splitlines()[-1] if output.strip() else 'failed', 'ok': False}
+    result = json.loads(output.strip().splitlines()[-1])
+    result['stage'] = stage
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+    result['throughput'] = result['items'] / result['seconds'] if result['seconds'] > 0 else float('nan')
+    return result
+
+
+def prepare_data(config, regenerate=False):
+    '''Generate (or reuse) the synthetic point cloud and raster pair of a configuration.'''
+    from synthetic_data import write_point_cloud, write_raster_pair
+
+    work_dir = config['work_dir']
+    os.makedirs(work_dir, exist_ok=True)
+    fn_data = os.path.join(work_dir, 'data.json')
+    keys = ['extent', 'density', 'raster_size', 'resolution', 'overlap', 'shifts', 'seed']
+    if not regenerate and os.path.exists(fn_data):
+        with open(fn_data) as f:
+            data = json.load(f)
+        if all(data['config'][key] == config[key] for key in keys):
+            return data['files']
+
+    print('Generating synthetic data in %s' % work_dir)
+    files = write_raster_pair(os.path.join(work_dir, 'rasters'), (config['raster_size'], config['raster_size']),
+                              config['resolution'], config['overlap'], config['shifts'], config['seed'])
+    files['las'] = os.path.join(work_dir, 'cloud.laz')
+    files['n_points'] = write_point_cloud(files['las'], config['extent'], config['density'], seed=config['seed'])
+    with open(fn_data, 'w') as f:
+        json.dump({'config': {key: config[key] for key in keys}, 'files': files}, f, indent=2)
+    return files
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''Print the run time ratio of every stage to a baseline; a ratio above 1 + tolerance is a regression.'''
+    previous = {result['stage']: result for result in baseline['results'] if 'seconds' in result}
+    print('\n%-22s %10s %10s %8s' % ('stage', 'baseline', 'now', 'ratio'))
+    regressions = []
+    for result in results:
+        if 'seconds' not in result or result['stage'] not in previous:
+            continue
+        ratio = result['seconds'] / previous[result['stage']]['seconds']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <- slower'
+            regressions.append(result['stage'])
+        print('%-22s %9.2fs %9.2fs %8.2f%s' % (result['stage'], previous[result['stage']]['seconds'],
+                                               result['seconds'], ratio, flag))
+    return regressions
+
+
+def run_benchmarks(config, stages=STAGES, regenerate=False, fn_out=None, fn_compare=None, tolerance=0.1):
+    '''
+    Run the benchmark stages on the synthetic data of a configuration.
+
+    Returns
+    -------
+    list of the result dicts of the stages
+    '''
+    files = prepare_data(config, regenerate)
+    files['sen_dtm_h'] = os.path.join(config['work_dir'], 'sen_dtm_h.tif')
+    files['sen_dtm_hv'] = os.path.join(config['work_dir'], 'sen_dtm_hv.tif')
+    config = dict(config, files=files)
+    fn_config = os.path.join(config['work_dir'], 'config.json')
+    with open(fn_config, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    results = []
+    with open(os.path.join(config['work_dir'], 'benchmark.log'), 'w') as log:
+        for stage in [stage for stage in STAGES if stage in stages]:
+            print('Running %s ...' % stage)
+            results.append(measure(stage, fn_config, log))
+
+    print('\n%-22s %9s %14s %-9s %10s  %s' % ('stage', 'time', 'throughput', '', 'peak RSS', 'accuracy'))
+    for result in results:
+        if 'error' in result:
+            print('%-22s FAILED: %s' % (result['stage'], result['error']))
+            continue
+        print('%-22s %8.2fs %14.0f %-9s %7.0f MB  %s%s' % (result['stage'], result['seconds'], result['throughput'],
+                                                          result['unit'], result['peak_rss_mb'],
+                                                          json.dumps(result['accuracy']),
+                                                          '' if result['ok'] else '  <- FAILED'))
+
+    if fn_out is not None:
+        with open(fn_out, 'w') as f:
+            json.dump({'config': {key: value for key, value in config.items() if key != 'files'},
+                       'results': results}, f, indent=2)
+        print('Check: ', fn_out)
+    if fn_compare is not None:
+        with open(fn_compare) as f:
+            compare(results, json.load(f), tolerance)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--run-stage':
+        run_stage(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmark the CHM generation and the global registration on synthetic data.')
+    parser.add_argument('--work-dir', default='benchmark_data', help='directory of the synthetic data and outputs')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--extent', type=float, nargs=2, default=[300., 300.], help='point cloud size X Y (unit: meter)')
+    parser.add_argument('--density', type=float, default=20., help='points per square meter')
+    parser.add_argument('--raster-size', type=int, default=2000, help='rows and columns of every CHM/DTM')
+    parser.add_argument('--resolution', type=float, default=0.5, help='unit: meter')
+    parser.add_argument('--overlap', type=float, default=0.5, help='overlap of the raster pair (fraction of the width)')
+    parser.add_argument('--shifts', type=float, nargs=3, default=[1.5, -1.0, 0.73], metavar=('DX', 'DY', 'DZ'),
+                        help='ground truth shifts of the sensed rasters (unit: meter)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='regenerate the synthetic data')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the stages that support them')
+    parser.add_argument('--max-memory', type=float, default=1024, help='memory cap of chm_streaming (unit: MB)')
+    parser.add_argument('--search', default='batched', help="MI search of 'estimate_horizontal_shift'")
+    parser.add_argument('--transform-mode', default='copy', help="mode of 'transform_image'")
+    parser.add_argument('--out', default=None, help='results file (.json)')
+    parser.add_argument('--compare', default=None, help='results file (.json) to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown flagged as a regression by --compare')
+    args = parser.parse_args()
+
+    config = {'work_dir': os.path.abspath(args.work_dir), 'extent': args.extent, 'density': args.density,
+              'raster_size': args.raster_size, 'resolution': args.resolution, 'overlap': args.overlap,
+              'shifts': args.shifts, 'seed': args.seed, 'workers': args.workers, 'max_memory': args.max_memory,
+              'search': args.search, 'transform_mode': args.transform_mode,
+              'horizontal': {'size_grid': '100', 'size_patch': '20', 'num_patch': '1',
+                             'shift_x': [0, 4], 'shift_y': [0, 4], 'buffer_size': 10}}
+    results = run_benchmarks(config, args.stages, args.regenerate, args.out, args.compare, args.tolerance)
+    sys.exit(0 if all(result['ok'] for result in results) else 1)
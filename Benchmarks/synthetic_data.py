@@ -0,0 +1,154 @@
+'''
+    Synthetic inputs for the benchmarks: point clouds with a HeightAboveGround dimension over a
+    random canopy, and pairs of adjacent CHMs/DTMs with known (ground truth) shifts.
+    The canopy is a set of random tree crowns (ellipsoid caps) on a smooth terrain, so the
+    CHMs have the texture the mutual information search relies on.
+'''
+
+import os, json
+import numpy as np
+
+
+def canopy_surface(img_shape, spatial_resolution, seed=0, tree_density=0.01, max_height=45.):
+    '''
+    Canopy heights of random tree crowns, as a raster.
+
+    tree_density: trees per square meter
+    Returns
+    -------
+    2D float32 array (unit: meter)
+    '''
+    from scipy import ndimage
+
+    rng = np.random.default_rng(seed)
+    canopy = np.zeros(img_shape, dtype=np.float32)
+    n_trees = int(tree_density * img_shape[0] * img_shape[1] * spatial_resolution**2)
+    rows = rng.uniform(0, img_shape[0], n_trees)
+    cols = rng.uniform(0, img_shape[1], n_trees)
+    heights = rng.uniform(5, max_height, n_trees)
+    radii = (1. + 0.15 * heights) / spatial_resolution  # unit: pixel
+
+    for row, col, height, radius in zip(rows, cols, heights, radii):
+        row0, row1 = max(int(row - radius), 0), min(int(row + radius) + 1, img_shape[0])
+        col0, col1 = max(int(col - radius), 0), min(int(col + radius) + 1, img_shape[1])
+        tmp_r, tmp_c = np.ogrid[row0:row1, col0:col1]
+        tmp_d = 1. - ((tmp_r + 0.5 - row)**2 + (tmp_c + 0.5 - col)**2) / radius**2
+        crown = (height * np.sqrt(np.clip(tmp_d, 0, None))).astype(np.float32)
+        np.maximum(canopy[row0:row1, col0:col1], crown, out=canopy[row0:row1, col0:col1])
+
+    # understory
+    canopy += np.clip(ndimage.gaussian_filter(rng.normal(0, 1, img_shape), 3 / spatial_resolution) * 20, 0, 3)
+    return canopy
+
+
+def terrain_surface(img_shape, spatial_resolution, seed=0, relief=30., base=100.):
+    '''Smooth terrain elevations (unit: meter) as a raster.'''
+    from scipy import ndimage
+
+    rng = np.random.default_rng([seed, 1])
+    tmp = ndimage.gaussian_filter(rng.normal(0, 1, img_shape), 50 / spatial_resolution)
+    return (base + relief * tmp / max(np.abs(tmp).max(), 1e-9)).astype(np.float32)
+
+
+def write_point_cloud(fn_out, extent=(100., 100.), density=20., origin=(500000., 9900000.), seed=0,
+                      ground_fraction=0.2, tree_density=0.01, chunk_size=5_000_000):
+    '''
+    Write a synthetic point cloud (.las/.laz) over a random canopy, chunk by chunk.
+    Vegetation returns are drawn below the canopy surface and ground returns at its foot;
+    Z is the terrain elevation plus HeightAboveGround.
+
+    extent: (X, Y) size (unit: meter)
+    density: points per square meter
+    origin: lower-left corner (X, Y)
+    Returns
+    -------
+    number of points
+    '''
+    import laspy as lp
+
+    resolution = 0.5
+    img_shape = (int(np.ceil(extent[1] / resolution)), int(np.ceil(extent[0] / resolution)))
+    canopy = canopy_surface(img_shape, resolution, seed, tree_density)
+    terrain = terrain_surface(img_shape, resolution, seed)
+
+    header = lp.LasHeader(point_format=6, version='1.4')
+    header.scales = np.array([0.01, 0.01, 0.01])
+    header.offsets = np.array([origin[0], origin[1], 0.])
+    header.add_extra_dims([lp.ExtraBytesParams(name='HeightAboveGround', type=np.float64)])
+
+    n_points = int(extent[0] * extent[1] * density)
+    rng = np.random.default_rng([seed, 2])
+    with lp.open(fn_out, mode='w', header=header, do_compress=fn_out.lower().endswith('.laz')) as writer:
+        for n_p in range(0, n_points, chunk_size):
+            n_c = min(chunk_size, n_points - n_p)
+            x = rng.uniform(0, extent[0], n_c)
+            y = rng.uniform(0, extent[1], n_c)
+            row = np.minimum(((extent[1] - y) / resolution).astype(np.int64), img_shape[0] - 1)
+            col = np.minimum((x / resolution).astype(np.int64), img_shape[1] - 1)
+
+            ground = rng.random(n_c) < ground_fraction
+            hag = canopy[row, col] * rng.random(n_c)**0.3
+            hag[ground] = rng.normal(0, 0.05, ground.sum())
+
+            points = lp.ScaleAwarePointRecord.zeros(n_c, header=header)
+            points.x = origin[0] + x
+            points.y = origin[1] + y
+            points.z = terrain[row, col] + hag
+            points.HeightAboveGround = hag
+            points.classification = np.where(ground, 2, 5).astype(np.uint8)
+            points.return_number = np.ones(n_c, dtype=np.uint8)
+            points.number_of_returns = np.ones(n_c, dtype=np.uint8)
+            writer.write_points(points)
+            del x, y, row, col, ground, hag, points
+    print('Check: ', fn_out)
+    return n_points
+
+
+def write_raster(fn_out, img, boundary_tl, spatial_resolution, no_data_value=-9999):
+    '''Write a raster as the CHM generation does (see CHM_generation/chm_writer.py).'''
+    from chm_writer import create_chm_raster, write_windowed
+
+    tmp_ds = create_chm_raster(fn_out, img.shape, boundary_tl, spatial_resolution, no_data_value)
+    write_windowed(tmp_ds.GetRasterBand(1), img)
+    tmp_ds = None
+
+
+def write_raster_pair(out_dir, img_shape=(2000, 2000), spatial_resolution=0.5, overlap=0.5,
+                      shifts=(1.5, -1.0, 0.73), seed=0, hole_fraction=0.001, no_data_value=-9999,
+                      origin=(500000., 9900000.)):
+    '''
+    Write the CHMs and DTMs of two adjacent flights side by side in X, overlapping by a fraction
+    of their width. The sensed rasters are georeferenced off by shifts (X, Y) and the sensed DTM
+    is off by shifts[2] in height, so that registration should return these shifts:
+    'estimate_horizontal_shift' -> (shift_x, shift_y) and 'estimate_vertical_shift' -> -shift_z.
+
+    img_shape: (rows, cols) of every raster
+    shifts: (shift_x, shift_y, shift_z) (unit: meter); X and Y are resolved to whole pixels
+    hole_fraction: fraction of random nodata pixels
+    Returns
+    -------
+    dict of the file paths ('ref_chm', 'ref_dtm', 'sen_chm', 'sen_dtm') and the 'truth'
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    offset = int(round(img_shape[1] * (1 - overlap)))
+    scene_shape = (img_shape[0], img_shape[1] + offset)
+    canopy = canopy_surface(scene_shape, spatial_resolution, seed)
+    terrain = terrain_surface(scene_shape, spatial_resolution, seed)
+    rng = np.random.default_rng([seed, 3])
+
+    files = {}
+    for name, col0, shift in (('ref', 0, (0., 0., 0.)), ('sen', offset, shifts)):
+        boundary_tl = [origin[0] + col0 * spatial_resolution + shift[0], origin[1] + shift[1]]
+        holes = rng.random(img_shape) < hole_fraction
+        for product, img in (('chm', canopy), ('dtm', terrain + shift[2])):
+            tmp_img = img[:, col0:col0+img_shape[1]].astype(np.float32)
+            tmp_img[holes] = no_data_value
+            files['%s_%s' % (name, product)] = os.path.join(out_dir, '%s_%s.tif' % (name, product))
+            write_raster(files['%s_%s' % (name, product)], tmp_img, boundary_tl, spatial_resolution, no_data_value)
+    del canopy, terrain
+
+    files['truth'] = {'shift_x': shifts[0], 'shift_y': shifts[1], 'shift_z': shifts[2],
+                      'resolution': spatial_resolution, 'overlap_pixels': img_shape[0] * (img_shape[1] - offset)}
+    with open(os.path.join(out_dir, 'truth.json'), 'w') as f:
+        json.dump(files, f, indent=2)
+    return files
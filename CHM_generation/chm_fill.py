@@ -0,0 +1,204 @@
+'''
+    Hole filling of generated CHMs (GDAL's FillNodata through rasterio.fill.fillnodata).
+    Nodata pixels are interpolated from the valid pixels within max_search_distance, so a tile
+    extended by a halo of max_search_distance (+1 pixel per smoothing iteration) gives the same
+    values in its core as the whole raster. Tiles are filled independently, in a process pool
+    with workers > 1, and only one band of tiles is held in memory for rasters on disk.
+    StreamingFiller fills a raster that is produced band of rows by band of rows before it is
+    written, holding back only the halo rows between bands.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def fill_halo(max_search_distance, smoothing_iterations=0):
+    '''Pixels around a tile that can contribute to its filled values.'''
+    return int(np.ceil(max_search_distance)) + int(smoothing_iterations)
+
+
+def fill_tile(img, valid, max_search_distance=10, smoothing_iterations=0):
+    '''
+    Fill the pixels of img where valid is False.
+
+    max_search_distance: unit: pixel
+    '''
+    from rasterio.fill import fillnodata
+
+    if valid.all() or not valid.any():
+        return img
+    # fillnodata fills the array it is given
+    return fillnodata(img.copy(), mask=valid.astype(np.uint8), max_search_distance=max_search_distance,
+                      smoothing_iterations=smoothing_iterations)
+
+
+def _fill_task(args):
+    tmp_img, tmp_valid, max_search_distance, smoothing_iterations = args
+    return fill_tile(tmp_img, tmp_valid, max_search_distance, smoothing_iterations)
+
+
+def tile_windows(img_shape, tile_size, halo):
+    '''(core, extended) windows (row0, row1, col0, col1) of the tiles of an image.'''
+    windows = []
+    for row0 in range(0, img_shape[0], tile_size):
+        for col0 in range(0, img_shape[1], tile_size):
+            row1, col1 = min(row0 + tile_size, img_shape[0]), min(col0 + tile_size, img_shape[1])
+            windows.append(((row0, row1, col0, col1),
+                            (max(row0 - halo, 0), min(row1 + halo, img_shape[0]),
+                             max(col0 - halo, 0), min(col1 + halo, img_shape[1]))))
+    return windows
+
+
+def fill_tiles(img, valid, max_search_distance=10, smoothing_iterations=0, tile_size=2048,
+               workers=1, executor=None):
+    '''
+    Fill the holes (valid == False) of a 2D image tile by tile; same result as filling it at once.
+
+    valid: validity mask, e.g. nop > 0 or img != no_data_value
+    max_search_distance: unit: pixel
+    workers: number of processes filling tiles (or an executor to use)
+
+    Returns
+    -------
+    filled copy of img
+    '''
+    out = img.copy()
+    windows = tile_windows(img.shape, tile_size, fill_halo(max_search_distance, smoothing_iterations))
+
+    def tasks(batch):
+        for _, (row0, row1, col0, col1) in batch:
+            yield img[row0:row1, col0:col1], valid[row0:row1, col0:col1], max_search_distance, smoothing_iterations
+
+    def write(batch, results):
+        for ((row0, row1, col0, col1), (e_row0, _, e_col0, _)), tmp_img in zip(batch, results):
+            out[row0:row1, col0:col1] = tmp_img[row0-e_row0:row1-e_row0, col0-e_col0:col1-e_col0]
+
+    if workers > 1 and executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return fill_tiles(img, valid, max_search_distance, smoothing_iterations, tile_size, workers, executor)
+    if executor is not None:
+        # keep at most 2 * workers tiles in flight
+        for n_t in range(0, len(windows), 2*workers):
+            batch = windows[n_t:n_t+2*workers]
+            write(batch, executor.map(_fill_task, tasks(batch)))
+    else:
+        write(windows, map(_fill_task, tasks(windows)))
+    return out
+
+
+class StreamingFiller:
+    '''
+    Hole filling of a raster produced band of rows by band of rows (e.g. the tiles of the
+    streaming mode), before the rows are written. The last halo rows of a band are held back
+    until the next band provides their lower halo, and kept afterwards as the upper halo of
+    the next rows, so the result is the same as filling the whole raster at once.
+
+    no_data_values: dict product name -> nodata value of its raster, or None for rasters that
+                    are not filled (e.g. counts)
+    img_ysize: rows of the raster; the held rows are released with its last band
+    workers, executor: process pool filling the tiles of every band (see fill_tiles)
+    '''
+
+    def __init__(self, no_data_values, img_ysize, max_search_distance=10, smoothing_iterations=0,
+                 tile_size=2048, workers=1, executor=None):
+        self.no_data_values = dict(no_data_values)
+        self.img_ysize = img_ysize
+        self.max_search_distance = max_search_distance
+        self.smoothing_iterations = smoothing_iterations
+        self.tile_size = tile_size
+        self.workers = workers
+        self.executor = executor
+        self.halo = fill_halo(max_search_distance, smoothing_iterations)
+        self.held = None   # dict name -> 2D array of the rows held, unfilled
+        self.row0 = 0      # first row held
+        self.next_row = 0  # first row not released yet
+
+    def push(self, grids, row0):
+        '''
+        Add the rows of a band (dict name -> 2D array, starting at row row0). Bands must be
+        added in order.
+
+        Returns
+        -------
+        list of (grids, row0) of the filled rows that can be written
+        '''
+        if self.held is None:
+            self.held, self.row0 = dict(grids), row0
+        else:
+            row1 = self.row0 + len(next(iter(self.held.values())))
+            if row0 != row1:
+                raise ValueError('Rows %d.. added after rows ..%d; bands must be added in order' % (row0, row1))
+            self.held = {name: np.concatenate([self.held[name], grids[name]]) for name in self.held}
+        row1 = self.row0 + len(next(iter(self.held.values())))
+
+        # rows whose lower halo is complete (all of them with the last band)
+        stop = row1 if row1 >= self.img_ysize else row1 - self.halo
+        if stop <= self.next_row:
+            return []
+
+        filled = {}
+        for name, tmp_img in self.held.items():
+            no_data = self.no_data_values[name]
+            if no_data is not None:
+                tmp_img = fill_tiles(tmp_img, tmp_img != no_data, self.max_search_distance, self.smoothing_iterations,
+                                     self.tile_size, self.workers, self.executor)
+            filled[name] = tmp_img[self.next_row-self.row0:stop-self.row0]
+        released = [(filled, self.next_row)]
+
+        # keep the upper halo of the next rows
+        keep = max(stop - self.halo, self.row0)
+        self.held = {name: tmp_img[keep-self.row0:].copy() for name, tmp_img in self.held.items()}
+        self.row0, self.next_row = keep, stop
+        return released
+
+
+def fill_raster(fn, max_search_distance=10, smoothing_iterations=0, tile_size=2048, workers=1):
+    '''
+    Fill the holes of every band of a GeoTIFF that has a nodata value (count bands have none).
+    Bands of tile_size rows are read with their halo and the filled rows are written to a new
+    file with the same creation options (see chm_writer.py), which then replaces fn; rewriting
+    compressed tiles in place would leave the old ones in the file.
+
+    max_search_distance: unit: pixel
+    '''
+    from osgeo import gdal
+    from chm_writer import creation_options, write_windowed
+
+    halo = fill_halo(max_search_distance, smoothing_iterations)
+    src_ds = gdal.Open(fn)
+    n_bands = src_ds.RasterCount
+    base, ext = os.path.splitext(fn)
+    fn_tmp = '%s_filled%s' % (base, ext)
+    driver = gdal.GetDriverByName('GTiff')
+    tar_ds = driver.Create(fn_tmp, src_ds.RasterXSize, src_ds.RasterYSize, n_bands, gdal.GDT_Float32,
+                           options=creation_options())
+    tar_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    tar_ds.SetProjection(src_ds.GetProjection())
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for n_band in range(n_bands):
+            src_band, tar_band = src_ds.GetRasterBand(n_band+1), tar_ds.GetRasterBand(n_band+1)
+            no_data = src_band.GetNoDataValue()
+            if no_data is not None:
+                tar_band.SetNoDataValue(no_data)
+            if src_band.GetDescription():
+                tar_band.SetDescription(src_band.GetDescription())
+
+            for row0 in range(0, src_ds.RasterYSize, tile_size):
+                row1 = min(row0 + tile_size, src_ds.RasterYSize)
+                e_row0, e_row1 = max(row0 - halo, 0), min(row1 + halo, src_ds.RasterYSize)
+                tmp_img = src_band.ReadAsArray(0, e_row0, src_ds.RasterXSize, e_row1 - e_row0)
+                if no_data is not None:
+                    tmp_img = fill_tiles(tmp_img, tmp_img != no_data, max_search_distance, smoothing_iterations,
+                                         tile_size, workers, executor)
+                write_windowed(tar_band, tmp_img[row0-e_row0:row1-e_row0], row0)
+                del tmp_img
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    src_ds = None
+    tar_ds = None
+    os.replace(fn_tmp, fn)
@@ -0,0 +1,311 @@
+'''
+    Incremental CHM mosaic of many flights, stored as square GeoTIFF tiles on a fixed grid
+    (aligned to multiples of the tile extent) and a VRT of all tiles ('mosaic.vrt').
+    The store ('mosaic.json') records every flight by its OriginalCloudIndex (as assigned by the
+    'point_cloud_shift.json' pipeline), with a fingerprint of its content (hash of the point
+    cloud and its shift) and the tiles its points fall in (from its spatial index, see
+    'las_index.py'), and every tile with the fingerprints of the flights it was gridded from.
+    An update only re-grids the tiles whose flights differ from the recorded ones: the tiles of a
+    new, changed (re-registered, re-processed) or removed flight. Each tile is gridded from the
+    points of all its flights, read through their spatial indexes. A tile equals the same window
+    of the CHM of the merged, shifted point clouds when the pixels of both coincide, i.e. when
+    that CHM's origin (round(min x), round(max y)) is a multiple of the resolution (always the
+    case for resolutions dividing 1 m, e.g. 0.25 or 0.5); otherwise its pixels are offset.
+    Tiles get internal overviews like the other generated rasters (see chm_writer.py).
+    The store is saved after every tile; an interrupted update resumes where it stopped.
+
+    Example:
+        python chm_mosaic.py manifest.json --store mosaic --shifts registered/shifts.json --resolution 0.5
+    The manifest is the one of 'register_flights.py' ("laz" and "index" of every flight); with
+    --shifts (its 'shifts.json'), the shifts are applied to the points while they are gridded,
+    without writing the shifted point clouds.
+'''
+
+import os, json, hashlib, tempfile, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+STORE_VERSION = 1
+
+
+def file_hash(fn, chunk_size=1 << 22):
+    '''BLAKE2b digest of a file's content (the same digest as mi_cache.file_hash of the registration code).'''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cloud_index(fn_las, default):
+    '''OriginalCloudIndex of a point cloud written by the 'point_cloud_shift.json' pipeline (default if it has none).'''
+    from chm_streaming import open_las
+
+    with open_las(fn_las) as reader:
+        if 'OriginalCloudIndex' not in reader.header.point_format.dimension_names:
+            return default
+        points = reader.read_points(1)
+        return int(points['OriginalCloudIndex'][0]) if len(points) else default
+
+
+def tile_key(col, row):
+    return '%d_%d' % (col, row)
+
+
+def _grid_tile(args):
+    '''
+    Grid one tile from the points of its flights and write it (with overviews, see chm_writer.finalize_raster).
+
+    Returns
+    -------
+    number of points gridded (the tile is not written when 0)
+    '''
+    from chm_gridding import grid_products, spec_dimensions
+    from chm_writer import create_product_rasters, write_windowed, finalize_raster
+    from las_index import read_bbox
+
+    fn_tile, boundary_tl, tile_size, spatial_resolution, specs, no_data_value, sources, overviews, cog = args
+    if not sources:
+        return 0
+    half = spatial_resolution / 2
+    # points assigned to the tile's pixels (nearest pixel, see chm_gridding.pixel_index)
+    bbox = (boundary_tl[0] - half, boundary_tl[1] - tile_size * spatial_resolution + half,
+            boundary_tl[0] + tile_size * spatial_resolution - half, boundary_tl[1] + half)
+    dimensions = spec_dimensions(specs)
+
+    xs, ys, values = [], [], {dimension: [] for dimension in dimensions}
+    for fn_las, shift in sources:
+        # the pipeline subtracts the shift, so the tile is read at bbox + shift
+        x, y, tmp_values = read_bbox(fn_las, (bbox[0] + shift[0], bbox[1] + shift[1],
+                                              bbox[2] + shift[0], bbox[3] + shift[1]),
+                                     dimensions, verbose=False)
+        xs.append(x - shift[0])
+        ys.append(y - shift[1])
+        for dimension in dimensions:
+            values[dimension].append(tmp_values[dimension] - shift[2] if dimension == 'z' else tmp_values[dimension])
+        del x, y, tmp_values
+
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    values = {dimension: np.concatenate(tmp) for dimension, tmp in values.items()}
+    if len(x) == 0:
+        return 0
+    grids = grid_products(x, y, values, boundary_tl, spatial_resolution, (tile_size, tile_size), specs,
+                          no_data_value)
+    datasets, bands = create_product_rasters(fn_tile, specs, (tile_size, tile_size), boundary_tl,
+                                             spatial_resolution, no_data_value)
+    for spec in specs:
+        write_windowed(bands[spec], grids[spec])
+    datasets = bands = None
+    finalize_raster(fn_tile, overviews, cog)
+    return len(x)
+
+
+class MosaicStore:
+    '''
+    store_dir: directory of the mosaic ('mosaic.json', 'tiles/<col>_<row>.tif', 'mosaic.vrt')
+    spatial_resolution: pixel size (unit: meter)
+    tile_size: width and height of the tiles (unit: pixel)
+    specs: products of the tiles (bands), as 'dimension:statistic' (see chm_gridding.py)
+    The parameters are fixed when the store is created; None keeps the stored ones.
+    '''
+
+    def __init__(self, store_dir, spatial_resolution=None, tile_size=None, specs=None,
+                 no_data_value=-9999):
+        self.store_dir = store_dir
+        self.fn_state = os.path.join(store_dir, 'mosaic.json')
+        os.makedirs(os.path.join(store_dir, 'tiles'), exist_ok=True)
+
+        config = {'spatial_resolution': spatial_resolution, 'tile_size': tile_size,
+                  'specs': list(specs) if specs is not None else None, 'no_data_value': no_data_value}
+        if os.path.exists(self.fn_state):
+            with open(self.fn_state) as f:
+                self.state = json.load(f)
+            if self.state.get('version') != STORE_VERSION:
+                raise ValueError('%s was written by another version of chm_mosaic.py' % self.fn_state)
+            for name, value in config.items():
+                if value is not None and value != self.state['config'][name]:
+                    raise ValueError('%s of the mosaic is %r, not %r (use a new store)' %
+                                     (name, self.state['config'][name], value))
+        else:
+            defaults = {'spatial_resolution': 0.25, 'tile_size': 2048, 'specs': ['HeightAboveGround:p98']}
+            for name, value in defaults.items():
+                if config[name] is None:
+                    config[name] = value
+            self.state = {'version': STORE_VERSION, 'config': config, 'flights': {}, 'tiles': {}}
+        self.config = self.state['config']
+        self.extent = self.config['tile_size'] * self.config['spatial_resolution']
+
+    def save(self):
+        '''Write the state atomically, so an interrupted update never leaves a partial file.'''
+        fd, fn_tmp = tempfile.mkstemp(suffix='.json', dir=self.store_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(fn_tmp, self.fn_state)
+
+    def tile_filename(self, key):
+        return os.path.join(self.store_dir, 'tiles', '%s.tif' % key)
+
+    def tile_boundary(self, key):
+        '''[X, Y] of the center of the top-left pixel of a tile (boundary_tl of 'gen_chm.py').'''
+        col, row = map(int, key.split('_'))
+        return [col * self.extent, (row + 1) * self.extent]
+
+    def tiles_in_bbox(self, bbox):
+        '''Keys of the tiles whose pixels hold points of a bounding box (xmin, ymin, xmax, ymax).'''
+        half = self.config['spatial_resolution'] / 2
+        col0, col1 = int(np.floor((bbox[0] + half) / self.extent)), int(np.floor((bbox[2] + half) / self.extent))
+        row0, row1 = int(np.floor((bbox[1] - half) / self.extent)), int(np.floor((bbox[3] - half) / self.extent))
+        return [tile_key(col, row) for col in range(col0, col1 + 1) for row in range(row0, row1 + 1)]
+
+    def footprint(self, index, shift):
+        '''Tiles of a flight, from the non-empty cells of its spatial index, after its shift.'''
+        cells = np.unique(index['cells'])
+        size, origin = index['tile_size'], index['mins']
+        tiles = set()
+        for col, row in zip((cells % index['n_cols']).tolist(), (cells // index['n_cols']).tolist()):
+            x0, y0 = origin[0] + col * size - shift[0], origin[1] + row * size - shift[1]
+            tiles.update(self.tiles_in_bbox((x0, y0, x0 + size, y0 + size)))
+        return sorted(tiles)
+
+    def flight_record(self, flight, shift):
+        '''
+        Record of a flight: its content hash (reused while the file is unchanged), fingerprint
+        and tiles (recomputed when the fingerprint changes).
+        '''
+        from las_index import load_index
+
+        stat = os.stat(flight['laz'])
+        previous = self.state['flights'].get(str(flight['index']), {})
+        if previous.get('laz') == os.path.abspath(flight['laz']) and previous.get('file_size') == stat.st_size \
+                and previous.get('file_mtime_ns') == stat.st_mtime_ns:
+            content_hash = previous['content_hash']
+        else:
+            content_hash = file_hash(flight['laz'])
+        fingerprint = hashlib.blake2b(('%s_%r_%r_%r' % (content_hash, *shift)).encode(), digest_size=16).hexdigest()
+
+        index = load_index(flight['laz'])
+        if previous.get('fingerprint') == fingerprint:
+            tiles = previous['tiles']
+        else:
+            tiles = self.footprint(index, shift)
+        return {'name': flight.get('name'), 'laz': os.path.abspath(flight['laz']),
+                'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns,
+                'content_hash': content_hash, 'shift': list(shift), 'fingerprint': fingerprint, 'tiles': tiles}
+
+    def update(self, flights, shifts=None, workers=1, overviews=True, cog=False):
+        '''
+        Bring the mosaic up to date with a list of flights (the whole mosaic: flights of the
+        store that are not listed are removed from it).
+
+        flights: manifest entries with 'laz', 'index' (OriginalCloudIndex) and optionally 'name'
+        shifts: dict name -> shift (as in the 'flights' of 'shifts.json' of 'register_flights.py')
+                applied to the points; flights without a shift are used as they are
+        workers: number of tiles gridded in parallel processes
+        overviews, cog: internal overviews and COG tiles (see chm_writer.finalize_raster)
+        Returns
+        -------
+        list of the tiles that were re-gridded
+        '''
+        shifts = shifts or {}
+
+        # region - Flights
+        records = {}
+        for n_f, flight in enumerate(flights):
+            flight = dict(flight)
+            if 'index' not in flight:
+                flight['index'] = cloud_index(flight['laz'], n_f + 1)
+            if str(flight['index']) in records:
+                raise ValueError('OriginalCloudIndex %s is used by two flights' % flight['index'])
+            tmp = shifts.get(flight.get('name'), {})
+            shift = (float(tmp.get('shift_x', 0.)), float(tmp.get('shift_y', 0.)), float(tmp.get('shift_z', 0.)))
+            records[str(flight['index'])] = self.flight_record(flight, shift)
+
+        previous = self.state['flights']
+        changed = [key for key in records if previous.get(key, {}).get('fingerprint') != records[key]['fingerprint']]
+        removed = [key for key in previous if key not in records]
+        self.state['flights'] = records
+        self.save()
+        # endregion
+
+        # region - Tiles to re-grid
+        # a tile is up to date when it was gridded from exactly the flights (and fingerprints) covering it now
+        expected = {}
+        for key, record in records.items():
+            for tile in record['tiles']:
+                expected.setdefault(tile, {})[key] = record['fingerprint']
+        tiles = self.state['tiles']
+        dirty = sorted(tile for tile in set(expected) | set(tiles)
+                       if expected.get(tile, {}) != tiles.get(tile, {}).get('flights', {}))
+        print('%d flights (%d new or changed, %d removed), %d of %d tiles to re-grid' %
+              (len(records), len(changed), len(removed), len(dirty), len(set(expected) | set(tiles))))
+        # endregion
+
+        # region - Tile gridding
+        def task(tile):
+            sources = [(records[key]['laz'], records[key]['shift']) for key in sorted(expected.get(tile, {}))]
+            return (self.tile_filename(tile), self.tile_boundary(tile), self.config['tile_size'],
+                    self.config['spatial_resolution'], self.config['specs'], self.config['no_data_value'], sources,
+                    overviews, cog)
+
+        def collect(tile, n_points):
+            if not expected.get(tile):
+                tiles.pop(tile, None)
+            else:
+                tiles[tile] = {'flights': expected[tile], 'points': n_points}
+            if n_points == 0 and os.path.exists(self.tile_filename(tile)):
+                os.remove(self.tile_filename(tile))
+            self.save()
+            print('       Tile %s: %d points from %d flights' % (tile, n_points, len(expected.get(tile, {}))))
+
+        if workers > 1 and len(dirty) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {tile: executor.submit(_grid_tile, task(tile)) for tile in dirty}
+                for tile, future in futures.items():
+                    collect(tile, future.result())
+        else:
+            for tile in dirty:
+                collect(tile, _grid_tile(task(tile)))
+        # endregion
+
+        self.build_vrt()
+        return dirty
+
+    def build_vrt(self):
+        '''VRT of all non-empty tiles ('mosaic.vrt').'''
+        from osgeo import gdal
+
+        fns = [self.tile_filename(tile) for tile, record in sorted(self.state['tiles'].items()) if record['points']]
+        fn_vrt = os.path.join(self.store_dir, 'mosaic.vrt')
+        if not fns:
+            print('Warning: the mosaic is empty')
+            return None
+        tmp_ds = gdal.BuildVRT(fn_vrt, fns)
+        tmp_ds = None
+        print('Check: ', fn_vrt, '(%d tiles)' % len(fns))
+        return fn_vrt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update a tiled CHM mosaic with the flights of a manifest.')
+    parser.add_argument('manifest', help='manifest of the flights (.json, as for register_flights.py)')
+    parser.add_argument('--store', default='mosaic', help='directory of the mosaic')
+    parser.add_argument('--shifts', default=None, help='shifts.json of register_flights.py, applied to the points')
+    parser.add_argument('--resolution', type=float, default=None, help='unit: meter (new stores: 0.25)')
+    parser.add_argument('--tile-size', type=int, default=None, help='unit: pixel (new stores: 2048)')
+    parser.add_argument('--products', nargs='+', default=None,
+                        help='products of the tiles as dimension:statistic (new stores: HeightAboveGround:p98)')
+    parser.add_argument('--workers', type=int, default=1, help='number of tiles gridded in parallel')
+    parser.add_argument('--no-overviews', action='store_true', help='do not add internal overviews to the tiles')
+    parser.add_argument('--cog', action='store_true', help='write the tiles as Cloud-Optimized GeoTIFFs (GDAL >= 3.1)')
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    shifts = None
+    if args.shifts is not None:
+        with open(args.shifts) as f:
+            shifts = json.load(f)['flights']
+
+    store = MosaicStore(args.store, args.resolution, args.tile_size, args.products)
+    store.update(manifest['flights'], shifts, workers=args.workers, overviews=not args.no_overviews, cog=args.cog)
@@ -0,0 +1,217 @@
+'''
+    Fixed-memory per-pixel percentile estimators for streaming CHM generation.
+    Both sketches are updated chunk by chunk as points stream in, so memory is O(pixels)
+    instead of O(points) and no tile spilling is needed.
+
+    TopKSketch keeps the k largest heights of every pixel.
+        For a pixel with n returns, the q-th percentile interpolates between the sorted
+        positions floor((n-1)*q/100) and the next one. Both are retained whenever
+        n - floor((n-1)*q/100) <= k, and the result is then identical to np.percentile.
+        This always holds for n <= k; for the 98th percentile and k = 32 it holds up to
+        about 1,550 returns per pixel. Otherwise the smallest retained height is returned,
+        which is an upper bound of the exact value; such pixels are reported as inexact.
+
+    HistogramSketch counts heights in fixed bins of bin_width between z_min and z_max.
+        Each order statistic is estimated by the center of its bin and clamped to the pixel's
+        min/max, so for heights within [z_min, z_max) the estimate is within bin_width/2 of
+        the exact np.percentile value. Heights outside the range are counted in the edge bins
+        and the bound does not hold for their pixels, which are reported as out of range.
+
+    Memory per pixel with the defaults: 32 * 8 + 4 = 260 bytes for TopKSketch of float64
+    heights (132 bytes for float32) and 80 * 2 + 12 = 172 bytes for HistogramSketch.
+'''
+
+import numpy as np
+
+from chm_gridding import percentile_indexes, lerp
+
+
+class TopKSketch:
+    '''
+    The k largest values of every cell and its number of values.
+
+    n_cells: number of raster cells (img_ysize * img_xsize)
+    k: values retained per cell; memory is about n_cells * (k * itemsize + 4) bytes
+    dtype: dtype of the retained values (default: that of the first values added, float64 for
+           integers), so percentiles are interpolated in the dtype of the data like np.percentile
+    '''
+
+    def __init__(self, n_cells, k=32, dtype=None):
+        self.k = int(k)
+        self.n_cells = n_cells
+        self.top = None  # (n_cells, k), ascending per cell
+        if dtype is not None:
+            self._allocate(dtype)
+        self.count = np.zeros(n_cells, dtype=np.uint32)
+
+    def _allocate(self, dtype):
+        self.top = np.full((self.n_cells, self.k), -np.inf, dtype=dtype)
+
+    def update(self, cell, z):
+        '''Add the values z of the cells cell (1D arrays of the same length).'''
+        if len(cell) == 0:
+            return
+        if self.top is None:
+            z = np.asarray(z)
+            self._allocate(z.dtype if np.issubdtype(z.dtype, np.floating) else np.float64)
+        order = np.lexsort((-z, cell))
+        cell_sorted = cell[order]
+        z_sorted = z[order].astype(self.top.dtype)
+        del order
+
+        starts = np.flatnonzero(np.r_[True, cell_sorted[1:] != cell_sorted[:-1]])
+        counts = np.diff(np.r_[starts, len(cell_sorted)])
+        cells = cell_sorted[starts]
+
+        # only the k largest new values of a cell can enter its buffer
+        rank = np.arange(len(cell_sorted)) - np.repeat(starts, counts)
+        keep = rank < self.k
+        new = np.full((len(cells), self.k), -np.inf, dtype=self.top.dtype)
+        new[np.repeat(np.arange(len(cells)), counts)[keep], rank[keep]] = z_sorted[keep]
+        del cell_sorted, z_sorted, rank, keep
+
+        merged = np.concatenate([self.top[cells], new], axis=1)
+        merged.sort(axis=1)
+        self.top[cells] = merged[:, self.k:]
+        self.count[cells] += counts.astype(np.uint32)
+
+    def percentile(self, q):
+        '''
+        Returns
+        -------
+        values: 1D array of the q-th percentile of every non-empty cell
+        cells: 1D int64 array of the non-empty cells
+        exact: 1D bool array, True where the value equals np.percentile
+        '''
+        cells = np.flatnonzero(self.count)
+        if self.top is None:
+            return np.zeros(0), cells, np.zeros(0, dtype=bool)
+        counts = self.count[cells].astype(np.int64)
+        previous, following, gamma = percentile_indexes(counts, q)
+
+        # sorted position i of a cell with n values sits in column i - n + k of its buffer
+        exact = previous - counts + self.k >= 0
+        col_previous = np.maximum(previous - counts + self.k, 0)
+        col_following = np.maximum(following - counts + self.k, 0)
+        values = lerp(self.top[cells, col_previous], self.top[cells, col_following], gamma)
+        return values, cells, exact
+
+
+class HistogramSketch:
+    '''
+    Fixed-bin histogram of the values of every cell, with their count, min and max.
+
+    n_cells: number of raster cells (img_ysize * img_xsize)
+    z_min, z_max, bin_width: histogram bins (unit: meter); values outside are counted in the edge bins
+    memory is about n_cells * (n_bins * 2 + 12) bytes
+    '''
+
+    def __init__(self, n_cells, z_min=0., z_max=80., bin_width=1.):
+        self.z_min = float(z_min)
+        self.z_max = float(z_max)
+        self.bin_width = float(bin_width)
+        self.n_bins = int(np.ceil((z_max - z_min) / bin_width))
+        self.hist = np.zeros((n_cells, self.n_bins), dtype=np.uint16)
+        self.count = np.zeros(n_cells, dtype=np.uint32)
+        self.min = np.full(n_cells, np.inf, dtype=np.float32)
+        self.max = np.full(n_cells, -np.inf, dtype=np.float32)
+
+    def update(self, cell, z):
+        '''Add the values z of the cells cell (1D arrays of the same length).'''
+        if len(cell) == 0:
+            return
+        tmp_bin = np.clip(np.floor((z - self.z_min) / self.bin_width), 0, self.n_bins-1).astype(np.int64)
+        flat, counts = np.unique(cell * self.n_bins + tmp_bin, return_counts=True)
+        hist = self.hist.reshape(-1)
+        hist[flat] = np.minimum(hist[flat].astype(np.int64) + counts, np.iinfo(np.uint16).max)
+        del tmp_bin, flat, counts
+
+        np.add.at(self.count, cell, 1)
+        np.minimum.at(self.min, cell, z.astype(np.float32))
+        np.maximum.at(self.max, cell, z.astype(np.float32))
+
+    def percentile(self, q):
+        '''
+        Returns
+        -------
+        values: 1D float64 array of the estimated q-th percentile of every non-empty cell
+        cells: 1D int64 array of the non-empty cells
+        '''
+        cells = np.flatnonzero(self.count)
+        counts = self.count[cells].astype(np.int64)
+        previous, following, gamma = percentile_indexes(counts, q)
+
+        cumulative = np.cumsum(self.hist[cells], axis=1, dtype=np.int64)
+        # a saturated bin undercounts; the last bin then absorbs the remainder
+        cumulative[:, -1] = np.maximum(cumulative[:, -1], counts)
+
+        estimates = []
+        for position in (previous, following):
+            tmp_bin = np.argmax(cumulative > position[:, None], axis=1)
+            center = self.z_min + (tmp_bin + 0.5) * self.bin_width
+            estimates.append(np.clip(center, self.min[cells], self.max[cells]))
+        return lerp(estimates[0], estimates[1], gamma), cells
+
+    def out_of_range(self):
+        '''Non-empty cells with values outside [z_min, z_max), whose estimates may exceed bin_width/2.'''
+        return np.flatnonzero((self.count > 0) & ((self.min < self.z_min) | (self.max >= self.z_max)))
+
+
+def build_chm_sketch(fn_las, fn_out, spatial_resolution, percentile_value_for_chm,
+                     no_data_value=-9999, sketch='topk', k=32, bin_width=1., z_min=0., z_max=80.,
+                     chunk_size=5_000_000, dimension='HeightAboveGround', overviews=True, cog=False,
+                     fill_distance=0, smoothing_iterations=0, fill_workers=1):
+    '''
+    Generate a CHM in one streaming pass with a per-pixel sketch instead of exact order statistics.
+
+    sketch: 'topk' (exact for pixels with few enough returns, see above) or 'histogram'
+    k: values retained per pixel by 'topk'
+    bin_width, z_min, z_max: histogram bins of 'histogram' (unit: meter); the estimate is within
+                             bin_width/2 only for pixels whose heights are all in [z_min, z_max)
+    overviews, cog: internal overviews and COG output (see chm_writer.finalize_raster)
+    fill_distance, smoothing_iterations, fill_workers: hole filling (see chm_fill.py; unit: pixel)
+    '''
+    import laspy as lp
+    from chm_gridding import pixel_index
+    from chm_streaming import chm_grid_from_header, iter_chunks
+    from chm_writer import create_chm_raster, write_windowed, finalize_raster
+
+    with lp.open(fn_las) as reader:
+        boundary_tl, boundary_br, img_shape = chm_grid_from_header(reader.header, spatial_resolution)
+        print('       # of points in LAS: %d' % reader.header.point_count)
+
+    n_cells = img_shape[0] * img_shape[1]
+    if sketch == 'topk':
+        estimator = TopKSketch(n_cells, k)
+    elif sketch == 'histogram':
+        estimator = HistogramSketch(n_cells, z_min, z_max, bin_width)
+    else:
+        raise ValueError('Unknown sketch: %s' % sketch)
+
+    for x, y, values in iter_chunks(fn_las, chunk_size, [dimension]):
+        cell, inside = pixel_index(x, y, boundary_tl, spatial_resolution, img_shape)
+        estimator.update(cell, values[dimension][inside])
+        del x, y, values, cell, inside
+
+    q = int(percentile_value_for_chm) if float(percentile_value_for_chm).is_integer() else percentile_value_for_chm
+    if sketch == 'topk':
+        values, cells, exact = estimator.percentile(q)
+        print('       Exact percentile in %.2f%% of %d pixels' % (100 * np.mean(exact) if len(exact) else 100, len(cells)))
+    else:
+        values, cells = estimator.percentile(q)
+        n_out = len(estimator.out_of_range())
+        if n_out:
+            print('Warning: %d of %d pixels have heights outside [%g, %g) m; their percentile may be off by more '
+                  'than half a bin' % (n_out, len(cells), z_min, z_max))
+    del estimator
+
+    ndhm = np.full(n_cells, no_data_value, dtype=np.float32)
+    ndhm[cells] = values
+    ndhm = ndhm.reshape(img_shape)
+    if fill_distance > 0:
+        from chm_fill import fill_tiles
+        ndhm = fill_tiles(ndhm, ndhm != no_data_value, fill_distance, smoothing_iterations, workers=fill_workers)
+    ndhm_ds = create_chm_raster(fn_out, img_shape, boundary_tl, spatial_resolution, no_data_value)
+    write_windowed(ndhm_ds.GetRasterBand(1), ndhm)
+    ndhm_ds = None
+    finalize_raster(fn_out, overviews, cog)
@@ -0,0 +1,470 @@
+'''
+    Out-of-core CHM generation for point clouds larger than memory.
+    The point cloud is streamed with laspy's chunk iterator; every chunk is binned into the
+    CHM grid of 'gen_chm.py' and its (pixel, height, ...) records are spilled to one file per
+    raster tile (a band of rows). Each tile is then gridded on its own with chm_gridding.py,
+    so the percentiles are exact and the peak memory is bounded by the chunk size and the
+    tile size instead of the size of the point cloud.
+    With workers > 1, disjoint point ranges are decoded and tiles are gridded in a process pool;
+    the main process writes every finished tile into the shared GeoTIFF by window, and the
+    result is bit-identical to the serial run.
+    Several products ('dimension:statistic' specs, see chm_gridding.py) can be built from the
+    same pass, as bands of one GeoTIFF or as separate files.
+    With prefetch > 0, the stages are pipelined: a background thread decodes the next chunks
+    (laspy's multi-threaded LAZ decoder when lazrs is installed) while the current one is
+    binned and spilled, and a writer thread writes the rows of a tile while the next one is
+    gridded. The result is identical.
+'''
+
+import os, glob, shutil, tempfile, queue, threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import laspy as lp
+
+from chm_gridding import pixel_index, reduce_products, spec_dimensions, is_count_product
+from chm_writer import BLOCK_SIZE, product_filenames, create_product_rasters, write_windowed, finalize_rasters, \
+                       BackgroundWriter
+
+
+# Approximate peak bytes held per point while decoding/binning a chunk, and per spilled byte
+# of a record while gridding a tile
+BYTES_PER_CHUNK_POINT = 160
+TILE_BYTES_PER_RECORD_BYTE = 4
+
+
+def open_las(fn_las):
+    '''
+    Open a point cloud in the main process. LAZ is decoded single-threaded here: a process forked
+    after the parallel LAZ decoder has started its threads can deadlock when it decodes.
+    '''
+    backends = [backend for backend in lp.LazBackend.detect_available() if backend != lp.LazBackend.LazrsParallel]
+    return lp.open(fn_las, laz_backend=backends if backends else None)
+
+
+def spill_dtype(fn_las, dimensions):
+    '''Record dtype of the spill files: the cell index and every dimension in its decoded dtype.'''
+    with open_las(fn_las) as reader:
+        points = reader.read_points(1)
+        return np.dtype([('cell', '<i8')] + [(dimension, np.array(points[dimension]).dtype.str)
+                                             for dimension in dimensions])
+
+
+def chm_grid_from_header(header, spatial_resolution):
+    '''
+    CHM grid of 'gen_chm.py' derived from the LAS header instead of the decoded points.
+
+    Returns
+    -------
+    boundary_tl, boundary_br: [X, Y]
+    img_shape: (img_ysize, img_xsize)
+    '''
+    boundary_tl = [round(header.mins[0]), round(header.maxs[1])] # Top-Left Coordinates (X,Y)
+    boundary_br = [round(header.maxs[0]), round(header.mins[1])] # Bottom-Right Coordinates (X,Y)
+
+    img_ysize = int(round(abs((boundary_tl[1]-boundary_br[1])/spatial_resolution)))
+    img_xsize = int(round(abs((boundary_tl[0]-boundary_br[0])/spatial_resolution)))
+    return boundary_tl, boundary_br, (img_ysize, img_xsize)
+
+
+class TileLayout:
+    '''
+    Raster tiles made of full-width bands of rows.
+    Tile k covers rows [k*tile_rows, min((k+1)*tile_rows, img_ysize)).
+    '''
+
+    def __init__(self, img_shape, tile_rows):
+        self.img_shape = img_shape
+        self.tile_rows = max(1, min(int(tile_rows), img_shape[0]))
+        self.n_tiles = int(np.ceil(img_shape[0] / self.tile_rows))
+
+    def rows(self, tile):
+        row0 = tile * self.tile_rows
+        return row0, min(row0 + self.tile_rows, self.img_shape[0])
+
+    def cells(self, tile):
+        row0, row1 = self.rows(tile)
+        return row0 * self.img_shape[1], row1 * self.img_shape[1]
+
+    def tile_of_cell(self, cell):
+        return cell // (self.tile_rows * self.img_shape[1])
+
+
+class SpillStore:
+    '''
+    Append-only files of (cell, dimensions...) records, one per tile and writer process, in one directory.
+    Every process appends to its own files (suffix 'part'), so several processes can spill
+    into the same store without locking.
+    '''
+
+    def __init__(self, dtype, spill_dir=None, path=None, part=0):
+        self.dtype = dtype
+        self.dir = path if path is not None else tempfile.mkdtemp(prefix='chm_spill_', dir=spill_dir)
+        self.part = part
+
+    def path(self, tile, part=None):
+        return os.path.join(self.dir, 'tile_%06d_%d.bin' % (tile, self.part if part is None else part))
+
+    def parts(self, tile):
+        return sorted(glob.glob(os.path.join(self.dir, 'tile_%06d_*.bin' % tile)))
+
+    def append(self, tile_ids, cell, values):
+        '''values: dict dimension name -> 1D array aligned with cell'''
+        order = np.argsort(tile_ids, kind='stable')
+        tile_ids = tile_ids[order]
+        records = np.empty(len(order), dtype=self.dtype)
+        records['cell'] = cell[order]
+        for name in self.dtype.names[1:]:
+            records[name] = values[name][order]
+        del order
+
+        bounds = np.flatnonzero(np.r_[True, tile_ids[1:] != tile_ids[:-1], True])
+        for n_b in range(len(bounds)-1):
+            with open(self.path(int(tile_ids[bounds[n_b]])), 'ab') as f:
+                records[bounds[n_b]:bounds[n_b+1]].tofile(f)
+
+    def load(self, tile):
+        '''Memory-mapped records of a tile; the parts of several writers are merged on disk first.'''
+        fn_parts = self.parts(tile)
+        if len(fn_parts) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        if len(fn_parts) > 1:
+            fn_merged = os.path.join(self.dir, 'tile_%06d_merged.tmp' % tile)
+            with open(fn_merged, 'wb') as f_out:
+                for fn_part in fn_parts:
+                    with open(fn_part, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out, 16 * 1024**2)
+                    os.remove(fn_part)
+            os.replace(fn_merged, self.path(tile, part=0))
+            fn_parts = [self.path(tile, part=0)]
+        if os.path.getsize(fn_parts[0]) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(fn_parts[0], dtype=self.dtype, mode='r')
+
+    def remove(self, tile):
+        for fn_part in self.parts(tile):
+            os.remove(fn_part)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def iter_chunks(fn_las, chunk_size, dimensions=('HeightAboveGround',), start=0, stop=None):
+    '''
+    Yield (x, y, values) of consecutive chunks of at most chunk_size points in [start, stop),
+    where values is a dict dimension name -> 1D array.
+    '''
+    with lp.open(fn_las) as reader:
+        if start == 0 and stop is None:
+            for points in reader.chunk_iterator(chunk_size):
+                yield np.array(points.x), np.array(points.y), \
+                      {dimension: np.array(points[dimension]) for dimension in dimensions}
+            return
+
+        stop = reader.header.point_count if stop is None else stop
+        reader.seek(start)
+        n_p = start
+        while n_p < stop:
+            points = reader.read_points(min(chunk_size, stop - n_p))
+            if len(points) == 0:
+                break
+            n_p += len(points)
+            yield np.array(points.x), np.array(points.y), \
+                  {dimension: np.array(points[dimension]) for dimension in dimensions}
+
+
+def prefetch_chunks(fn_las, chunk_size, dimensions=('HeightAboveGround',), start=0, stop=None, depth=2):
+    '''
+    iter_chunks with the chunks decoded ahead in a background thread: up to 'depth' decoded
+    chunks wait in a queue while the caller processes the current one.
+    '''
+    chunks = queue.Queue(maxsize=max(1, depth))
+    stopped = threading.Event()
+
+    def put(item):
+        # gives up when the caller stopped iterating
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decode():
+        try:
+            for chunk in iter_chunks(fn_las, chunk_size, dimensions, start, stop):
+                if not put(('chunk', chunk)):
+                    return
+                del chunk
+            put(('end', None))
+        except BaseException as e:
+            put(('end', e))
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = chunks.get()
+            if kind == 'end':
+                if item is not None:
+                    raise item
+                return
+            yield item
+            del item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def spill_points(fn_las, store_dir, dtype, layout, boundary_tl, spatial_resolution, chunk_size,
+                 start=0, stop=None, prefetch=0):
+    '''
+    Bin the points [start, stop) chunk by chunk and spill them to their tiles.
+
+    prefetch: number of chunks decoded ahead in a background thread (0: none)
+    '''
+    store = SpillStore(dtype, path=store_dir, part=os.getpid())
+    if prefetch > 0:
+        chunks = prefetch_chunks(fn_las, chunk_size, dtype.names[1:], start, stop, prefetch)
+    else:
+        chunks = iter_chunks(fn_las, chunk_size, dtype.names[1:], start, stop)
+    for x, y, values in chunks:
+        cell, inside = pixel_index(x, y, boundary_tl, spatial_resolution, layout.img_shape)
+        values = {name: tmp[inside] for name, tmp in values.items()}
+        del x, y, inside
+        if len(cell):
+            store.append(layout.tile_of_cell(cell), cell, values)
+        del cell, values
+
+
+def plan_memory(max_memory_mb, n_points, img_shape, record_bytes=16, n_products=1, prefetch=0):
+    '''
+    Split a peak memory budget between the chunk reader and the tile gridder.
+    With prefetch, the chunks decoded ahead and the tiles waiting for the writer thread
+    share the budget.
+
+    Returns
+    -------
+    chunk_size: points decoded at once
+    tile_rows: rows per tile, sized so that an average tile fits in the budget
+    max_tile_points: points gridded at once; denser tiles are split further
+    '''
+    budget = max_memory_mb * 1024**2
+    chunk_size = max(10_000, int(budget * 0.25 / BYTES_PER_CHUNK_POINT / (1 + prefetch)))
+    max_tile_points = max(10_000, int(budget * 0.5 / (TILE_BYTES_PER_RECORD_BYTE * record_bytes)))
+
+    points_per_row = max(1.0, n_points / max(1, img_shape[0]))
+    # half of the tile budget on average leaves room for denser-than-average tiles
+    tile_rows = max(1, int(max_tile_points / 2 / points_per_row))
+    # the output bands of a tile must fit as well (x3 with the writer thread: gridded, queued, being written)
+    n_outputs = 3 if prefetch > 0 else 1
+    tile_rows = min(tile_rows, max(1, int(budget * 0.25 / (4 * n_products * img_shape[1] * n_outputs))))
+    return chunk_size, tile_rows, max_tile_points
+
+
+def grid_spill(records, cell0, cell1, specs, max_points, spill_dir, out):
+    '''
+    Grid the spilled records of the cells [cell0, cell1) into the flat arrays of out.
+    Record sets larger than max_points are split in two cell ranges through temporary
+    files until each part fits; a single cell is always gridded as a whole.
+    out: dict product spec -> flat array indexed by cell - offset, with out['_offset']
+    '''
+    if len(records) == 0:
+        return
+
+    if len(records) > max_points and cell1 - cell0 > 1:
+        cell_mid = (cell0 + cell1) // 2
+        records_dtype = records.dtype
+        tmp_dir = tempfile.mkdtemp(dir=spill_dir)
+        try:
+            fn_parts = [os.path.join(tmp_dir, 'lower.bin'), os.path.join(tmp_dir, 'upper.bin')]
+            with open(fn_parts[0], 'ab') as f_lower, open(fn_parts[1], 'ab') as f_upper:
+                for n_s in range(0, len(records), max_points):
+                    tmp = np.asarray(records[n_s:n_s+max_points])
+                    lower = tmp['cell'] < cell_mid
+                    tmp[lower].tofile(f_lower)
+                    tmp[~lower].tofile(f_upper)
+                    del tmp, lower
+            del records
+            for fn_part, (c0, c1) in zip(fn_parts, [(cell0, cell_mid), (cell_mid, cell1)]):
+                if os.path.getsize(fn_part) > 0:
+                    part = np.memmap(fn_part, dtype=records_dtype, mode='r')
+                    grid_spill(part, c0, c1, specs, max_points, spill_dir, out)
+                    del part
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    cell = np.array(records['cell'])
+    dimensions = {name: np.array(records[name]) for name in records.dtype.names[1:]}
+    cells, stats = reduce_products(cell, dimensions, specs)
+    del cell, dimensions
+    for spec, values in stats.items():
+        out[spec][cells - out['_offset']] = values
+
+
+def grid_tile(store_dir, dtype, layout, tile, specs, max_points, no_data_value=-9999):
+    '''
+    Grid the spilled records of one tile.
+
+    Returns
+    -------
+    tile, row0, dict: product spec -> 2D array of the tile rows
+    '''
+    store = SpillStore(dtype, path=store_dir)
+    row0, row1 = layout.rows(tile)
+    cell0, cell1 = layout.cells(tile)
+
+    out = {'_offset': cell0}
+    for spec in specs:
+        out[spec] = np.zeros(cell1-cell0, dtype=np.uint32) if is_count_product(spec) else \
+                    np.full(cell1-cell0, no_data_value, dtype=np.float32)
+    grid_spill(store.load(tile), cell0, cell1, specs, max_points, store_dir, out)
+    store.remove(tile)
+
+    del out['_offset']
+    return tile, row0, {spec: values.reshape(row1-row0, layout.img_shape[1]) for spec, values in out.items()}
+
+
+def build_chm_streaming(fn_las, fn_out, spatial_resolution, percentile_value_for_chm,
+                        no_data_value=-9999, max_memory_mb=4096, dimension='HeightAboveGround',
+                        spill_dir=None, workers=1, products=None, separate_files=False,
+                        overviews=True, cog=False, fill_distance=0, smoothing_iterations=0, prefetch=0,
+                        fill_workers=None):
+    '''
+    Generate the same CHM as 'gen_chm.py' without loading the point cloud into memory.
+
+    fn_las: input point cloud (.las/.laz) with the 'dimension' attribute
+    fn_out: output CHM (.tif)
+    max_memory_mb: approximate peak memory of the point processing, shared by all workers (unit: MB)
+    spill_dir: directory for the temporary tile files (default: system temp directory)
+    workers: number of processes decoding point ranges and gridding tiles
+    products: product specs to build instead of the CHM alone, e.g.
+              ['HeightAboveGround:p98', 'HeightAboveGround:p50', 'z:max', 'count']
+    separate_files: write every product to its own file instead of a band of fn_out
+    overviews, cog: internal overviews and COG output (see chm_writer.finalize_raster)
+    fill_distance, smoothing_iterations: hole filling of every tile before it is written
+                                         (see chm_fill.StreamingFiller; unit: pixel)
+    fill_workers: number of processes filling holes (default: workers); the tile gridding pool is
+                  used when it has enough processes
+    prefetch: number of chunks decoded ahead by a background thread (in every worker), and
+              tiles written by a writer thread (0: decode, grid and write one after another)
+    '''
+    from osgeo import gdal
+
+    if products is None:
+        products = ['%s:p%g' % (dimension, percentile_value_for_chm)]
+
+    with open_las(fn_las) as reader:
+        header = reader.header
+        n_points = header.point_count
+        boundary_tl, boundary_br, img_shape = chm_grid_from_header(header, spatial_resolution)
+    print('       # of points in LAS: %d' % n_points)
+
+    dtype = spill_dtype(fn_las, spec_dimensions(products))
+    workers = max(1, int(workers))
+    fill_workers = workers if fill_workers is None else max(1, int(fill_workers))
+    chunk_size, tile_rows, max_tile_points = plan_memory(max_memory_mb / workers, n_points, img_shape,
+                                                         dtype.itemsize, len(products), prefetch)
+    if tile_rows > BLOCK_SIZE:
+        # whole tile rows of the output per tile
+        tile_rows -= tile_rows % BLOCK_SIZE
+    layout = TileLayout(img_shape, tile_rows)
+    print('       Streaming %d-point chunks into %d tiles of %d rows with %d worker(s)%s' % \
+          (chunk_size, layout.n_tiles, layout.tile_rows, workers,
+           ', %d chunk(s) decoded ahead' % prefetch if prefetch > 0 else ''))
+
+    # keep GDAL's block cache within the budget as well
+    gdal.SetCacheMax(int(max(16, max_memory_mb * 0.1)) * 1024**2)
+
+    store = SpillStore(dtype, spill_dir)
+    writer = None
+    fill_executor = None
+    try:
+        datasets, bands = create_product_rasters(fn_out, products, img_shape, boundary_tl,
+                                                 spatial_resolution, no_data_value, separate_files)
+        writer = BackgroundWriter(bands) if prefetch > 0 else None
+        filler = None
+        if fill_distance > 0:
+            from chm_fill import StreamingFiller
+            no_data_values = {spec: None if is_count_product(spec) else no_data_value for spec in products}
+
+        def create_filler(executor):
+            nonlocal fill_executor
+            if fill_workers > 1 and (executor is None or fill_workers > workers):
+                fill_executor = executor = ProcessPoolExecutor(max_workers=fill_workers)
+            return StreamingFiller(no_data_values, img_shape[0], fill_distance, smoothing_iterations,
+                                   workers=fill_workers, executor=executor if fill_workers > 1 else None)
+
+        def write(grids, row0):
+            # with hole filling, the rows are released once the next tile provides their halo
+            for tmp_grids, tmp_row0 in (filler.push(grids, row0) if filler is not None else [(grids, row0)]):
+                if writer is not None:
+                    writer.submit(tmp_grids, tmp_row0)
+                else:
+                    for spec in products:
+                        write_windowed(bands[spec], tmp_grids[spec], tmp_row0)
+
+        if workers == 1:
+            # # (1) Bin every chunk and spill the records to their tiles
+            spill_points(fn_las, store.dir, dtype, layout, boundary_tl, spatial_resolution, chunk_size,
+                         prefetch=prefetch)
+
+            # # (2) Grid every tile, fill its holes and write its rows
+            if fill_distance > 0:
+                filler = create_filler(None)
+            for tile in range(layout.n_tiles):
+                _, row0, grids = grid_tile(store.dir, dtype, layout, tile, products, max_tile_points, no_data_value)
+                write(grids, row0)
+                del grids
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # # (1) Decode disjoint point ranges in parallel; each process spills to its own files
+                n_ranges = min(workers * 4, max(1, int(np.ceil(n_points / chunk_size))))
+                bounds = np.linspace(0, n_points, n_ranges+1).astype(np.int64)
+                futures = [executor.submit(spill_points, fn_las, store.dir, dtype, layout, boundary_tl,
+                                           spatial_resolution, chunk_size,
+                                           int(bounds[n_r]), int(bounds[n_r+1]), prefetch)
+                           for n_r in range(n_ranges)]
+                for future in as_completed(futures):
+                    future.result()
+
+                # # (2) Grid tiles in parallel and write them in order as soon as they are done
+                # (hole filling needs the tiles in order). Only a few tiles are in flight or waiting
+                # for an earlier one at a time so that finished rows do not pile up.
+                if fill_distance > 0:
+                    filler = create_filler(executor)
+                pending, done = set(), {}
+                next_tile, next_write = 0, 0
+                while next_tile < layout.n_tiles or pending:
+                    while next_tile < layout.n_tiles and len(pending) + len(done) < 2 * workers:
+                        pending.add(executor.submit(grid_tile, store.dir, dtype, layout, next_tile, products,
+                                                    max_tile_points, no_data_value))
+                        next_tile += 1
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                    tile, row0, grids = future.result()
+                    done[tile] = (row0, grids)
+                    del future, grids
+                    while next_write in done:
+                        row0, grids = done.pop(next_write)
+                        write(grids, row0)
+                        next_write += 1
+                        del grids
+        if writer is not None:
+            writer.close()
+            writer = None
+        bands = None
+        datasets = None
+    finally:
+        if writer is not None:
+            # after an error: let the writer thread finish before the rasters are released
+            try:
+                writer.close()
+            except Exception:
+                pass
+        if fill_executor is not None:
+            fill_executor.shutdown()
+        store.close()
+
+    finalize_rasters(product_filenames(fn_out, products, separate_files), overviews, cog)
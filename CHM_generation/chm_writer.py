@@ -0,0 +1,216 @@
+'''
+    GeoTIFF output of the generated rasters (CHM and products).
+    The rasters are created tiled (512 x 512) and DEFLATE-compressed with the floating point
+    predictor, and written by windows of block rows, so reading a sub-region (e.g. the overlap
+    window of the registration code) only decodes the tiles it covers.
+    finalize_raster then adds internal overviews and, optionally, rewrites the file as a
+    Cloud-Optimized GeoTIFF (COG driver, GDAL >= 3.1).
+    BackgroundWriter writes the windows in a separate thread, so the next tile can be gridded
+    while the previous one is compressed and written.
+'''
+
+import os, queue, threading
+
+
+BLOCK_SIZE = 512
+
+
+def creation_options(block_size=BLOCK_SIZE, compress='DEFLATE'):
+    '''GTiff creation options of the generated rasters: tiled, compressed, BigTIFF when needed.'''
+    options = ['TILED=YES', 'BLOCKXSIZE=%d' % block_size, 'BLOCKYSIZE=%d' % block_size, 'BIGTIFF=IF_SAFER']
+    if compress:
+        # PREDICTOR=3: floating point predictor (every band is Float32)
+        options += ['COMPRESS=%s' % compress, 'PREDICTOR=3']
+    return options
+
+
+def create_chm_raster(fn_out, img_shape, boundary_tl, spatial_resolution,
+                      no_data_value=-9999, epsg=32718, n_bands=1, options=None):
+    '''
+    Create the (empty) Float32 CHM GeoTIFF with the geotransform of 'gen_chm.py'.
+
+    options: GTiff creation options (default: creation_options())
+    '''
+    from osgeo import gdal, osr
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_geotransform = [boundary_tl[0], spatial_resolution, 0,
+                        boundary_tl[1], 0, -spatial_resolution]
+    out_projection = osr.SpatialReference()
+    out_projection.ImportFromEPSG(epsg)
+
+    if options is None:
+        options = creation_options()
+    ndhm_ds = driver.Create(fn_out, img_shape[1], img_shape[0], n_bands, gdal.GDT_Float32, options=options)
+    ndhm_ds.SetGeoTransform(out_geotransform)
+    ndhm_ds.SetProjection(out_projection.ExportToWkt())
+    for n_band in range(n_bands):
+        ndhm_ds.GetRasterBand(n_band+1).SetNoDataValue(no_data_value)
+    return ndhm_ds
+
+
+def product_filename(fn_out, spec):
+    '''File of one product when products are written to separate files, e.g. chm_z_max.tif.'''
+    base, ext = os.path.splitext(fn_out)
+    return '%s_%s%s' % (base, spec.replace(':', '_'), ext if ext else '.tif')
+
+
+def product_filenames(fn_out, specs, separate_files=False):
+    '''Files written by create_product_rasters.'''
+    return [product_filename(fn_out, spec) for spec in specs] if separate_files else [fn_out]
+
+
+def create_product_rasters(fn_out, specs, img_shape, boundary_tl, spatial_resolution,
+                           no_data_value=-9999, separate_files=False):
+    '''
+    Create the output rasters of several products, as bands of fn_out (described by their
+    spec) or as one file per product (see product_filename).
+
+    Returns
+    -------
+    datasets: list of GDAL datasets (set to None to close them)
+    bands: dict spec -> GDAL band
+    '''
+    from chm_gridding import is_count_product
+
+    datasets, bands = [], {}
+    if separate_files:
+        for spec in specs:
+            tmp_ds = create_chm_raster(product_filename(fn_out, spec), img_shape, boundary_tl,
+                                       spatial_resolution, no_data_value)
+            datasets.append(tmp_ds)
+            bands[spec] = tmp_ds.GetRasterBand(1)
+    else:
+        tmp_ds = create_chm_raster(fn_out, img_shape, boundary_tl, spatial_resolution, no_data_value,
+                                   n_bands=len(specs))
+        datasets.append(tmp_ds)
+        for n_band, spec in enumerate(specs):
+            bands[spec] = tmp_ds.GetRasterBand(n_band+1)
+            if len(specs) > 1:
+                bands[spec].SetDescription(spec)
+    for spec in specs:
+        if is_count_product(spec):
+            # counts are 0 in empty pixels
+            bands[spec].DeleteNoDataValue()
+    return datasets, bands
+
+
+def write_windowed(band, img, row0=0, rows=BLOCK_SIZE):
+    '''
+    Write the rows of img to a band from row row0, one band of block rows at a time, so that
+    every tile row is complete (and compressed) before the next one is started.
+    '''
+    block_rows = max(int(band.GetBlockSize()[1]), 1)
+    rows = max(rows // block_rows, 1) * block_rows
+    n_row = 0
+    while n_row < img.shape[0]:
+        # align the windows with the block rows of the band
+        tmp_rows = min((((row0 + n_row) // rows) + 1) * rows - (row0 + n_row), img.shape[0] - n_row)
+        band.WriteArray(img[n_row:n_row+tmp_rows], 0, row0 + n_row)
+        n_row += tmp_rows
+
+
+class BackgroundWriter:
+    '''
+    Writes row windows (write_windowed) of several bands in a background thread.
+    The bands are only used by this thread until close(); errors are raised by the next
+    submit() or by close().
+
+    bands: dict product spec -> GDAL band
+    depth: number of finished windows waiting to be written (each holds the rows of every band)
+    '''
+
+    def __init__(self, bands, depth=1):
+        self.bands = bands
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # drain the queue after a failure
+                continue
+            grids, row0 = item
+            try:
+                for spec, grid in grids.items():
+                    write_windowed(self.bands[spec], grid, row0)
+            except BaseException as e:
+                self._error = e
+
+    def submit(self, grids, row0=0):
+        '''Queue the rows of every band (dict spec -> 2D array) from row row0; blocks while the queue is full.'''
+        if self._error is not None:
+            raise self._error
+        self._queue.put((grids, row0))
+
+    def close(self):
+        '''Wait until every queued window is written.'''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # the error of the caller is raised, not one of the writer
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+
+def overview_levels(img_shape, block_size=BLOCK_SIZE):
+    '''Overview factors 2, 4, 8, ... until the overview fits in one block.'''
+    levels = []
+    factor = 2
+    while max(img_shape) / (factor // 2) > block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def finalize_raster(fn, overviews=True, cog=False, resampling='AVERAGE'):
+    '''
+    Add internal overviews to a generated raster and optionally rewrite it as a COG.
+
+    overviews: build overviews (averaging valid pixels; nodata is excluded)
+    cog: rewrite fn as a Cloud-Optimized GeoTIFF, keeping its overviews, tiles and compression
+    '''
+    from osgeo import gdal
+
+    if overviews:
+        tmp_ds = gdal.Open(fn, gdal.GA_Update)
+        levels = overview_levels((tmp_ds.RasterYSize, tmp_ds.RasterXSize))
+        if levels:
+            tmp_ds.BuildOverviews(resampling, levels)
+        tmp_ds = None
+
+    if cog:
+        base, ext = os.path.splitext(fn)
+        fn_tmp = '%s_cog%s' % (base, ext)
+        # floating point predictor, as in creation_options (every band is Float32)
+        options = ['COMPRESS=DEFLATE', 'PREDICTOR=FLOATING_POINT', 'BLOCKSIZE=%d' % BLOCK_SIZE, 'BIGTIFF=IF_SAFER',
+                   'OVERVIEWS=%s' % ('AUTO' if overviews else 'NONE')]
+        tmp_ds = gdal.Translate(fn_tmp, fn, format='COG', creationOptions=options)
+        if tmp_ds is None:
+            raise RuntimeError('Cannot write a COG of %s' % fn)
+        tmp_ds = None
+        os.replace(fn_tmp, fn)
+
+
+def finalize_rasters(fns, overviews=True, cog=False):
+    '''finalize_raster for every file of a list.'''
+    for fn in fns:
+        finalize_raster(fn, overviews, cog)
@@ -10,100 +10,224 @@ percentile_value_for_chm = 98 # unit: percentile
 
 ######################## Can be modified ######################################
 no_data_value = -9999 # No data value for CHM, indicating no lidar returns or outside the TBS region
+fill_distance = 0 # Fill holes from valid pixels within this distance (unit: pixel). 0: no hole filling
+smoothing_iterations = 0 # 3x3 smoothing passes over the filled pixels
 ###############################################################################
 
-import os, time
+import os, sys, argparse
 import laspy as lp
 import numpy as np
-from osgeo import gdal, osr
-import rasterio
-from rasterio.fill import fillnodata
 
+from chm_gridding import pixel_index, grid_cells
+from chm_writer import create_chm_raster, write_windowed, finalize_raster
+# stage_profiler.py is in ../Instrumentation, next to this script's folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Instrumentation'))
+from stage_profiler import StageProfiler, stage_of
+
+
+# # Command-line arguments override the parameters above
+parser = argparse.ArgumentParser(description='Generate a CHM from a point cloud with a HeightAboveGround attribute.')
+parser.add_argument('--las', default=fn_las, help='input point cloud (.las/.laz)')
+parser.add_argument('--out', default=fn_out, help='output CHM (.tif)')
+parser.add_argument('--resolution', type=float, default=spatial_resolution, help='unit: meter')
+parser.add_argument('--percentile', type=float, default=percentile_value_for_chm, help='unit: percentile')
+parser.add_argument('--max-memory', type=float, default=None,
+                    help='peak memory cap (unit: MB). Streams the point cloud in chunks and spills tiles to disk')
+parser.add_argument('--spill-dir', default=None, help='directory for temporary tile files of the streaming mode')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of processes of the streaming mode (decoding and tile gridding)')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='streaming mode: chunks decoded ahead by a background thread while the current one is binned, '
+                         'and tiles written by a writer thread while the next one is gridded (0: no pipelining)')
+parser.add_argument('--sketch', choices=['topk', 'histogram'], default=None,
+                    help='approximate per-pixel percentile in one streaming pass with fixed memory per pixel')
+parser.add_argument('--topk', type=int, default=32, help='heights retained per pixel by the topk sketch')
+parser.add_argument('--bin-width', type=float, default=1., help='bin width of the histogram sketch (unit: meter)')
+parser.add_argument('--hist-range', type=float, nargs=2, default=[0., 80.], metavar=('ZMIN', 'ZMAX'),
+                    help='height range of the histogram sketch (unit: meter)')
+parser.add_argument('--products', nargs='+', default=None,
+                    help="rasters to build in one pass instead of the CHM alone, as 'dimension:statistic' "
+                         "(statistic: count, min, max, mean, p<q>, eq<v>) or 'count', "
+                         "e.g. HeightAboveGround:p98 HeightAboveGround:p50 z:max count return_number:eq1")
+parser.add_argument('--separate-files', action='store_true',
+                    help='write every product to its own file (<out>_<dimension>_<statistic>.tif) instead of a band of --out')
+parser.add_argument('--no-overviews', action='store_true', help='do not add internal overviews to the output')
+parser.add_argument('--cog', action='store_true', help='write Cloud-Optimized GeoTIFFs (GDAL >= 3.1)')
+parser.add_argument('--fill-distance', type=float, default=fill_distance,
+                    help='fill holes from valid pixels within this distance (unit: pixel; 0: no filling)')
+parser.add_argument('--smoothing-iterations', type=int, default=smoothing_iterations,
+                    help='3x3 smoothing passes over the filled pixels')
+parser.add_argument('--fill-workers', type=int, default=None,
+                    help='number of processes filling holes tile by tile (default: 1, or --workers in the streaming mode)')
+parser.add_argument('--bbox', type=float, nargs=4, default=None, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                    help='only generate the CHM window of this bounding box (e.g. the overlap with another flight), '
+                         'snapped to the pixels of the full CHM; only the points near it are decoded (see las_index.py)')
+parser.add_argument('--profile', default=None, help='save the time and memory of every stage to this file (.json)')
+parser.add_argument('--cprofile', default=None, help='dump cProfile statistics of the run to this file (.prof)')
+args = parser.parse_args()
+fn_las, fn_out = args.las, args.out
+spatial_resolution, percentile_value_for_chm = args.resolution, args.percentile
+overviews, cog = not args.no_overviews, args.cog
+fill_workers = args.fill_workers if args.fill_workers is not None else 1
+fill_distance, smoothing_iterations = args.fill_distance, args.smoothing_iterations
+
+# # (option) Time and memory of every stage (see stage_profiler.py); reported when the script exits
+profiler = None
+if args.profile is not None or args.cprofile is not None:
+    import atexit
+    profiler = StageProfiler('gen_chm', fn_json=args.profile, fn_cprofile=args.cprofile).__enter__()
+    atexit.register(profiler.__exit__, None, None, None)
+stage = stage_of(profiler)
+
+
+# # (option) Approximate percentiles with a fixed-memory per-pixel sketch (see chm_sketch.py)
+if args.bbox is not None and (args.sketch is not None or args.max_memory is not None or args.workers > 1
+                              or args.prefetch > 0):
+    parser.error('--bbox is only supported in memory (without --sketch, --max-memory, --workers and --prefetch)')
+if args.sketch is not None:
+    if args.products is not None:
+        parser.error('--products is not supported with --sketch')
+    if args.max_memory is not None or args.workers > 1 or args.prefetch > 0:
+        parser.error('--sketch reads the point cloud in one pass with fixed memory per pixel '
+                     '(without --max-memory, --workers and --prefetch)')
+    from chm_sketch import build_chm_sketch
+    with stage('sketch'):
+        build_chm_sketch(fn_las, fn_out, spatial_resolution, percentile_value_for_chm,
+                         no_data_value=no_data_value, sketch=args.sketch, k=args.topk, bin_width=args.bin_width,
+                         z_min=args.hist_range[0], z_max=args.hist_range[1],
+                         overviews=overviews, cog=cog, fill_distance=fill_distance,
+                         smoothing_iterations=smoothing_iterations, fill_workers=fill_workers)
+    print('       Check CHM in %s' % fn_out)
+    sys.exit(0)
+
+# # (option) Streaming (and multi-process) mode for point clouds larger than memory
+if args.max_memory is not None or args.workers > 1 or args.prefetch > 0:
+    from chm_streaming import build_chm_streaming
+    with stage('streaming'):
+        build_chm_streaming(fn_las, fn_out, spatial_resolution, percentile_value_for_chm,
+                            no_data_value=no_data_value,
+                            max_memory_mb=args.max_memory if args.max_memory is not None else 4096,
+                            spill_dir=args.spill_dir, workers=args.workers,
+                            products=args.products, separate_files=args.separate_files,
+                            overviews=overviews, cog=cog, fill_distance=fill_distance,
+                            smoothing_iterations=smoothing_iterations, prefetch=args.prefetch,
+                            fill_workers=args.fill_workers)
+    print('       Check CHM in %s' % fn_out)
+    sys.exit(0)
+
+# # (option) Several products (bands or files) from one read of the point cloud
+if args.products is not None:
+    from chm_gridding import grid_products, spec_dimensions, is_count_product
+    from chm_writer import create_product_rasters, product_filenames, finalize_rasters
+
+    with stage('LAS read') as record:
+        if args.bbox is not None:
+            from las_index import read_window
+            x, y, dimensions, boundary_tl, boundary_br = read_window(fn_las, args.bbox, spatial_resolution,
+                                                                     spec_dimensions(args.products))
+        else:
+            las = lp.read(fn_las)
+            x = np.array(las.x)
+            y = np.array(las.y)
+            dimensions = {name: np.array(las[name]) for name in spec_dimensions(args.products)}
+            del las
+
+            boundary_tl = [round(np.min(x)), round(np.max(y))] # Top-Left Coordinates (X,Y)
+            boundary_br = [round(np.max(x)), round(np.min(y))] # Bottom-Right Coordinates (X,Y)
+        record['items'] = len(x)
+        print('       # of points in LAS: %d' % len(x))
+
+    img_ysize = int(round(abs((boundary_tl[1]-boundary_br[1])/spatial_resolution)))
+    img_xsize = int(round(abs((boundary_tl[0]-boundary_br[0])/spatial_resolution)))
+
+    with stage('gridding', len(x)):
+        grids = grid_products(x, y, dimensions, boundary_tl, spatial_resolution, (img_ysize, img_xsize),
+                              args.products, no_data_value=no_data_value)
+    del x, y, dimensions
+    if fill_distance > 0:
+        from chm_fill import fill_tiles
+        with stage('hole filling', img_ysize * img_xsize):
+            for spec in args.products:
+                if not is_count_product(spec):
+                    grids[spec] = fill_tiles(grids[spec], grids[spec] != no_data_value, fill_distance,
+                                             smoothing_iterations, workers=fill_workers)
+    with stage('write', img_ysize * img_xsize * len(args.products)):
+        datasets, bands = create_product_rasters(fn_out, args.products, (img_ysize, img_xsize), boundary_tl,
+                                                 spatial_resolution, no_data_value, args.separate_files)
+        for spec in args.products:
+            write_windowed(bands[spec], grids[spec])
+        bands = None
+        datasets = None
+        finalize_rasters(product_filenames(fn_out, args.products, args.separate_files), overviews, cog)
+    print('       Check products in %s' % fn_out)
+    sys.exit(0)
 
-# # # # # # (1) Import las file # # # # #
-las = lp.read(fn_las)
-
-x = np.array(las.x)
-y = np.array(las.y)
-z = las['HeightAboveGround']
-# z = np.array(las.z) # '''If you are interested in ellipsoidal height, use this line instead of the right above'''
-del las
 
-# # Define boundary
-boundary_tl = [round(np.min(x)), round(np.max(y))] # Top-Left Coordinates (X,Y)
-boundary_br = [round(np.max(x)), round(np.min(y))] # Bottom-Rgith Coordinates (X,Y)
+# # # # # # (1) Import las file # # # # #
+with stage('LAS read') as record:
+    if args.bbox is not None:
+        # only the points of the window, which is aligned with the full CHM (see las_index.py)
+        from las_index import read_window
+        x, y, values, boundary_tl, boundary_br = read_window(fn_las, args.bbox, spatial_resolution)
+        z = values.pop('HeightAboveGround')
+        del values
+    else:
+        las = lp.read(fn_las)
+
+        x = np.array(las.x)
+        y = np.array(las.y)
+        z = np.array(las['HeightAboveGround'])
+        # z = np.array(las.z) # '''If you are interested in ellipsoidal height, use this line instead of the right above'''
+        del las
+
+        # # Define boundary
+        boundary_tl = [round(np.min(x)), round(np.max(y))] # Top-Left Coordinates (X,Y)
+        boundary_br = [round(np.max(x)), round(np.min(y))] # Bottom-Rgith Coordinates (X,Y)
+    record['items'] = len(z)
 print('       # of points in LAS: %d' % len(z))
 
 
 
 
 # # # # # # (2) Convert to the CHM image coordinate # # # # # #
-# tic = time.time()
-
-img_x_ndhm = np.round((x - boundary_tl[0])/spatial_resolution)
-img_y_ndhm = np.round((boundary_tl[1] - y)/spatial_resolution)
-
-dict_pts_ndhm = {}
-
-n_p = int(0)
-num_pts = len(z)
-while n_p < num_pts:
-    tmp_key = (int(img_x_ndhm[n_p]), int(img_y_ndhm[n_p]))
-    if not tmp_key in dict_pts_ndhm.keys():
-        dict_pts_ndhm[tmp_key] = [z[n_p]]
-    else:
-        dict_pts_ndhm[tmp_key].append(z[n_p])
-    del tmp_key
-
-    n_p += 1
-# print('       Took %.2f secs' %(time.time()-tic)); del tic
-del n_p, num_pts
+with stage('binning', len(z)):
+    img_ysize = int(round(abs((boundary_tl[1]-boundary_br[1])/spatial_resolution)))
+    img_xsize = int(round(abs((boundary_tl[0]-boundary_br[0])/spatial_resolution)))
+    cell, inside = pixel_index(x, y, boundary_tl, spatial_resolution, (img_ysize, img_xsize))
+    if not inside.all():
+        z = z[inside]
+    del x, y, inside
 
 
 
 
 # # # # # # (3) CHM image pixel value assign # # # # # #
-# tic = time.time()
-img_ysize = int(round(abs((boundary_tl[1]-boundary_br[1])/spatial_resolution)))
-img_xsize = int(round(abs((boundary_tl[0]-boundary_br[0])/spatial_resolution)))
-
-nop = np.zeros((img_ysize, img_xsize), dtype=np.uint16)
-ndhm = np.zeros((img_ysize, img_xsize), dtype=np.float32) - no_data_value
-for n_x in range(img_xsize):
-    for n_y in range(img_ysize):
-        if (n_x, n_y) in dict_pts_ndhm.keys():
-            ndhm[n_y, n_x] = np.percentile(dict_pts_ndhm[(n_x, n_y)], percentile_value_for_chm)
-            nop[n_y, n_x] = len(dict_pts_ndhm[(n_x, n_y)])
-del n_x, n_y
-# print('       Took %.2f secs' %(time.time()-tic)); del tic
-
-
-
-
-# # # # # (4) Save CHM and (optional) smoothing # # # # #
-out_format = 'GTiff'
-driver = gdal.GetDriverByName(out_format)
-out_geotransform = [boundary_tl[0], spatial_resolution, 0,
-                    boundary_tl[1], 0, -spatial_resolution]
-out_projection = osr.SpatialReference()
-out_projection.ImportFromEPSG(32718)
-
-ndhm_ds = driver.Create(fn_out, ndhm.shape[1], ndhm.shape[0], 1, gdal.GDT_Float32)
-ndhm_ds.SetGeoTransform(out_geotransform)
-ndhm_ds.SetProjection(out_projection.ExportToWkt())
-ndhm_ds.GetRasterBand(1).WriteArray(ndhm)
-ndhm_ds.GetRasterBand(1).SetNoDataValue(-9999)
-ndhm_ds = None
-del out_format, driver
-
-# # region - (option) Smoothing holes
-# with rasterio.open(fn_out, 'r+') as src:
-#     n_band = 1
-#     arr = src.read(n_band)
-#     arr_filled = fillnodata(arr, mask=nop, max_search_distance = spatial_resolution*10,
-#                             smoothing_iterations=0)
-#     src.write_band(n_band, arr_filled)
-# del src, arr, arr_filled, n_band
-# # endregion
+# Points are sorted once by pixel and every statistic is reduced per pixel (see chm_gridding.py)
+name_chm = 'p%g' % percentile_value_for_chm
+with stage('pixel assignment', len(z)):
+    grids = grid_cells(cell, z, (img_ysize, img_xsize), products=[name_chm, 'count'],
+                       no_data_value=no_data_value)
+ndhm = grids[name_chm]
+# number of points per pixel, kept as uint32: a uint16 copy wraps to 0 at multiples of 65,536 returns
+# and would turn those pixels into holes
+nop = grids['count']
+del grids, name_chm, cell
+
+
+
+
+# # # # # (4) (option) Filling holes and save CHM # # # # #
+# Holes are pixels without returns; they are filled tile by tile in memory (see chm_fill.py)
+if fill_distance > 0:
+    from chm_fill import fill_tiles
+    with stage('hole filling', ndhm.size):
+        ndhm = fill_tiles(ndhm, nop > 0, fill_distance, smoothing_iterations, workers=fill_workers)
+
+# Tiled and compressed GeoTIFF written by block rows, then internal overviews (see chm_writer.py)
+with stage('write', ndhm.size):
+    ndhm_ds = create_chm_raster(fn_out, ndhm.shape, boundary_tl, spatial_resolution, no_data_value, epsg=32718)
+    write_windowed(ndhm_ds.GetRasterBand(1), ndhm)
+    ndhm_ds = None
+    finalize_raster(fn_out, overviews, cog)
 print('       Check CHM in %s' % fn_out)
 
@@ -0,0 +1,232 @@
+'''
+    Spatial index of a point cloud, saved as a sidecar file ('<fn_las>.index.npz'), so that only
+    the points of a bounding box (e.g. the overlap strip of two flights) are read and decoded.
+    The points are indexed in file order by blocks of consecutive points; for LAZ, a block is a
+    compressed chunk (50,000 points by default), the unit the decoder can seek to. For every
+    block, the index records its point range, bounds and point count per tile of a coarse grid
+    (tile_size, unit: meter). A flight's points are stored along its scan lines, so each block
+    covers a narrow part of the flight and a bounding box only touches a few blocks.
+
+    Example:
+        python las_index.py F01.laz F02.laz --tile-size 50
+'''
+
+import os, struct, argparse
+import numpy as np
+
+
+INDEX_VERSION = 1
+
+
+def index_filename(fn_las):
+    return fn_las + '.index.npz'
+
+
+def laz_chunk_size(header):
+    '''Points per compressed chunk of a LAZ file (None for LAS or variable-size chunks).'''
+    for vlr in header.vlrs:
+        if vlr.user_id == 'laszip encoded' and vlr.record_id == 22204:
+            chunk_size = struct.unpack_from('<I', vlr.record_data_bytes(), 12)[0]
+            if 0 < chunk_size < 0xFFFFFFFF:
+                return int(chunk_size)
+    return None
+
+
+def build_index(fn_las, tile_size=50., block_points=None):
+    '''
+    Index a point cloud and save it next to it.
+
+    tile_size: tile size of the grid the point counts are recorded on (unit: meter)
+    block_points: points per block (default: the LAZ chunk size, or 50,000)
+    Returns
+    -------
+    dict of the index arrays (see load_index)
+    '''
+    from chm_streaming import open_las
+
+    stat = os.stat(fn_las)
+    with open_las(fn_las) as reader:
+        header = reader.header
+        if block_points is None:
+            block_points = laz_chunk_size(header) or 50_000
+        mins, maxs = np.array(header.mins[:2]), np.array(header.maxs[:2])
+        n_cols = int(np.floor((maxs[0] - mins[0]) / tile_size)) + 1
+        n_rows = int(np.floor((maxs[1] - mins[1]) / tile_size)) + 1
+
+        starts, bounds, cell_ptr, cells, counts = [0], [], [0], [], []
+        for points in reader.chunk_iterator(block_points):
+            x, y = np.array(points.x), np.array(points.y)
+            starts.append(starts[-1] + len(x))
+            bounds.append([x.min(), y.min(), x.max(), y.max()])
+            col = np.clip(((x - mins[0]) // tile_size).astype(np.int64), 0, n_cols - 1)
+            row = np.clip(((y - mins[1]) // tile_size).astype(np.int64), 0, n_rows - 1)
+            tmp_cells, tmp_counts = np.unique(row * n_cols + col, return_counts=True)
+            cells.append(tmp_cells)
+            counts.append(tmp_counts)
+            cell_ptr.append(cell_ptr[-1] + len(tmp_cells))
+            del x, y, col, row, points
+
+    index = {'version': INDEX_VERSION, 'file_size': stat.st_size, 'file_mtime_ns': stat.st_mtime_ns,
+             'point_count': starts[-1], 'block_points': block_points,
+             'mins': np.array(header.mins), 'maxs': np.array(header.maxs),
+             'tile_size': float(tile_size), 'n_cols': n_cols, 'n_rows': n_rows,
+             'starts': np.array(starts, dtype=np.int64), 'bounds': np.array(bounds, dtype=np.float64).reshape(-1, 4),
+             'cell_ptr': np.array(cell_ptr, dtype=np.int64),
+             'cells': np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64),
+             'counts': np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)}
+    np.savez(index_filename(fn_las), **index)
+    print('Check: ', index_filename(fn_las), '(%d blocks of %d points)' % (len(starts) - 1, block_points))
+    return index
+
+
+def load_index(fn_las, build=True, tile_size=50.):
+    '''
+    Index of a point cloud from its sidecar; (re)built when missing or older than the file
+    (with build=True; None otherwise).
+    '''
+    fn_index = index_filename(fn_las)
+    if os.path.exists(fn_index):
+        with np.load(fn_index) as tmp:
+            index = {name: tmp[name] for name in tmp.files}
+        for name in index:
+            if index[name].ndim == 0:
+                index[name] = index[name].item()
+        stat = os.stat(fn_las)
+        if index.get('version') == INDEX_VERSION and index['file_size'] == stat.st_size \
+                and index['file_mtime_ns'] == stat.st_mtime_ns:
+            return index
+        print('Warning: %s is out of date' % fn_index)
+    return build_index(fn_las, tile_size) if build else None
+
+
+def blocks_in_bbox(index, bbox):
+    '''
+    Blocks with points in a bounding box (xmin, ymin, xmax, ymax), by their grid tiles.
+
+    Returns
+    -------
+    1D int array of block numbers
+    '''
+    xmin, ymin, xmax, ymax = bbox
+    origin, tile_size, n_cols = index['mins'], index['tile_size'], index['n_cols']
+    col0, col1 = np.floor((xmin - origin[0]) / tile_size), np.floor((xmax - origin[0]) / tile_size)
+    row0, row1 = np.floor((ymin - origin[1]) / tile_size), np.floor((ymax - origin[1]) / tile_size)
+
+    cells = index['cells']
+    hit = (cells % n_cols >= col0) & (cells % n_cols <= col1) & (cells // n_cols >= row0) & (cells // n_cols <= row1)
+    block_of_cell = np.repeat(np.arange(len(index['cell_ptr']) - 1), np.diff(index['cell_ptr']))
+    blocks = np.unique(block_of_cell[hit])
+
+    bounds = index['bounds'][blocks]
+    inside = (bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)
+    return blocks[inside]
+
+
+def point_ranges(index, blocks):
+    '''[start, stop) point ranges of blocks, consecutive blocks merged.'''
+    ranges = []
+    for block in blocks:
+        start, stop = int(index['starts'][block]), int(index['starts'][block + 1])
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+    return ranges
+
+
+def read_bbox(fn_las, bbox, dimensions=('HeightAboveGround',), index=None, chunk_size=5_000_000, verbose=True):
+    '''
+    Points of a bounding box (xmin, ymin, xmax, ymax), decoding only the blocks that intersect it.
+
+    Returns
+    -------
+    x, y: 1D arrays
+    values: dict dimension name -> 1D array
+    '''
+    from chm_streaming import iter_chunks
+
+    if index is None:
+        index = load_index(fn_las)
+    xmin, ymin, xmax, ymax = bbox
+    ranges = point_ranges(index, blocks_in_bbox(index, bbox))
+
+    xs, ys, values = [], [], {dimension: [] for dimension in dimensions}
+    for start, stop in ranges:
+        for x, y, tmp_values in iter_chunks(fn_las, chunk_size, dimensions, start, stop):
+            inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+            xs.append(x[inside])
+            ys.append(y[inside])
+            for dimension in dimensions:
+                values[dimension].append(tmp_values[dimension][inside])
+            del x, y, tmp_values, inside
+
+    n_read = sum(stop - start for start, stop in ranges)
+    if verbose:
+        print('       Decoded %d of %d points (%.1f%%) for the bounding box' %
+              (n_read, index['point_count'], 100. * n_read / max(index['point_count'], 1)))
+    if not xs:
+        return np.zeros(0), np.zeros(0), {dimension: np.zeros(0) for dimension in dimensions}
+    return np.concatenate(xs), np.concatenate(ys), \
+           {dimension: np.concatenate(tmp) for dimension, tmp in values.items()}
+
+
+def snap_bbox(index, bbox, spatial_resolution):
+    '''
+    CHM grid of a bounding box, snapped to the pixels of the full-flight CHM of 'gen_chm.py'
+    (whose grid starts at the rounded minimum X / maximum Y of the point cloud), so the CHM of
+    the box equals the same window of the full CHM.
+
+    Returns
+    -------
+    boundary_tl, boundary_br: [X, Y] of the window
+    points_bbox: bounding box of the points that fall in its pixels
+    '''
+    from chm_streaming import chm_grid_from_header
+    from types import SimpleNamespace
+
+    header = SimpleNamespace(mins=index['mins'], maxs=index['maxs'])
+    boundary_tl, _, (img_ysize, img_xsize) = chm_grid_from_header(header, spatial_resolution)
+    xmin, ymin, xmax, ymax = bbox
+
+    col0 = int(np.clip(np.floor((xmin - boundary_tl[0]) / spatial_resolution), 0, img_xsize))
+    col1 = int(np.clip(np.ceil((xmax - boundary_tl[0]) / spatial_resolution), col0, img_xsize))
+    row0 = int(np.clip(np.floor((boundary_tl[1] - ymax) / spatial_resolution), 0, img_ysize))
+    row1 = int(np.clip(np.ceil((boundary_tl[1] - ymin) / spatial_resolution), row0, img_ysize))
+    if col1 == col0 or row1 == row0:
+        raise ValueError('The bounding box does not overlap the point cloud')
+
+    window_tl = [boundary_tl[0] + col0 * spatial_resolution, boundary_tl[1] - row0 * spatial_resolution]
+    window_br = [boundary_tl[0] + col1 * spatial_resolution, boundary_tl[1] - row1 * spatial_resolution]
+    # pixel k of the window holds the points within half a pixel of window_tl + k * resolution
+    half = spatial_resolution / 2
+    points_bbox = (window_tl[0] - half, window_br[1] - half, window_br[0] + half, window_tl[1] + half)
+    return window_tl, window_br, points_bbox
+
+
+def read_window(fn_las, bbox, spatial_resolution, dimensions=('HeightAboveGround',), index=None):
+    '''
+    Points of the CHM window of a bounding box (see snap_bbox), read through the index (built
+    first if needed).
+
+    Returns
+    -------
+    x, y: 1D arrays
+    values: dict dimension name -> 1D array
+    boundary_tl, boundary_br: [X, Y] of the window, as defined in 'gen_chm.py'
+    '''
+    if index is None:
+        index = load_index(fn_las)
+    boundary_tl, boundary_br, points_bbox = snap_bbox(index, bbox, spatial_resolution)
+    x, y, values = read_bbox(fn_las, points_bbox, dimensions, index)
+    return x, y, values, boundary_tl, boundary_br
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the spatial index sidecar of point clouds.')
+    parser.add_argument('las', nargs='+', help='point clouds (.las/.laz)')
+    parser.add_argument('--tile-size', type=float, default=50., help='unit: meter')
+    parser.add_argument('--block-points', type=int, default=None,
+                        help='points per block (default: the LAZ chunk size)')
+    args = parser.parse_args()
+    for fn_las in args.las:
+        build_index(fn_las, args.tile_size, args.block_points)
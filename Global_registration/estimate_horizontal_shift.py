@@ -5,18 +5,50 @@
     For 'mutual_information_2d', please refer to the **reference information provided within the function.    
 '''
 
+import os, sys
+from contextlib import contextmanager
+
+# stage_profiler.py (stage_of) is in ../Instrumentation, next to this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Instrumentation'))
+
+
 def estimate_horizontal_shift(fn_ref, fn_sen,
                  size_grid = '200', size_patch = '10', num_patch = '1',
-                 shift_x=[0, 10], shift_y=[0,10], buffer_size = 20, nodata = -9999, display=True):
+                 shift_x=[0, 10], shift_y=[0,10], buffer_size = 20, nodata = -9999, display=True,
+                 search='batched', workers=1, seed=0, profiler=None, cache_dir=None, cache_size_mb=1024,
+                 mi_kernel=False, mi_bins=64, return_diagnostics=False, diagnostics_size=1000,
+                 adaptive=False, confidence=0.99, min_patches=8):
     
     # fn_ref: file path of the reference CHM (.tif)
     # fn_sen: file path of the sensed CHM (which will be aligned to the reference CHM; .tif)
     # size_grid, size_patch, shift_x, shift_y, buffer_size are in meter.
+    # search: 'brute' (one 'mutual_information_2d' call per shift), 'batched' (same MI surface,
+    #         evaluated in batches by 'mi_search.py') or 'pyramid' (coarse-to-fine; see 'mi_search.py')
+    # workers: number of processes evaluating the grids in parallel (1: no process pool)
+    # seed: seed of the patch locations; grid [i, j] draws them from np.random.default_rng([seed, i, j]),
+    #       so the result does not depend on 'workers'
+    # profiler: StageProfiler (Instrumentation/stage_profiler.py) recording the stages, or None
+    # cache_dir: directory of the on-disk cache of MI surfaces ('mi_cache.py'; None: no cache). Re-runs on
+    #            the same CHMs only evaluate the patches and shifts that are not cached yet
+    # cache_size_mb: the least recently used surfaces are evicted above this size
+    # mi_kernel: compute the MI with 'MIKernel' of 'mi_search.py' (mi_bins fixed bins over the height range of
+    #            both overlap images, no smoothing) instead of 'mutual_information_2d'; faster, and MI values
+    #            are comparable across shifts and patches, but the surfaces differ from the default ones
+    # display: show the overlap images and the MI surface (blocks on plt.show()). With display=False,
+    #          matplotlib is not imported and no figure is drawn
+    # return_diagnostics: also return a dict of the data behind the figures (best MI surface, lut, overlap image
+    #                     downsampled to at most 'diagnostics_size' pixels per side), e.g. for 'render_diagnostics.py'
+    # adaptive: evaluate the patches of all grids in a random order and stop once the vote is decided, i.e.
+    #           the leading dx and dy each beat their runner-up with a one-sided sign test at 'confidence'
+    #           after at least 'min_patches' votes ('adaptive_patch_mis'). Undecided votes use every patch
     
     from osgeo import gdal
     from scipy.stats import mode
     import numpy as np
-    import matplotlib.pyplot as plt
+    from raster_overlap import read_overlap
+    from stage_profiler import stage_of
+    if display:
+        import matplotlib.pyplot as plt
 
 
     size_grid = float(size_grid)
@@ -24,6 +56,7 @@ def estimate_horizontal_shift(fn_ref, fn_sen,
     num_patch = int(num_patch)
     nodata = float(nodata)
     buffer_size = float(buffer_size)
+    stage = stage_of(profiler)
 
 
     ndhm_ref = gdal.Open(fn_ref)
@@ -39,64 +72,14 @@ def estimate_horizontal_shift(fn_ref, fn_sen,
     print('Spatial Resolution\n    REF: %.2f  |  SEN: %.2f' % (srx_ref, srx_sen))
     del skewx_ref, skewy_ref, skewx_sen, skewy_sen
 
-    brx_ref = ulx_ref + (ndhm_ref.RasterXSize) * srx_ref
-    bry_ref = uly_ref + (ndhm_ref.RasterYSize) * sry_ref
-    brx_sen = ulx_sen + (ndhm_sen.RasterXSize) * srx_sen
-    bry_sen = uly_sen + (ndhm_sen.RasterYSize) * sry_sen
-
-
-    tmp_x = np.sort(np.array([ulx_ref, brx_ref, ulx_sen, brx_sen]))
-    tmp_y = np.sort(np.array([uly_ref, bry_ref, uly_sen, bry_sen]))
-
-    overlap_ul = [tmp_x[1], tmp_y[2]]
-    overlap_br = [tmp_x[2], tmp_y[1]]
-    del tmp_x, tmp_y
     # endregion
 
 
     # region - Load Overlapped and Valid NDHM Image
-    img_coor_x1 = int(round((overlap_ul[0] - ulx_ref)/srx_ref))
-    if img_coor_x1 < 0: img_coor_x1 = 0
-    img_coor_y1 = int(round((overlap_ul[1] - uly_ref)/sry_ref))
-    if img_coor_y1 < 0: img_coor_y1 = 0
-    img_coor_x2 = int(round((overlap_br[0] - ulx_ref)/srx_ref))
-    if img_coor_x2 > ndhm_ref.RasterXSize: img_coor_x2 = ndhm_ref.RasterXSize
-    img_coor_y2 = int(round((overlap_br[1] - uly_ref)/sry_ref))
-    if img_coor_y2 > ndhm_ref.RasterYSize: img_coor_y2 = ndhm_ref.RasterYSize
-    # print(img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, img_coor_x2-img_coor_x1+1, img_coor_y2-img_coor_y1+1)
-    ndhm_img_ref = ndhm_ref.GetRasterBand(1).ReadAsArray(img_coor_x1, img_coor_y1,
-                                                        img_coor_x2-img_coor_x1,
-                                                        img_coor_y2-img_coor_y1)
-    tmp_coor1 = np.argwhere(ndhm_img_ref != nodata)
-    ymin1, xmin1 = np.min(tmp_coor1, axis=0)
-    ymax1, xmax1 = np.max(tmp_coor1, axis=0)
-
-
-    img_coor_x1 = int(round((overlap_ul[0] - ulx_sen)/srx_sen))
-    if img_coor_x1 < 0: img_coor_x1 = 0
-    img_coor_y1 = int(round((overlap_ul[1] - uly_sen)/sry_sen))
-    if img_coor_y1 < 0: img_coor_y1 = 0
-    img_coor_x2 = int(round((overlap_br[0] - ulx_sen)/srx_sen))
-    if img_coor_x2 > ndhm_sen.RasterXSize: img_coor_x2 = ndhm_sen.RasterXSize
-    img_coor_y2 = int(round((overlap_br[1] - uly_sen)/sry_sen))
-    if img_coor_y2 > ndhm_sen.RasterYSize: img_coor_y2 = ndhm_sen.RasterYSize
-    # print(img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, img_coor_x2-img_coor_x1+1, img_coor_y2-img_coor_y1+1)
-    ndhm_img_sen = ndhm_sen.GetRasterBand(1).ReadAsArray(img_coor_x1, img_coor_y1,
-                                                        img_coor_x2-img_coor_x1,
-                                                        img_coor_y2-img_coor_y1)
-    tmp_coor2 = np.argwhere(ndhm_img_sen != nodata)
-    ymin2, xmin2 = np.min(tmp_coor2, axis=0)
-    ymax2, xmax2 = np.max(tmp_coor2, axis=0)
-
-    tmp_y = np.sort(np.array([ymin1, ymin2, ymax1, ymax2]))
-    tmp_x = np.sort(np.array([xmin1, xmin2, xmax1, xmax2]))
-
-    buffer = int(round(buffer_size/srx_ref)) # unit: pixel
-    img_ref = ndhm_img_ref[tmp_y[1]+buffer:tmp_y[2]-buffer, tmp_x[1]+buffer:tmp_x[2]-buffer]
-    img_sen = ndhm_img_sen[tmp_y[1]+buffer:tmp_y[2]-buffer, tmp_x[1]+buffer:tmp_x[2]-buffer]
-    del img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, tmp_coor1, tmp_coor2,\
-        ymin1, xmin1, ymax1, xmax1, ymin2, xmin2, ymax2, xmax2, tmp_x, tmp_y, ndhm_img_ref, ndhm_img_sen
-
+    with stage('overlap load') as record:
+        buffer = int(round(buffer_size/srx_ref)) # unit: pixel
+        img_ref, img_sen = read_overlap(ndhm_ref, ndhm_sen, nodata, buffer)
+        record['items'] = img_ref.size
     # endregion
 
     # region - Image Display and size
@@ -128,121 +111,338 @@ def estimate_horizontal_shift(fn_ref, fn_sen,
 
     # region - Gridding
 
-    shift_init_x = round(shift_x[0]/srx_ref)
-    shift_range_x = round(shift_x[1]/srx_ref)
-    shift_init_y = round(shift_y[0]/sry_ref)
-    shift_range_y = round(shift_y[1]/sry_ref)
+    with stage('gridding'):
+        shift_init_x = round(shift_x[0]/srx_ref)
+        shift_range_x = round(shift_x[1]/srx_ref)
+        shift_init_y = round(shift_y[0]/sry_ref)
+        shift_range_y = round(shift_y[1]/sry_ref)
 
-    shifts_x = np.arange(shift_init_x-shift_range_x, shift_init_x+shift_range_x+1, 1).tolist() # unit: pixel
-    # print(shifts_x)
-    shifts_y = np.arange(shift_init_y-shift_range_y, shift_init_y+shift_range_y+1, -1).tolist()
-    # print(shifts_y)
+        shifts_x = np.arange(shift_init_x-shift_range_x, shift_init_x+shift_range_x+1, 1).tolist() # unit: pixel
+        # print(shifts_x)
+        shifts_y = np.arange(shift_init_y-shift_range_y, shift_init_y+shift_range_y+1, -1).tolist()
+        # print(shifts_y)
     
-    size_grid_img   = int(round(size_grid / srx_ref))
-    num_grid_x = int(np.ceil(img_ref.shape[1] / size_grid_img))
-    if num_grid_x < 1: num_grid_x = 2
-    num_grid_y = int(np.ceil(img_ref.shape[0] / size_grid_img))
-    if num_grid_y < 1: num_grid_y = 2
-
-    intervals_x = np.round(np.linspace(0, img_ref.shape[1], num_grid_x))
-    if np.min(shifts_x) < 0: intervals_x[0] = abs(np.min(shifts_x))
-    if np.max(shifts_x) > 0: intervals_x[-1] = img_ref.shape[1]-np.max(shifts_x)
-    # if np.max(shifts_x) > 0: intervals_x[0] = np.max(shifts_x)
-    # if np.min(shifts_x) < 0: intervals_x[-1] = img_ref.shape[1] + np.min(shifts_x)
-    intervals_y = np.round(np.linspace(0, img_ref.shape[0], num_grid_y))
-    if np.min(shifts_y) < 0: intervals_y[0] = abs(np.min(shifts_y))
-    if np.max(shifts_y) > 0: intervals_y[-1] = img_ref.shape[0]-np.max(shifts_y)
-    # if np.max(shifts_y) > 0: intervals_y[0] = np.max(shifts_y)
-    # if np.min(shifts_y) < 0: intervals_y[-1] = img_ref.shape[0] + np.min(shifts_y)
-    # print(intervals_x)
-    # print(intervals_y)
-    print('\nGrid Number:', len(intervals_x)-1, len(intervals_y)-1)
+        size_grid_img   = int(round(size_grid / srx_ref))
+        num_grid_x = int(np.ceil(img_ref.shape[1] / size_grid_img))
+        if num_grid_x < 1: num_grid_x = 2
+        num_grid_y = int(np.ceil(img_ref.shape[0] / size_grid_img))
+        if num_grid_y < 1: num_grid_y = 2
+
+        intervals_x = np.round(np.linspace(0, img_ref.shape[1], num_grid_x))
+        if np.min(shifts_x) < 0: intervals_x[0] = abs(np.min(shifts_x))
+        if np.max(shifts_x) > 0: intervals_x[-1] = img_ref.shape[1]-np.max(shifts_x)
+        # if np.max(shifts_x) > 0: intervals_x[0] = np.max(shifts_x)
+        # if np.min(shifts_x) < 0: intervals_x[-1] = img_ref.shape[1] + np.min(shifts_x)
+        intervals_y = np.round(np.linspace(0, img_ref.shape[0], num_grid_y))
+        if np.min(shifts_y) < 0: intervals_y[0] = abs(np.min(shifts_y))
+        if np.max(shifts_y) > 0: intervals_y[-1] = img_ref.shape[0]-np.max(shifts_y)
+        # if np.max(shifts_y) > 0: intervals_y[0] = np.max(shifts_y)
+        # if np.min(shifts_y) < 0: intervals_y[-1] = img_ref.shape[0] + np.min(shifts_y)
+        # print(intervals_x)
+        # print(intervals_y)
+        print('\nGrid Number:', len(intervals_x)-1, len(intervals_y)-1)
     # endregion
 
 
     # region - MI for selected patches
-    size_patch_img  = int(round(size_patch / srx_ref / 2))
-    mis_calculated = {}
-    lut = []
-    for i in range(len(intervals_x)-1):
-        for j in range(len(intervals_y)-1):
-            # print('[%d, %d] Grid' % (i, j))
-
-            x1 = int(intervals_x[i])
-            x2 = int(intervals_x[i+1])
-            y1 = int(intervals_y[j])
-            y2 = int(intervals_y[j+1])
+    with stage('patch sampling', (len(intervals_x)-1) * (len(intervals_y)-1) * num_patch):
+        size_patch_img  = int(round(size_patch / srx_ref / 2))
+        mis_calculated = {}
+        lut = []
+        grids = []
+        for i in range(len(intervals_x)-1):
+            for j in range(len(intervals_y)-1):
+                # print('[%d, %d] Grid' % (i, j))
+
+                x1 = int(intervals_x[i])
+                x2 = int(intervals_x[i+1])
+                y1 = int(intervals_y[j])
+                y2 = int(intervals_y[j+1])
             
-            grid_size_x = x2-x1
-            grid_size_y = y2-y1
-            seed_x = np.random.choice(grid_size_x-size_patch_img, num_patch, replace=False) + size_patch_img
-            seed_y = np.random.choice(grid_size_y-size_patch_img, num_patch, replace=False) + size_patch_img
-
-            
-            for n_p in range(num_patch):
-                
-                patch_img_ref = img_ref[y1:y2, x1:x2][seed_y[n_p]-size_patch_img:seed_y[n_p]+size_patch_img,
-                                                    seed_x[n_p]-size_patch_img:seed_x[n_p]+size_patch_img]
-                valid_ref = (patch_img_ref != nodata)
-
-                patch_mis = np.zeros((len(shifts_y), len(shifts_x)))
-                for n_dx in range(len(shifts_x)):
-                    for n_dy in range(len(shifts_y)):
-                        shift = [int(shifts_x[n_dx]), int(shifts_y[n_dy])]
-                        # print('      Shift (x, y)', shift) # true_loc = loc+shift
-                        
-                        tmp_img = img_sen[y1+shift[1]:y2+shift[1], x1+shift[0]:x2+shift[0]]
-                        patch_img_sen = tmp_img[seed_y[n_p]-size_patch_img:seed_y[n_p]+size_patch_img,
-                                             seed_x[n_p]-size_patch_img:seed_x[n_p]+size_patch_img]
-                        del tmp_img
-                        valid_sen = (patch_img_sen != nodata)
-                        valid_both = (valid_ref * valid_sen).ravel()
-                        # if np.sum(valid_both) != len(valid_both): dafdsf
-                        # print(patch_img_sen.ravel()[valid_both])
-                        patch_mis[n_dy, n_dx] = mutual_information_2d(patch_img_ref.ravel()[valid_both], patch_img_sen.ravel()[valid_both])
-                
-                mi_mx = np.max(patch_mis, axis=None)
-                position = np.argwhere(patch_mis==mi_mx)
-                if len(position) > 1:
-                    print('  Patch location: [%d, %d]' % (seed_x[n_p], seed_y[n_p]))
-                    print('    Warning: The MI results has multiple maximum points\n')
-                else:
-                    dx = shifts_x[position[0, 1]]
-                    dy = shifts_y[position[0, 0]]
-                    mis_calculated[(x1+seed_x[n_p], y1+seed_y[n_p])] = patch_mis
-                    # print('  Patch location: [%d, %d]' % (seed_x[n_p], seed_y[n_p]))
-                    # print('    Estimated Shift: %.2f in X' % (dx*srx_ref))
-                    # print('                   : %.2f in Y' % (dy*srx_ref))
-                    # print('    Calculated MI score: %.3f\n' % mi_mx)
-                    lut.append([x1+seed_x[n_p], y1+seed_y[n_p], dx, dy, mi_mx])
-    lut = np.array(lut)
-    # endregion
-
-    dx, count_x = mode(lut[:,2])
-    dy, count_y = mode(lut[:,3])
+                grid_size_x = x2-x1
+                grid_size_y = y2-y1
+                # the first patches do not depend on num_patch, so more patches extend a cached run
+                rng = np.random.default_rng([seed, i, j])
+                seed_x = rng.permutation(grid_size_x-size_patch_img)[:num_patch] + size_patch_img
+                seed_y = rng.permutation(grid_size_y-size_patch_img)[:num_patch] + size_patch_img
+                grids.append((x1, x2, y1, y2, seed_x, seed_y))
+
+    cache = None
+    if cache_dir is not None:
+        from mi_cache import MICache
+        cache = MICache(cache_dir, fn_ref, fn_sen, nodata, buffer, cache_size_mb)
+    kernel = None
+    if mi_kernel:
+        from mi_search import MIKernel
+        kernel = MIKernel.from_images(img_ref, img_sen, nodata, mi_bins)
+
+    patch_budget = sum(len(seed_x) for _, _, _, _, seed_x, _ in grids)
+    with stage('MI search', patch_budget * len(shifts_x) * len(shifts_y)) as record:
+        if adaptive:
+            patches = adaptive_patch_mis(img_ref, img_sen, grids, size_patch_img, shifts_x, shifts_y, nodata,
+                                         search, workers, cache, kernel, seed, confidence, min_patches)
+            record['items'] = len(patches) * len(shifts_x) * len(shifts_y)
+        else:
+            if workers > 1:
+                grid_mis = parallel_grid_patch_mis(img_ref, img_sen, grids, size_patch_img,
+                                                   shifts_x, shifts_y, nodata, search, workers, cache, kernel)
+            else:
+                grid_mis = [grid_patch_mis(img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                                           shifts_x, shifts_y, nodata, search, cache, kernel)
+                            for x1, x2, y1, y2, seed_x, seed_y in grids]
+            patches = [(x1, y1, tmp_x, tmp_y, patch_mis)
+                       for (x1, x2, y1, y2, seed_x, seed_y), patches_mis in zip(grids, grid_mis)
+                       for tmp_x, tmp_y, patch_mis in zip(seed_x, seed_y, patches_mis)]
+            del grid_mis
+    if cache is not None:
+        cache.evict()
+
+    with stage('mode voting') as record:
+        for x1, y1, tmp_x, tmp_y, patch_mis in patches:
+            vote = patch_vote(patch_mis, shifts_x, shifts_y)
+            if vote is None:
+                print('  Patch location: [%d, %d]' % (tmp_x, tmp_y))
+                print('    Warning: The MI results has multiple maximum points\n')
+            else:
+                dx, dy, mi_mx = vote
+                mis_calculated[(x1+tmp_x, y1+tmp_y)] = patch_mis
+                # print('  Patch location: [%d, %d]' % (tmp_x, tmp_y))
+                # print('    Estimated Shift: %.2f in X' % (dx*srx_ref))
+                # print('                   : %.2f in Y' % (dy*srx_ref))
+                # print('    Calculated MI score: %.3f\n' % mi_mx)
+                lut.append([x1+tmp_x, y1+tmp_y, dx, dy, mi_mx])
+        lut = np.array(lut)
+        # endregion
+
+        dx, count_x = mode(lut[:,2])
+        dy, count_y = mode(lut[:,3])
+        record['items'] = len(lut)
 
     shift_x = dx * srx_ref
     shift_y = dy * sry_ref
 
     print('Estimated Shifts in X and Y: [%.2f, %.2f]\n    with counts: [%d, %d] out of %d' % (shift_x, shift_y, count_x, count_y, len(lut)))
 
+    mi_location = (lut[lut[:,-1]==np.max(lut[:, -1]),0][0], lut[lut[:,-1]==np.max(lut[:, -1]),1][0])
+    img_mi = mis_calculated[mi_location]
     if display:
-        img_mi = mis_calculated[(lut[lut[:,-1]==np.max(lut[:, -1]),0][0], lut[lut[:,-1]==np.max(lut[:, -1]),1][0])]
         plt.figure()
         plt.imshow(img_mi), plt.colorbar(), plt.axis('off')
         plt.show()
-    
-    plt.figure()
-    plt.imshow(img_ref, clim=(0,55))
-    for n_p in range(len(lut)):
-        tmp = lut[n_p, :]
-        scale = 10
-        plt.arrow(tmp[0], img_ref.shape[0]-tmp[1], tmp[2]*scale, -tmp[3]*scale,
-                  ec='red')
 
+        plt.figure()
+        plt.imshow(img_ref, clim=(0,55))
+        for n_p in range(len(lut)):
+            tmp = lut[n_p, :]
+            scale = 10
+            plt.arrow(tmp[0], img_ref.shape[0]-tmp[1], tmp[2]*scale, -tmp[3]*scale,
+                      ec='red')
+
+    if return_diagnostics:
+        # a copy of every step-th pixel, so the diagnostics do not hold the overlap image
+        step = max(1, int(np.ceil(max(img_ref.shape) / diagnostics_size)))
+        diagnostics = {'kind': 'horizontal', 'shift': (shift_x, shift_y), 'counts': (int(count_x), int(count_y)),
+                       'mi_surface': img_mi, 'mi_location': mi_location,
+                       'shifts_x': shifts_x, 'shifts_y': shifts_y, 'resolution': (srx_ref, sry_ref),
+                       'lut': lut, 'img_ref': img_ref[::step, ::step].copy(), 'img_ref_shape': img_ref.shape,
+                       'patches_evaluated': len(patches), 'patch_budget': patch_budget}
+        return (shift_x, shift_y), lut, diagnostics
     return (shift_x, shift_y), lut
 
 
+def patch_vote(patch_mis, shifts_x, shifts_y):
+    '''
+    Shift voted for by a patch: (dx, dy, MI) at the maximum of its MI surface, or None when the
+    maximum is not unique. 'pyramid' leaves unevaluated shifts as NaN.
+    '''
+    import numpy as np
+
+    mi_mx = np.nanmax(patch_mis, axis=None)
+    position = np.argwhere(patch_mis==mi_mx)
+    if len(position) > 1:
+        return None
+    return shifts_x[position[0, 1]], shifts_y[position[0, 0]], mi_mx
+
+
+def vote_decided(votes, confidence=0.99):
+    '''
+    Whether the leading value of a vote (Counter) beats the runner-up: one-sided sign test of the
+    leader's share of the votes of both against 1/2, at the given confidence.
+    '''
+    from scipy.stats import binom
+
+    ranked = votes.most_common(2)
+    if not ranked:
+        return False
+    lead = ranked[0][1]
+    second = ranked[1][1] if len(ranked) > 1 else 0
+    return binom.sf(lead - 1, lead + second, 0.5) < 1 - confidence
+
+
+def adaptive_patch_mis(img_ref, img_sen, grids, size_patch_img, shifts_x, shifts_y, nodata,
+                       search='batched', workers=1, cache=None, kernel=None, seed=0,
+                       confidence=0.99, min_patches=8):
+    '''
+    MI surfaces of the patches of grids (x1, x2, y1, y2, seed_x, seed_y), evaluated in a random
+    order across all grids while the dx and dy votes are tallied, until both are decided
+    ('vote_decided') with at least min_patches votes, or every patch is evaluated.
+    With workers > 1, patches are evaluated in batches of 2 * workers in one process pool.
+
+    Returns
+    -------
+    list of (x1, y1, seed_x, seed_y, patch_mis) in evaluation order
+    '''
+    import numpy as np
+    from collections import Counter
+    from contextlib import nullcontext
+
+    candidates = [(n_g, n_p) for n_g, grid in enumerate(grids) for n_p in range(len(grid[4]))]
+    order = np.random.default_rng(seed).permutation(len(candidates))
+    batch_size = 2 * workers if workers > 1 else 1
+
+    patches = []
+    votes_x, votes_y = Counter(), Counter()
+    decided = False
+    with shared_image_pool(img_ref, img_sen, workers) if workers > 1 else nullcontext() as executor:
+        for n_b in range(0, len(order), batch_size):
+            tasks = []
+            for n_c in order[n_b:n_b+batch_size]:
+                n_g, n_p = candidates[n_c]
+                x1, x2, y1, y2, seed_x, seed_y = grids[n_g]
+                tasks.append((x1, x2, y1, y2, seed_x[n_p:n_p+1], seed_y[n_p:n_p+1], size_patch_img,
+                              shifts_x, shifts_y, nodata, search, cache, kernel))
+            if executor is not None:
+                results = list(executor.map(_shared_grid_patch_mis, tasks))
+            else:
+                results = [grid_patch_mis(img_ref, img_sen, *task) for task in tasks]
+
+            for task, (patch_mis,) in zip(tasks, results):
+                x1, _, y1, _, seed_x, seed_y = task[:6]
+                patches.append((x1, y1, seed_x[0], seed_y[0], patch_mis))
+                vote = patch_vote(patch_mis, shifts_x, shifts_y)
+                if vote is not None:
+                    votes_x[vote[0]] += 1
+                    votes_y[vote[1]] += 1
+            if sum(votes_x.values()) >= min_patches and vote_decided(votes_x, confidence) \
+                    and vote_decided(votes_y, confidence):
+                decided = True
+                break
+
+    print('Adaptive sampling: %d of %d patches evaluated (%s)' %
+          (len(patches), len(candidates), 'vote decided at confidence %g' % confidence if decided
+           else 'vote not decided, every patch used'))
+    return patches
+
+
+def grid_patch_mis(img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                   shifts_x, shifts_y, nodata, search='batched', cache=None, kernel=None):
+    '''
+    MI surfaces (len(shifts_y), len(shifts_x)) of the patches centered at (seed_x, seed_y)
+    within the grid [y1:y2, x1:x2] of 'estimate_horizontal_shift'.
+    cache: MICache ('mi_cache.py') the surfaces are read from and saved to, or None
+    kernel: MIKernel ('mi_search.py') computing the MI, or None ('mutual_information_2d'); 'brute' then
+            evaluates every shift as 'batched' does
+    '''
+    import numpy as np
+    if search != 'brute' or kernel is not None:
+        from mi_search import patch_mi_surface
+
+    surfaces = []
+    for n_p in range(len(seed_x)):
+        cached_mis = None
+        if cache is not None:
+            cached_mis = cache.load(x1+seed_x[n_p], y1+seed_y[n_p], size_patch_img, shifts_x, shifts_y,
+                                    search, kernel)
+            if cached_mis is not None and (search == 'pyramid' or not np.isnan(cached_mis).any()):
+                surfaces.append(cached_mis)
+                continue
+
+        patch_img_ref = img_ref[y1:y2, x1:x2][seed_y[n_p]-size_patch_img:seed_y[n_p]+size_patch_img,
+                                            seed_x[n_p]-size_patch_img:seed_x[n_p]+size_patch_img]
+        valid_ref = (patch_img_ref != nodata)
+
+        if search == 'brute' and kernel is None:
+            patch_mis = np.zeros((len(shifts_y), len(shifts_x))) if cached_mis is None else cached_mis
+            for n_dx in range(len(shifts_x)):
+                for n_dy in range(len(shifts_y)):
+                    if cached_mis is not None and not np.isnan(cached_mis[n_dy, n_dx]):
+                        continue
+                    shift = [int(shifts_x[n_dx]), int(shifts_y[n_dy])]
+                    # print('      Shift (x, y)', shift) # true_loc = loc+shift
+
+                    tmp_img = img_sen[y1+shift[1]:y2+shift[1], x1+shift[0]:x2+shift[0]]
+                    patch_img_sen = tmp_img[seed_y[n_p]-size_patch_img:seed_y[n_p]+size_patch_img,
+                                         seed_x[n_p]-size_patch_img:seed_x[n_p]+size_patch_img]
+                    del tmp_img
+                    valid_sen = (patch_img_sen != nodata)
+                    valid_both = (valid_ref * valid_sen).ravel()
+                    patch_mis[n_dy, n_dx] = mutual_information_2d(patch_img_ref.ravel()[valid_both], patch_img_sen.ravel()[valid_both])
+        else:
+            patch_mis = patch_mi_surface(patch_img_ref, img_sen, x1, x2, y1, y2,
+                                         seed_x[n_p], seed_y[n_p], size_patch_img,
+                                         shifts_x, shifts_y, nodata,
+                                         search='pyramid' if search == 'pyramid' else 'batched',
+                                         patch_mis=cached_mis if search != 'pyramid' else None, kernel=kernel)
+        if cache is not None:
+            cache.save(x1+seed_x[n_p], y1+seed_y[n_p], size_patch_img, shifts_x, shifts_y, patch_mis,
+                       search, kernel)
+        surfaces.append(patch_mis)
+    return surfaces
+
+
+_SHARED_IMAGES = {}
+
+
+def _load_shared_images(fn_img_ref, fn_img_sen):
+    '''Process pool initializer: memory-map the images once per worker.'''
+    import numpy as np
+    _SHARED_IMAGES['ref'] = np.load(fn_img_ref, mmap_mode='r')
+    _SHARED_IMAGES['sen'] = np.load(fn_img_sen, mmap_mode='r')
+
+
+def _shared_grid_patch_mis(args):
+    return grid_patch_mis(_SHARED_IMAGES['ref'], _SHARED_IMAGES['sen'], *args)
+
+
+@contextmanager
+def shared_image_pool(img_ref, img_sen, workers=2):
+    '''
+    Process pool whose workers run '_shared_grid_patch_mis' on the images. The images are written
+    once to memory-mapped temporary files that all workers read, instead of being pickled for
+    every task.
+    '''
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    tmp_dir = tempfile.mkdtemp(prefix='mi_patches_')
+    try:
+        fn_img_ref = os.path.join(tmp_dir, 'img_ref.npy')
+        fn_img_sen = os.path.join(tmp_dir, 'img_sen.npy')
+        np.save(fn_img_ref, img_ref)
+        np.save(fn_img_sen, img_sen)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_load_shared_images,
+                                 initargs=(fn_img_ref, fn_img_sen)) as executor:
+            yield executor
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def parallel_grid_patch_mis(img_ref, img_sen, grids, size_patch_img,
+                            shifts_x, shifts_y, nodata, search='batched', workers=2, cache=None,
+                            kernel=None):
+    '''
+    'grid_patch_mis' of every (x1, x2, y1, y2, seed_x, seed_y) in grids, in a process pool
+    ('shared_image_pool'). Results are returned in the order of grids.
+    '''
+    tasks = [(x1, x2, y1, y2, seed_x, seed_y, size_patch_img, shifts_x, shifts_y, nodata, search, cache, kernel)
+             for x1, x2, y1, y2, seed_x, seed_y in grids]
+    with shared_image_pool(img_ref, img_sen, workers) as executor:
+        return list(executor.map(_shared_grid_patch_mis, tasks))
+
+
 def mutual_information_2d(x, y, sigma=1, normalized=False):
     """
     Computes (normalized) mutual information between two 1D variate from a
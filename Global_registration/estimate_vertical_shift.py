@@ -5,17 +5,38 @@
     Refer to the data description paper (link provided in the README) for details.
 '''
 
-
-def estimate_vertical_shift(fn_ref, fn_sen, buffer = 100, display=True):
-    '''buffer unit : pixel'''
+import os, sys
+# stage_profiler.py (stage_of) is in ../Instrumentation, next to this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Instrumentation'))
+
+
+def estimate_vertical_shift(fn_ref, fn_sen, buffer = 100, display=True, return_stats=False,
+                            nodata = -9999, block_rows = 1024, profiler=None, return_diagnostics=False):
+    '''
+    buffer unit : pixel
+    return_stats: also return a dict with the sub-bin 'mode', 'median', robust 'spread'
+                  (IQR / 1.349) and 'count' of the valid differences (see difference_stats)
+    block_rows: rows of the overlap window read at once; the difference histogram is
+                accumulated block by block, so memory does not grow with the DTM size
+    profiler: StageProfiler (Instrumentation/stage_profiler.py) recording the stages, or None
+    display: show the overlap images and the differences (blocks on plt.show()); with display=False,
+             matplotlib is not imported
+    return_diagnostics: also return (last) a dict with the histogram of the differences ('hist',
+                        'bin_edges'), e.g. for 'render_diagnostics.py'
+    '''
     from osgeo import gdal
     import numpy as np
-    import matplotlib.pyplot as plt
-    
+    from stage_profiler import stage_of
+    if display:
+        import matplotlib.pyplot as plt
+    from raster_overlap import overlap_windows, read_window, strip_rows
+
+    stage = stage_of(profiler)
+
     dem_ref = gdal.Open(fn_ref)
     dem_sen = gdal.Open(fn_sen)
 
-    
+
 
     # region - Define Overlap Area
     ulx_ref, srx_ref, skewx_ref, uly_ref, skewy_ref, sry_ref = dem_ref.GetGeoTransform()
@@ -24,70 +45,24 @@ def estimate_vertical_shift(fn_ref, fn_sen, buffer = 100, display=True):
         print('Warning:    The spatial resolutions of input images are not same!')
     print('Spatial Resolution\n    REF: %.2f\n    SEN: %.2f' % (srx_ref, srx_sen))
 
-    brx_ref = ulx_ref + (dem_ref.RasterXSize) * srx_ref
-    bry_ref = uly_ref + (dem_ref.RasterYSize) * sry_ref
-    brx_sen = ulx_sen + (dem_sen.RasterXSize) * srx_sen
-    bry_sen = uly_sen + (dem_sen.RasterYSize) * sry_sen
-
-    tmp_x = np.sort(np.array([ulx_ref, brx_ref, ulx_sen, brx_sen]))
-    tmp_y = np.sort(np.array([uly_ref, bry_ref, uly_sen, bry_sen]))
-
-    overlap_ul = [tmp_x[1], tmp_y[2]]
-    overlap_br = [tmp_x[2], tmp_y[1]]
-    # print(overlap_ul)
-    # print(overlap_br)
-    del tmp_x, tmp_y
     # endregion
 
 
-    # region - Load Overlapped and Valid DEM Image
-
-    img_coor_x1 = int(round((overlap_ul[0] - ulx_ref)/srx_ref))
-    if img_coor_x1 < 0: img_coor_x1 = 0
-    img_coor_y1 = int(round((overlap_ul[1] - uly_ref)/sry_ref))
-    if img_coor_y1 < 0: img_coor_y1 = 0
-    img_coor_x2 = int(round((overlap_br[0] - ulx_ref)/srx_ref))
-    if img_coor_x2 > dem_ref.RasterXSize: img_coor_x2 = dem_ref.RasterXSize
-    img_coor_y2 = int(round((overlap_br[1] - uly_ref)/sry_ref))
-    if img_coor_y2 > dem_ref.RasterYSize: img_coor_y2 = dem_ref.RasterYSize
-    # print(img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, img_coor_x2-img_coor_x1+1, img_coor_y2-img_coor_y1+1)
-    ndhm_img_ref = dem_ref.GetRasterBand(1).ReadAsArray(img_coor_x1, img_coor_y1,
-                                                        img_coor_x2-img_coor_x1,
-                                                        img_coor_y2-img_coor_y1)
-    tmp_coor1 = np.argwhere(ndhm_img_ref != -9999)
-    ymin1, xmin1 = np.min(tmp_coor1, axis=0)
-    ymax1, xmax1 = np.max(tmp_coor1, axis=0)
-
-
-    img_coor_x1 = int(round((overlap_ul[0] - ulx_sen)/srx_sen))
-    if img_coor_x1 < 0: img_coor_x1 = 0
-    img_coor_y1 = int(round((overlap_ul[1] - uly_sen)/sry_sen))
-    if img_coor_y1 < 0: img_coor_y1 = 0
-    img_coor_x2 = int(round((overlap_br[0] - ulx_sen)/srx_sen))
-    if img_coor_x2 > dem_sen.RasterXSize: img_coor_x2 = dem_sen.RasterXSize
-    img_coor_y2 = int(round((overlap_br[1] - uly_sen)/sry_sen))
-    if img_coor_y2 > dem_sen.RasterYSize: img_coor_y2 = dem_sen.RasterYSize
-    # print(img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, img_coor_x2-img_coor_x1+1, img_coor_y2-img_coor_y1+1)
-    ndhm_img_sen = dem_sen.GetRasterBand(1).ReadAsArray(img_coor_x1, img_coor_y1,
-                                                        img_coor_x2-img_coor_x1,
-                                                        img_coor_y2-img_coor_y1)
-    tmp_coor2 = np.argwhere(ndhm_img_sen != -9999)
-    ymin2, xmin2 = np.min(tmp_coor2, axis=0)
-    ymax2, xmax2 = np.max(tmp_coor2, axis=0)
-
-    tmp_y = np.sort(np.array([ymin1, ymin2, ymax1, ymax2]))
-    tmp_x = np.sort(np.array([xmin1, xmin2, xmax1, xmax2]))
-
-
-    img_ref = ndhm_img_ref[tmp_y[1]+buffer:tmp_y[2]-buffer, tmp_x[1]+buffer:tmp_x[2]-buffer]
-    img_sen = ndhm_img_sen[tmp_y[1]+buffer:tmp_y[2]-buffer, tmp_x[1]+buffer:tmp_x[2]-buffer]
-    del img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2, tmp_coor1, tmp_coor2,\
-        ymin1, xmin1, ymax1, xmax1, ymin2, xmin2, ymax2, xmax2, tmp_x, tmp_y, ndhm_img_ref, ndhm_img_sen
-
+    # region - Overlapped and Valid DEM Window
+    with stage('overlap windows'):
+        window_ref, window_sen = overlap_windows(dem_ref, dem_sen, nodata, buffer)
+    band_ref = dem_ref.GetRasterBand(1)
+    band_sen = dem_sen.GetRasterBand(1)
+    size_x = window_ref[2] - window_ref[0]
+    size_y = window_ref[3] - window_ref[1]
+    if (size_x, size_y) != (window_sen[2] - window_sen[0], window_sen[3] - window_sen[1]):
+        raise ValueError('The overlap windows of the input images differ in size')
     # endregion
 
     # region - Debug. Image Display
     if display:
+        img_ref = read_window(band_ref, window_ref)
+        img_sen = read_window(band_sen, window_sen)
         fig = plt.figure()
         ax = fig.add_subplot(1,2,1)
         ax.imshow(img_ref, clim = (0, np.max(img_ref, axis=None)))
@@ -96,30 +71,90 @@ def estimate_vertical_shift(fn_ref, fn_sen, buffer = 100, display=True):
         ax.imshow(img_sen, clim = (0, np.max(img_sen, axis=None)))
         plt.axis('off')
         plt.show()
+        del img_ref, img_sen
     # endregion
 
 
-    mask = (img_ref != -9999) * (img_sen != -9999)
-    img_dif = img_ref-img_sen
-    tmp_loc = np.argwhere(mask == 0)
-    for n_p in range(len(tmp_loc)):
-        img_dif[tmp_loc[n_p, 0], tmp_loc[n_p,1]] = -9999
-    del tmp_loc, n_p, mask
-
+    # region - Histogram of the differences, block by block
     tmp_bin = np.arange(-10, 10, 0.1)
-    hist, bin_edges = np.histogram(img_dif.ravel(), bins= tmp_bin, density=False)
+    hist = np.zeros(len(tmp_bin)-1, dtype=np.int64)
+    count = 0
+    with stage('histogram', size_x * size_y):
+        # strips in absolute rows of the reference, so they follow its block rows
+        for row0, row1 in strip_rows(band_ref, window_ref[1], window_ref[1]+size_y, block_rows):
+            tmp_ref = band_ref.ReadAsArray(window_ref[0], row0, size_x, row1-row0)
+            tmp_sen = band_sen.ReadAsArray(window_sen[0], window_sen[1]+row0-window_ref[1], size_x, row1-row0)
+            mask = (tmp_ref != nodata) & (tmp_sen != nodata)
+            tmp_dif = (tmp_ref - tmp_sen)[mask]
+            hist += np.histogram(tmp_dif, bins=tmp_bin, density=False)[0]
+            count += len(tmp_dif)
+            del tmp_ref, tmp_sen, mask, tmp_dif
+    # endregion
+
     shift_z=(tmp_bin[:-1][hist==np.max(hist)]+tmp_bin[1:][hist==np.max(hist)])/2
     print(shift_z)
 
     if display:
+        img_ref = read_window(band_ref, window_ref)
+        img_sen = read_window(band_sen, window_sen)
+        img_dif = img_ref - img_sen
+        img_dif[(img_ref == nodata) | (img_sen == nodata)] = nodata
+        del img_ref, img_sen
         plt.figure()
-        plt.hist(img_dif.ravel(), bins=np.arange(shift_z-5,shift_z+5,0.1))
+        plt.hist(img_dif.ravel(), bins=np.arange(shift_z[0]-5,shift_z[0]+5,0.1))
         plt.figure()
-        plt.imshow(img_dif, clim=(shift_z-5,shift_z+5)), plt.colorbar()
+        plt.imshow(img_dif, clim=(shift_z[0]-5,shift_z[0]+5)), plt.colorbar()
         plt.axis('off')
         plt.show()
-    return shift_z    
 
+    outputs = [shift_z]
+    if return_stats:
+        outputs.append(difference_stats(hist, tmp_bin, count))
+    if return_diagnostics:
+        outputs.append({'kind': 'vertical', 'shift_z': shift_z, 'hist': hist, 'bin_edges': tmp_bin, 'count': count})
+    return tuple(outputs) if len(outputs) > 1 else shift_z
+
+
+def difference_stats(hist, bin_edges, count):
+    '''
+    Summary of a histogram of DTM differences.
+
+    Returns
+    -------
+    dict:
+        'mode': peak refined within its bin by a parabola through the peak bin and its neighbors
+        'median': from the cumulative histogram, interpolated within the bin
+        'spread': robust standard deviation, (75th - 25th percentile) / 1.349
+        'count': number of valid (non-nodata) differences
+        'count_in_range': differences within the histogram range
+    '''
+    import numpy as np
 
-# # # # Example code to run # # # # 
-# shift_v = estimate_vertical_shift(filepath_dtm1, filepath_dtm2)
\ No newline at end of file
+    width = bin_edges[1:] - bin_edges[:-1]
+    centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    n_in = int(np.sum(hist))
+    stats = {'mode': np.nan, 'median': np.nan, 'spread': np.nan,
+             'count': int(count), 'count_in_range': n_in}
+    if n_in == 0:
+        return stats
+
+    peak = int(np.argmax(hist))
+    offset = 0.
+    if 0 < peak < len(hist)-1:
+        tmp_l, tmp_c, tmp_r = hist[peak-1:peak+2].astype(float)
+        curvature = tmp_l - 2*tmp_c + tmp_r
+        if curvature < 0:
+            offset = 0.5 * (tmp_l - tmp_r) / curvature
+    stats['mode'] = float(centers[peak] + offset * width[peak])
+
+    cumulative = np.concatenate([[0], np.cumsum(hist)]) / n_in
+    percentile = lambda q: float(np.interp(q, cumulative, bin_edges))
+    stats['median'] = percentile(0.5)
+    stats['spread'] = (percentile(0.75) - percentile(0.25)) / 1.349
+    return stats
+
+
+# # # # Example code to run # # # #
+# shift_v = estimate_vertical_shift(filepath_dtm1, filepath_dtm2)
+# shift_v, stats = estimate_vertical_shift(filepath_dtm1, filepath_dtm2, return_stats=True)
+# shift_v, diagnostics = estimate_vertical_shift(filepath_dtm1, filepath_dtm2, display=False, return_diagnostics=True)
@@ -0,0 +1,141 @@
+'''
+    On-disk cache of the per-patch MI surfaces of 'estimate_horizontal_shift'.
+    Surfaces are stored per pair of input CHMs (keyed by the hashes of both files, the nodata
+    value and the overlap buffer), one .npz file per patch location and patch size, with the
+    shifts they were evaluated at. A re-run (after a crash, or with another num_patch or a wider
+    shift range) only evaluates the patches and shifts that are not in the cache yet.
+    The least recently used files are evicted once the cache exceeds its size.
+'''
+
+import os, hashlib, tempfile
+
+import numpy as np
+
+
+_FILE_HASHES = {}
+
+
+def file_hash(fn, chunk_size=1 << 22):
+    '''BLAKE2b digest of a file's content; memoized per (path, size, modification time).'''
+    stat = os.stat(fn)
+    key = (os.path.abspath(fn), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_HASHES:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        _FILE_HASHES[key] = digest.hexdigest()
+    return _FILE_HASHES[key]
+
+
+def search_family(search, kernel=None):
+    '''
+    'brute' and 'batched' give identical MI values for every shift and share their entries;
+    'pyramid' surfaces leave shifts unevaluated (NaN) and are kept apart, as are the MI values
+    of an MIKernel ('mi_search.py'). Pyramid surfaces saved before their maximum was checked by
+    brute force are not reused.
+    '''
+    family = 'pyramid2' if search == 'pyramid' else 'full'
+    if kernel is not None:
+        family = '%s_%s' % (family, hashlib.blake2b(kernel.key.encode(), digest_size=8).hexdigest())
+    return family
+
+
+class MICache:
+    '''
+    cache_dir: root directory of the cache (shared by all pairs of CHMs)
+    fn_ref, fn_sen: input CHMs of 'estimate_horizontal_shift'
+    nodata, buffer: as used to read the overlap images (buffer unit: pixel)
+    max_size_mb: size of cache_dir above which the least recently used files are evicted
+    '''
+
+    def __init__(self, cache_dir, fn_ref, fn_sen, nodata, buffer, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        key = '%s_%s_%r_%d' % (file_hash(fn_ref), file_hash(fn_sen), float(nodata), int(buffer))
+        self.pair_dir = os.path.join(cache_dir, hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+        os.makedirs(self.pair_dir, exist_ok=True)
+
+    def filename(self, x, y, size_patch_img, search, kernel=None):
+        '''Entry of the patch centered at (x, y) of the overlap image.'''
+        return os.path.join(self.pair_dir, '%s_%d_%d_%d.npz' % (search_family(search, kernel), x, y, size_patch_img))
+
+    def _read(self, fn):
+        try:
+            with np.load(fn) as entry:
+                return entry['shifts_x'], entry['shifts_y'], entry['mis']
+        except (OSError, ValueError, KeyError):
+            # missing, or left incomplete by another process
+            return None
+
+    def load(self, x, y, size_patch_img, shifts_x, shifts_y, search='batched', kernel=None):
+        '''
+        Cached MI surface (len(shifts_y), len(shifts_x)) of a patch, NaN at the shifts that were
+        not evaluated yet, or None. Pyramid surfaces are only reused for the same shifts.
+        '''
+        fn = self.filename(x, y, size_patch_img, search, kernel)
+        entry = self._read(fn)
+        if entry is None:
+            return None
+        cached_x, cached_y, cached_mis = entry
+        os.utime(fn)  # recently used
+
+        if search == 'pyramid':
+            if np.array_equal(cached_x, shifts_x) and np.array_equal(cached_y, shifts_y):
+                return cached_mis
+            return None
+
+        patch_mis = np.full((len(shifts_y), len(shifts_x)), np.nan)
+        index_x = {dx: n for n, dx in enumerate(cached_x.tolist())}
+        index_y = {dy: n for n, dy in enumerate(cached_y.tolist())}
+        cols = [(n_dx, index_x[dx]) for n_dx, dx in enumerate(shifts_x) if dx in index_x]
+        rows = [(n_dy, index_y[dy]) for n_dy, dy in enumerate(shifts_y) if dy in index_y]
+        if not cols or not rows:
+            return None
+        (tar_cols, src_cols), (tar_rows, src_rows) = zip(*cols), zip(*rows)
+        patch_mis[np.ix_(tar_rows, tar_cols)] = cached_mis[np.ix_(src_rows, src_cols)]
+        return patch_mis
+
+    def save(self, x, y, size_patch_img, shifts_x, shifts_y, patch_mis, search='batched', kernel=None):
+        '''Store the MI surface of a patch, merged with the shifts already cached.'''
+        fn = self.filename(x, y, size_patch_img, search, kernel)
+        shifts_x, shifts_y = np.asarray(shifts_x), np.asarray(shifts_y)
+        entry = self._read(fn) if search != 'pyramid' else None
+        if entry is not None:
+            cached_x, cached_y, cached_mis = entry
+            merged_x, merged_y = np.union1d(cached_x, shifts_x), np.union1d(cached_y, shifts_y)
+            merged_mis = np.full((len(merged_y), len(merged_x)), np.nan)
+            for tmp_x, tmp_y, tmp_mis in ((cached_x, cached_y, cached_mis), (shifts_x, shifts_y, patch_mis)):
+                index = np.ix_(np.searchsorted(merged_y, tmp_y), np.searchsorted(merged_x, tmp_x))
+                merged_mis[index] = np.where(np.isnan(tmp_mis), merged_mis[index], tmp_mis)
+            shifts_x, shifts_y, patch_mis = merged_x, merged_y, merged_mis
+
+        # written next to the entry and renamed, so concurrent readers never see a partial file
+        fd, fn_tmp = tempfile.mkstemp(suffix='.npz', dir=self.pair_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, shifts_x=shifts_x, shifts_y=shifts_y, mis=patch_mis)
+        os.replace(fn_tmp, fn)
+
+    def evict(self):
+        '''Delete the least recently used entries (of all pairs) until the cache fits max_size_mb.'''
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                fn = os.path.join(root, name)
+                try:
+                    stat = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, fn in sorted(entries):
+            if total <= self.max_size_mb * 1024**2:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                continue
+            total -= size
+            n_evicted += 1
+        print('MI cache: %.1f MB in %s (%d entries evicted)' % (total / 1024**2, self.cache_dir, n_evicted))
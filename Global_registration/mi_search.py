@@ -0,0 +1,319 @@
+'''
+    Batched mutual-information shift search for 'estimate_horizontal_shift'.
+    Instead of calling 'mutual_information_2d' once per (dx, dy) candidate, the sensed patches
+    of many shifts are stacked and their 256x256 joint histograms are built together with one
+    np.bincount, smoothed with one Gaussian filter and reduced to MI values in one pass.
+    The bin edges, smoothing and reductions follow 'mutual_information_2d' exactly, so the
+    MI surface (and therefore the estimated shift) is identical to the brute-force search.
+    'pyramid' evaluates a coarse grid of shifts first and refines around the best ones, which
+    cuts the number of MI evaluations per patch by one to two orders of magnitude; its maximum
+    is checked by brute force in a neighbourhood, but a narrow MI peak elsewhere can be missed.
+    'MIKernel' is an opt-in MI over fixed bins (one height range for all shifts and patches),
+    computed from precomputed bin indices with few allocations per call.
+'''
+
+import numpy as np
+
+
+BINS = 256
+
+
+def sensed_patches(img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img, shifts):
+    '''
+    Sensed patches of every (dx, dy) in shifts, sliced exactly as in 'estimate_horizontal_shift'.
+
+    Returns
+    -------
+    2D array (len(shifts), patch pixels)
+    '''
+    patches = []
+    for shift in shifts:
+        tmp_img = img_sen[y1+shift[1]:y2+shift[1], x1+shift[0]:x2+shift[0]]
+        patches.append(tmp_img[seed_y-size_patch_img:seed_y+size_patch_img,
+                               seed_x-size_patch_img:seed_x+size_patch_img].ravel())
+        del tmp_img
+    return np.stack(patches)
+
+
+def _histogram_bins(values, valid):
+    '''
+    Bin index (0..BINS-1) of every value in the 256 equal bins between the min and max of the
+    valid values of its row, as np.histogram2d computes them.
+    '''
+    n_rows = values.shape[0]
+    has_valid = valid.any(axis=1)
+    first_edge = np.min(values, axis=1, where=valid, initial=np.inf).astype(values.dtype)
+    last_edge = np.max(values, axis=1, where=valid, initial=-np.inf).astype(values.dtype)
+    first_edge[~has_valid] = 0
+    last_edge[~has_valid] = 1
+    same = first_edge == last_edge
+    first_edge[same] = first_edge[same] - values.dtype.type(0.5)
+    last_edge[same] = last_edge[same] + values.dtype.type(0.5)
+
+    edges = np.linspace(first_edge, last_edge, BINS + 1, axis=1)
+
+    # estimate the bin arithmetically, then correct it against the exact edges
+    span = (last_edge - first_edge).astype(np.float64)
+    tmp_bin = np.floor((values - first_edge[:, None]) / span[:, None] * BINS)
+    tmp_bin = np.clip(np.nan_to_num(tmp_bin), 0, BINS - 1).astype(np.int64)
+    rows = np.broadcast_to(np.arange(n_rows)[:, None], values.shape)
+    while True:
+        lower = (values < edges[rows, tmp_bin]) & (tmp_bin > 0)
+        upper = (values >= edges[rows, tmp_bin + 1]) & (tmp_bin < BINS - 1)
+        if not (lower.any() or upper.any()):
+            break
+        tmp_bin = tmp_bin - lower + upper
+    return tmp_bin
+
+
+def batched_mutual_information(values_ref, values_sen, valid, sigma=1, normalized=False):
+    '''
+    'mutual_information_2d' of many pairs at once.
+
+    values_ref, values_sen: 2D arrays (pairs, pixels)
+    valid: 2D bool array (pairs, pixels), pixels used by each pair
+
+    Returns
+    -------
+    1D array of the MI of every pair
+    '''
+    from scipy import ndimage
+
+    EPS = np.finfo(float).eps
+
+    n_pairs = values_ref.shape[0]
+    # np.histogram2d bins the stacked (x, y) sample in their common dtype
+    dtype = np.result_type(values_ref, values_sen)
+    bin_ref = _histogram_bins(values_ref.astype(dtype, copy=False), valid)
+    bin_sen = _histogram_bins(values_sen.astype(dtype, copy=False), valid)
+
+    flat = (np.arange(n_pairs)[:, None] * BINS + bin_ref) * BINS + bin_sen
+    jh = np.bincount(flat[valid], minlength=n_pairs * BINS * BINS).astype(float)
+    jh = jh.reshape(n_pairs, BINS, BINS)
+    del flat, bin_ref, bin_sen
+
+    # smooth every jh with a gaussian filter of given sigma (not across pairs)
+    ndimage.gaussian_filter(jh, sigma=(0, sigma, sigma), mode='constant', output=jh)
+
+    # compute marginal histograms (in place; same operations as 'mutual_information_2d')
+    jh += EPS
+    sh = np.sum(jh.reshape(n_pairs, -1), axis=1)
+    jh /= sh[:, None, None]
+    s1 = np.sum(jh, axis=1)
+    s2 = np.sum(jh, axis=2)
+
+    tmp = np.log(jh)
+    tmp *= jh
+    h_joint = np.sum(tmp.reshape(n_pairs, -1), axis=1)
+    del tmp, jh
+    h1 = np.sum(s1 * np.log(s1), axis=1)
+    h2 = np.sum(s2 * np.log(s2), axis=1)
+    if normalized:
+        mi = ((h1 + h2) / h_joint) - 1
+    else:
+        mi = h_joint - h1 - h2
+    return mi
+
+
+class MIKernel:
+    '''
+    Mutual information over fixed bins, for many calls on patches of the same pair of images.
+    Unlike 'mutual_information_2d', whose 256 bins span the min/max of every call, the bins
+    split one height range (e.g. of both images) into equal bins, so MI values of different
+    shifts and patches are comparable. Values are digitized once per patch into integer bin
+    indices; every call then builds the joint histogram with one np.bincount and computes the
+    entropies from sum(c * log(c)) of the nonzero counts (a lookup table, no log of full
+    arrays). The joint histogram is not smoothed.
+
+    low, high: height range of the bins; values outside fall into the first or last bin
+    bins: bins per image
+    '''
+
+    def __init__(self, low, high, bins=64):
+        if not high > low:
+            high = low + 1.
+        self.low, self.high, self.bins = float(low), float(high), int(bins)
+        self._scale = self.bins / (self.high - self.low)
+        self._codes = np.empty(0, dtype=np.int64)
+        self._clogc = np.zeros(1)
+
+    @classmethod
+    def from_images(cls, img_ref, img_sen, nodata, bins=64):
+        '''Kernel whose bins span the valid heights of both images.'''
+        low, high = np.inf, -np.inf
+        for img in (img_ref, img_sen):
+            valid = img != nodata
+            if valid.any():
+                low = min(low, float(np.min(img, where=valid, initial=np.inf)))
+                high = max(high, float(np.max(img, where=valid, initial=-np.inf)))
+        if low > high:
+            low, high = 0., 1.
+        return cls(low, high, bins)
+
+    @property
+    def key(self):
+        '''Identifies the MI values of this kernel (e.g. in 'mi_cache.py').'''
+        return 'kernel%d_%r_%r' % (self.bins, self.low, self.high)
+
+    def digitize(self, values, nodata):
+        '''Bin index of every value, -1 for nodata.'''
+        index = np.floor((values - self.low) * self._scale)
+        np.clip(index, 0, self.bins - 1, out=index)
+        index = index.astype(np.int64)
+        index[values == nodata] = -1
+        return index
+
+    def _reserve(self, n):
+        if len(self._codes) < n:
+            self._codes = np.empty(n, dtype=np.int64)
+        if len(self._clogc) <= n:
+            counts = np.arange(1, n + 1, dtype=float)
+            self._clogc = np.concatenate([[0.], counts * np.log(counts)])
+
+    def _entropy(self, counts, n):
+        # H = log(n) - sum(c * log(c)) / n, over the nonzero counts (c * log(c) is 0 for c = 0)
+        return np.log(n) - np.sum(self._clogc[counts]) / n
+
+    def __call__(self, index_ref, index_sen, normalized=False):
+        '''MI of two patches of bin indices of the same shape (see digitize); -1 pixels are skipped.'''
+        n = index_ref.size
+        self._reserve(n)
+        codes = self._codes[:n].reshape(index_ref.shape)
+        np.multiply(index_ref, self.bins, out=codes)
+        codes += index_sen
+        codes = codes[(index_ref >= 0) & (index_sen >= 0)]
+        n_valid = len(codes)
+        if n_valid == 0:
+            return 0.
+
+        joint = np.bincount(codes)
+        h_joint = self._entropy(joint, n_valid)
+        h_ref = self._entropy(np.bincount(codes // self.bins), n_valid)
+        h_sen = self._entropy(np.bincount(codes % self.bins), n_valid)
+        if normalized:
+            return (h_ref + h_sen) / h_joint - 1 if h_joint > 0 else 0.
+        return h_ref + h_sen - h_joint
+
+    def shift_mis(self, patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                  shifts, nodata):
+        '''
+        MI between the reference patch and the sensed patch of every (dx, dy) in shifts.
+        The sensed window covering all shifts is digitized once and sliced per shift.
+        '''
+        index_ref = self.digitize(patch_img_ref, nodata)
+        # patches at the bottom/right of a grid are cut by the grid, the sensed ones alike
+        size_y, size_x = index_ref.shape
+        shifts = np.asarray(shifts, dtype=np.int64).reshape(-1, 2)
+        # top-left of every sensed patch, as sliced by 'sensed_patches'
+        rows = y1 + shifts[:, 1] + seed_y - size_patch_img
+        cols = x1 + shifts[:, 0] + seed_x - size_patch_img
+        row0, col0 = max(int(rows.min()), 0), max(int(cols.min()), 0)
+        index_sen = self.digitize(img_sen[row0:int(rows.max()) + size_y, col0:int(cols.max()) + size_x], nodata)
+
+        mis = np.zeros(len(shifts))
+        for n_s, (row, col) in enumerate(zip(rows - row0, cols - col0)):
+            mis[n_s] = self(index_ref, index_sen[row:row + size_y, col:col + size_x])
+        return mis
+
+
+def evaluate_shifts(patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                    shifts, nodata, batch_size=64, kernel=None):
+    '''
+    MI between the reference patch and the sensed patch of every (dx, dy) in shifts.
+    kernel: MIKernel evaluating the shifts one by one, or None for 'batched_mutual_information'
+    '''
+    if kernel is not None:
+        return kernel.shift_mis(patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                                shifts, nodata)
+    values_ref = patch_img_ref.ravel()
+    valid_ref = (values_ref != nodata)
+
+    mis = np.zeros(len(shifts))
+    for n_b in range(0, len(shifts), batch_size):
+        values_sen = sensed_patches(img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                                    shifts[n_b:n_b+batch_size])
+        valid = valid_ref[None, :] & (values_sen != nodata)
+        values_ref_batch = np.broadcast_to(values_ref, values_sen.shape)
+        mis[n_b:n_b+batch_size] = batched_mutual_information(values_ref_batch, values_sen, valid)
+        del values_sen, valid, values_ref_batch
+    return mis
+
+
+def patch_mi_surface(patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                     shifts_x, shifts_y, nodata, search='batched', levels=None, n_candidates=3,
+                     patch_mis=None, kernel=None, verify_radius=None):
+    '''
+    MI surface of one patch over the shift grid, shaped like 'patch_mis' in
+    'estimate_horizontal_shift' (len(shifts_y), len(shifts_x)).
+
+    search: 'batched' evaluates every shift (identical to the brute-force search);
+            'pyramid' evaluates every 2**(levels-1)-th shift first, then halves the step around
+            the n_candidates best shifts at every level. Shifts that were not evaluated are NaN.
+            The maximum is then checked by brute force: every shift within verify_radius of it
+            is evaluated, moving to a higher one until it is the maximum of its neighbourhood.
+            It returns the brute-force maximum whenever the MI peak is wider than the coarse
+            step, with far fewer MI evaluations (about 250 instead of 6,561 for 81x81 shifts);
+            a narrower peak farther than verify_radius from the maximum found can be missed.
+    levels: pyramid levels (default: coarse step of about 1/8 of the shift range)
+    verify_radius: ('pyramid') half size of the brute-force check (default: half the coarse step)
+    patch_mis: ('batched') surface known in part, e.g. from 'mi_cache.py'; only its NaN shifts
+               are evaluated
+    kernel: MIKernel computing the MI instead of 'batched_mutual_information' (see evaluate_shifts)
+    '''
+    if search == 'batched':
+        if patch_mis is None:
+            patch_mis = np.full((len(shifts_y), len(shifts_x)), np.nan)
+        else:
+            patch_mis = np.array(patch_mis, dtype=float)
+        todo = np.argwhere(np.isnan(patch_mis))
+        if len(todo):
+            shifts = [[int(shifts_x[n_dx]), int(shifts_y[n_dy])] for n_dy, n_dx in todo]
+            patch_mis[todo[:, 0], todo[:, 1]] = evaluate_shifts(patch_img_ref, img_sen, x1, x2, y1, y2,
+                                                                seed_x, seed_y, size_patch_img, shifts, nodata,
+                                                                kernel=kernel)
+        return patch_mis
+
+    if search != 'pyramid':
+        raise ValueError('Unknown MI search: %s' % search)
+
+    if levels is None:
+        levels = max(1, int(np.log2(max(len(shifts_x), len(shifts_y)) / 8)) + 1)
+    patch_mis = np.full((len(shifts_y), len(shifts_x)), np.nan)
+    step = 2 ** (levels - 1)
+    candidates = {(n_dy, n_dx) for n_dy in range(0, len(shifts_y), step) for n_dx in range(0, len(shifts_x), step)}
+    while True:
+        candidates = sorted(c for c in candidates if np.isnan(patch_mis[c]))
+        if candidates:
+            shifts = [[int(shifts_x[n_dx]), int(shifts_y[n_dy])] for n_dy, n_dx in candidates]
+            mis = evaluate_shifts(patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                                  shifts, nodata, kernel=kernel)
+            for (n_dy, n_dx), mi in zip(candidates, mis):
+                patch_mis[n_dy, n_dx] = mi
+        if step == 1:
+            break
+
+        evaluated = np.flatnonzero(~np.isnan(patch_mis.ravel()))
+        best = evaluated[np.argsort(patch_mis.ravel()[evaluated])[::-1][:n_candidates]]
+        step //= 2
+        candidates = set()
+        for best_dy, best_dx in zip(*np.unravel_index(best, patch_mis.shape)):
+            candidates.update((n_dy, n_dx)
+                              for n_dy in range(max(0, best_dy - 2*step), min(len(shifts_y), best_dy + 2*step + 1), step)
+                              for n_dx in range(max(0, best_dx - 2*step), min(len(shifts_x), best_dx + 2*step + 1), step))
+
+    # brute-force check of the maximum within verify_radius (hill climbing until it is the local maximum)
+    if verify_radius is None:
+        verify_radius = max(1, 2 ** (levels - 2))
+    while True:
+        best_dy, best_dx = np.unravel_index(np.nanargmax(patch_mis), patch_mis.shape)
+        window = (slice(max(0, best_dy - verify_radius), best_dy + verify_radius + 1),
+                  slice(max(0, best_dx - verify_radius), best_dx + verify_radius + 1))
+        todo = np.argwhere(np.isnan(patch_mis[window]))
+        if not len(todo):
+            break
+        todo += [window[0].start, window[1].start]
+        shifts = [[int(shifts_x[n_dx]), int(shifts_y[n_dy])] for n_dy, n_dx in todo]
+        patch_mis[todo[:, 0], todo[:, 1]] = evaluate_shifts(patch_img_ref, img_sen, x1, x2, y1, y2,
+                                                            seed_x, seed_y, size_patch_img, shifts, nodata,
+                                                            kernel=kernel)
+    return patch_mis
@@ -0,0 +1,150 @@
+'''
+    Overlap windows of two rasters, shared by 'estimate_horizontal_shift' and 'estimate_vertical_shift'.
+    The valid-data bounding box of each overlap window is found strip by strip with row/column
+    any() reductions, and only the final (intersected and buffered) windows are read into memory,
+    instead of reading both overlap windows in full and locating valid pixels with np.argwhere.
+'''
+
+import numpy as np
+
+
+def raster_bounds(ds):
+    '''(ulx, uly, brx, bry) of a GDAL dataset from its geotransform.'''
+    ulx, srx, _, uly, _, sry = ds.GetGeoTransform()
+    return ulx, uly, ulx + ds.RasterXSize * srx, uly + ds.RasterYSize * sry
+
+
+def overlap_bounds(ds_ref, ds_sen):
+    '''
+    Upper-left and bottom-right corners of the overlap area of two datasets.
+
+    Returns
+    -------
+    overlap_ul, overlap_br: [X, Y]
+    '''
+    ulx_ref, uly_ref, brx_ref, bry_ref = raster_bounds(ds_ref)
+    ulx_sen, uly_sen, brx_sen, bry_sen = raster_bounds(ds_sen)
+
+    tmp_x = np.sort(np.array([ulx_ref, brx_ref, ulx_sen, brx_sen]))
+    tmp_y = np.sort(np.array([uly_ref, bry_ref, uly_sen, bry_sen]))
+
+    overlap_ul = [tmp_x[1], tmp_y[2]]
+    overlap_br = [tmp_x[2], tmp_y[1]]
+    return overlap_ul, overlap_br
+
+
+def overlap_window(ds, overlap_ul, overlap_br):
+    '''Pixel window (x1, y1, x2, y2) of the overlap area within a dataset, clipped to the raster.'''
+    ulx, srx, _, uly, _, sry = ds.GetGeoTransform()
+
+    img_coor_x1 = int(round((overlap_ul[0] - ulx)/srx))
+    if img_coor_x1 < 0: img_coor_x1 = 0
+    img_coor_y1 = int(round((overlap_ul[1] - uly)/sry))
+    if img_coor_y1 < 0: img_coor_y1 = 0
+    img_coor_x2 = int(round((overlap_br[0] - ulx)/srx))
+    if img_coor_x2 > ds.RasterXSize: img_coor_x2 = ds.RasterXSize
+    img_coor_y2 = int(round((overlap_br[1] - uly)/sry))
+    if img_coor_y2 > ds.RasterYSize: img_coor_y2 = ds.RasterYSize
+    return img_coor_x1, img_coor_y1, img_coor_x2, img_coor_y2
+
+
+def strip_rows(band, y1, y2, rows=1024):
+    '''(row0, row1) strips covering rows y1..y2 whose boundaries follow the band's block rows.'''
+    block_rows = max(int(band.GetBlockSize()[1]), 1)
+    rows = max(rows // block_rows, 1) * block_rows
+    row0 = y1
+    while row0 < y2:
+        row1 = min((row0 // rows + 1) * rows, y2)
+        yield row0, row1
+        row0 = row1
+
+
+def valid_bbox(band, window, nodata, rows=1024):
+    '''
+    Bounding box of the pixels != nodata within a window, as the min/max of np.argwhere would
+    give it, read strip by strip so that only one strip is held in memory.
+
+    Returns
+    -------
+    (ymin, xmin, ymax, xmax) relative to the window (inclusive), or None without valid pixels
+    '''
+    x1, y1, x2, y2 = window
+    rows_valid = np.zeros(max(y2 - y1, 0), dtype=bool)
+    cols_valid = np.zeros(max(x2 - x1, 0), dtype=bool)
+    for row0, row1 in strip_rows(band, y1, y2, rows):
+        valid = band.ReadAsArray(x1, row0, x2 - x1, row1 - row0) != nodata
+        rows_valid[row0 - y1:row1 - y1] = valid.any(axis=1)
+        cols_valid |= valid.any(axis=0)
+        del valid
+
+    if not rows_valid.any():
+        return None
+    tmp_rows = np.flatnonzero(rows_valid)
+    tmp_cols = np.flatnonzero(cols_valid)
+    return tmp_rows[0], tmp_cols[0], tmp_rows[-1], tmp_cols[-1]
+
+
+def overlap_windows(ds_ref, ds_sen, nodata=-9999, buffer=0, band=1):
+    '''
+    Pixel windows of the overlapping, valid and buffered area of two datasets.
+    The window is the overlap area cropped to the intersection of the valid-data bounding boxes
+    and shrunk by buffer pixels on each side, exactly as the shift estimators originally cut it.
+
+    buffer: unit: pixel
+
+    Returns
+    -------
+    window_ref, window_sen: (x1, y1, x2, y2) in the pixels of each dataset (possibly empty)
+    '''
+    overlap_ul, overlap_br = overlap_bounds(ds_ref, ds_sen)
+    window_ref = overlap_window(ds_ref, overlap_ul, overlap_br)
+    window_sen = overlap_window(ds_sen, overlap_ul, overlap_br)
+
+    bbox_ref = valid_bbox(ds_ref.GetRasterBand(band), window_ref, nodata)
+    bbox_sen = valid_bbox(ds_sen.GetRasterBand(band), window_sen, nodata)
+    if bbox_ref is None or bbox_sen is None:
+        raise ValueError('The overlap area has no valid pixels')
+    ymin1, xmin1, ymax1, xmax1 = bbox_ref
+    ymin2, xmin2, ymax2, xmax2 = bbox_sen
+
+    tmp_y = np.sort(np.array([ymin1, ymin2, ymax1, ymax2]))
+    tmp_x = np.sort(np.array([xmin1, xmin2, xmax1, xmax2]))
+    row1, row2 = int(tmp_y[1]) + buffer, int(tmp_y[2]) - buffer
+    col1, col2 = int(tmp_x[1]) + buffer, int(tmp_x[2]) - buffer
+
+    windows = []
+    for x1, y1, x2, y2 in (window_ref, window_sen):
+        # the crop, clipped to the window as slicing the full window would
+        tmp_row1, tmp_row2 = _clip_slice(row1, row2, y2 - y1)
+        tmp_col1, tmp_col2 = _clip_slice(col1, col2, x2 - x1)
+        windows.append((x1 + tmp_col1, y1 + tmp_row1, x1 + tmp_col2, y1 + tmp_row2))
+    return windows[0], windows[1]
+
+
+def read_window(band, window):
+    '''Read a (possibly empty) window (x1, y1, x2, y2) of a band.'''
+    x1, y1, x2, y2 = window
+    if x2 > x1 and y2 > y1:
+        return band.ReadAsArray(x1, y1, x2 - x1, y2 - y1)
+    return np.zeros((y2 - y1, x2 - x1), dtype=band.ReadAsArray(0, 0, 1, 1).dtype)
+
+
+def read_overlap(ds_ref, ds_sen, nodata=-9999, buffer=0, band=1):
+    '''
+    Overlapping, valid and buffered images of two datasets (see overlap_windows).
+
+    buffer: unit: pixel
+
+    Returns
+    -------
+    img_ref, img_sen: 2D arrays
+    '''
+    window_ref, window_sen = overlap_windows(ds_ref, ds_sen, nodata, buffer, band)
+    return (read_window(ds_ref.GetRasterBand(band), window_ref),
+            read_window(ds_sen.GetRasterBand(band), window_sen))
+
+
+def _clip_slice(start, stop, size):
+    '''Bounds of array[start:stop] for an axis of the given size.'''
+    start, stop, _ = slice(start, stop).indices(size)
+    return start, max(stop, start)
@@ -0,0 +1,295 @@
+'''
+    Register a whole mosaic of adjacent UAS flights to one reference flight.
+    Overlapping flights are found from the CHM geotransforms, the horizontal and vertical shifts
+    of every overlapping pair are estimated in parallel processes, and the shifts are chained
+    outward from the reference along the largest overlaps. A PDAL pipeline (from the
+    'point_cloud_shift.json' template) is then written for every flight.
+
+    Manifest (.json):
+    {
+        "reference": "F01",
+        "flights": [
+            {"name": "F01", "chm": "F01_chm.tif", "dtm": "F01_dtm.tif", "laz": "F01.laz", "index": 1},
+            {"name": "F02", "chm": "F02_chm.tif", "dtm": "F02_dtm.tif", "laz": "F02.laz", "index": 2},
+            ...
+        ],
+        "horizontal": {"size_grid": "50", "num_patch": "2", "shift_x": [0, 5], "shift_y": [0, 5]},
+        "vertical": {"buffer": 100}
+    }
+    "index" is the OriginalCloudIndex of the flight (default: its position in "flights", from 1).
+    "horizontal" and "vertical" are optional arguments of 'estimate_horizontal_shift' and
+    'estimate_vertical_shift'.
+
+    Example:
+        python register_flights.py manifest.json --out-dir registered --workers 8
+'''
+
+import os
+import json
+import argparse
+
+
+def overlap_area(bounds1, bounds2):
+    '''Area of the intersection of two raster bounds (0 if they do not overlap).'''
+    width = min(bounds1[2], bounds2[2]) - max(bounds1[0], bounds2[0])
+    height = min(bounds1[1], bounds2[1]) - max(bounds1[3], bounds2[3])
+    return max(width, 0) * max(height, 0)
+
+
+def find_overlapping_pairs(flights, min_overlap=10000):
+    '''
+    Overlapping flight pairs from the CHM geotransforms.
+
+    min_overlap: minimum overlap area (unit: square meter)
+
+    Returns
+    -------
+    dict: (name1, name2) -> overlap area
+    '''
+    from osgeo import gdal
+    from raster_overlap import raster_bounds
+
+    bounds = {flight['name']: raster_bounds(gdal.Open(flight['chm'])) for flight in flights}
+    names = [flight['name'] for flight in flights]
+    pairs = {}
+    for n_1 in range(len(names)):
+        for n_2 in range(n_1+1, len(names)):
+            area = overlap_area(bounds[names[n_1]], bounds[names[n_2]])
+            if area >= min_overlap:
+                pairs[(names[n_1], names[n_2])] = area
+    return pairs
+
+
+def registration_tree(names, pairs, reference):
+    '''
+    Pairs to register: a spanning tree grown from the reference flight that always adds the
+    unregistered flight with the largest overlap to an already registered one.
+
+    Returns
+    -------
+    list of (parent, child) in registration order; flights that cannot be reached are left out
+    '''
+    registered = {reference}
+    edges = []
+    while True:
+        candidates = [(area, pair) for pair, area in pairs.items()
+                      if (pair[0] in registered) != (pair[1] in registered)]
+        if not candidates:
+            break
+        _, pair = max(candidates)
+        parent, child = pair if pair[0] in registered else pair[::-1]
+        registered.add(child)
+        edges.append((parent, child))
+
+    for name in names:
+        if name not in registered:
+            print('Warning:    %s does not overlap any registered flight and is skipped' % name)
+    return edges
+
+
+def register_pair(parent, child, work_dir, horizontal=None, vertical=None, return_diagnostics=False):
+    '''
+    Shift of the child flight relative to the parent flight, following the README workflow
+    (horizontal shift of the CHMs, then vertical shift of the DTMs after the horizontal shift).
+
+    parent, child: manifest entries
+    Returns
+    -------
+    dict with 'shift_x', 'shift_y' (as returned by 'estimate_horizontal_shift') and
+    'shift_z' (to subtract from Z, i.e. the negative of 'estimate_vertical_shift'), with the
+    robust spread and number of pixels of the DTM differences ('spread_z', 'pixels_z')
+    (and, with return_diagnostics, the diagnostics of both estimators; see 'render_diagnostics.py')
+    '''
+    from estimate_horizontal_shift import estimate_horizontal_shift
+    from estimate_vertical_shift import estimate_vertical_shift
+    from transform_image_horizontal import transform_image
+
+    print('Pair %s (reference) - %s (sensed)' % (parent['name'], child['name']))
+    options = dict(display=False)
+    options.update(horizontal or {})
+    shifts_h, lut, *diagnostics = estimate_horizontal_shift(parent['chm'], child['chm'],
+                                                           return_diagnostics=return_diagnostics, **options)
+
+    fn_dtm = os.path.join(work_dir, '%s_to_%s_dtm.tif' % (child['name'], parent['name']))
+    transform_image(child['dtm'], fn_dtm, shifts_h, mode='copy')
+    options = dict(display=False)
+    options.update(vertical or {})
+    shift_v, stats_v, *diagnostics_v = estimate_vertical_shift(parent['dtm'], fn_dtm, return_stats=True,
+                                                              return_diagnostics=return_diagnostics, **options)
+
+    result = {'shift_x': float(shifts_h[0]), 'shift_y': float(shifts_h[1]),
+              'shift_z': -float(shift_v[0]), 'patches': len(lut),
+              'spread_z': stats_v['spread'], 'pixels_z': stats_v['count']}
+    if return_diagnostics:
+        return result, diagnostics + diagnostics_v
+    return result
+
+
+def chain_shifts(edges, pair_shifts, reference):
+    '''
+    Shift of every flight relative to the reference flight.
+    A child aligned to its parent by subtracting the pair shift is aligned to the reference by
+    also subtracting the parent's shift, so shifts add up along the tree.
+    '''
+    shifts = {reference: {'shift_x': 0., 'shift_y': 0., 'shift_z': 0., 'parent': None}}
+    for parent, child in edges:
+        tmp = pair_shifts[(parent, child)]
+        shifts[child] = {key: shifts[parent][key] + tmp[key] for key in ('shift_x', 'shift_y', 'shift_z')}
+        shifts[child]['parent'] = parent
+    return shifts
+
+
+def _assignment(dimension, shift):
+    '''PDAL expression subtracting shift from a dimension.'''
+    if shift < 0:
+        return '%s = %s+%.4f' % (dimension, dimension, -shift)
+    return '%s = %s-%.4f' % (dimension, dimension, shift)
+
+
+def point_cloud_pipeline(template, fn_in, fn_out, shift, index):
+    '''PDAL pipeline of one flight, filled in from the 'point_cloud_shift.json' template.'''
+    import copy
+
+    pipeline = copy.deepcopy(template)
+    for stage in pipeline['pipeline']:
+        if stage['type'] == 'readers.las':
+            stage['filename'] = fn_in
+        elif stage['type'] == 'writers.las':
+            stage['filename'] = fn_out
+        elif stage['type'] == 'filters.assign' and 'value' in stage:
+            stage['value'] = [_assignment('X', shift['shift_x']),
+                              _assignment('Y', shift['shift_y']),
+                              _assignment('Z', shift['shift_z'])]
+        elif stage['type'] == 'filters.assign' and 'assignment' in stage:
+            stage['assignment'] = 'OriginalCloudIndex[:]=%d' % index
+    return pipeline
+
+
+def register_flights(fn_manifest, out_dir, workers=1, min_overlap=10000, fn_template=None,
+                     transform_rasters=False, shift_point_clouds=False, plots=False):
+    '''
+    Register every flight of the manifest to the reference flight.
+
+    out_dir: output directory of 'shifts.json', the PDAL pipelines ('<name>_shift.json')
+             and, with transform_rasters, the aligned CHMs and DTMs
+    shift_point_clouds: also write the shifted point clouds ('<name>_shifted.laz') with
+                        'shift_point_cloud.py' instead of the PDAL pipelines
+    workers: number of flight pairs estimated in parallel
+    min_overlap: minimum overlap of a flight pair (unit: square meter)
+    fn_template: PDAL pipeline template (default: 'point_cloud_shift.json' next to this file)
+    plots: write diagnostics figures of every pair to '<out_dir>/plots' in a background thread
+           ('render_diagnostics.py') while the other pairs are estimated
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from contextlib import nullcontext
+
+    with open(fn_manifest) as f:
+        manifest = json.load(f)
+    flights = manifest['flights']
+    reference = manifest['reference']
+    for n_f, flight in enumerate(flights):
+        flight.setdefault('index', n_f + 1)
+    by_name = {flight['name']: flight for flight in flights}
+    if reference not in by_name:
+        raise ValueError('Reference flight %s is not in the manifest' % reference)
+
+    work_dir = os.path.join(out_dir, 'pairs')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # region - Overlapping pairs
+    pairs = find_overlapping_pairs(flights, min_overlap)
+    edges = registration_tree([flight['name'] for flight in flights], pairs, reference)
+    print('%d flights, %d overlapping pairs, %d pairs to register' % (len(flights), len(pairs), len(edges)))
+    # endregion
+
+    # region - Pair estimation
+    pair_shifts = {}
+    if plots:
+        from render_diagnostics import DiagnosticsRenderer
+    with DiagnosticsRenderer(os.path.join(out_dir, 'plots')) if plots else nullcontext() as renderer:
+        def collect(edge, result):
+            if plots:
+                result, diagnostics = result
+                for tmp in diagnostics:
+                    renderer.submit('%s_to_%s' % (edge[1], edge[0]), tmp)
+            pair_shifts[edge] = result
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {edge: executor.submit(register_pair, by_name[edge[0]], by_name[edge[1]], work_dir,
+                                                 manifest.get('horizontal'), manifest.get('vertical'), plots)
+                           for edge in edges}
+                for edge in edges:
+                    # drop each future once collected, so the diagnostics are only held by the renderer
+                    collect(edge, futures.pop(edge).result())
+        else:
+            for edge in edges:
+                collect(edge, register_pair(by_name[edge[0]], by_name[edge[1]], work_dir,
+                                            manifest.get('horizontal'), manifest.get('vertical'), plots))
+    # endregion
+
+    # region - Chained shifts and PDAL pipelines
+    shifts = chain_shifts(edges, pair_shifts, reference)
+
+    if fn_template is None:
+        fn_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'point_cloud_shift.json')
+    with open(fn_template) as f:
+        template = json.load(f)
+
+    for name, shift in shifts.items():
+        flight = by_name[name]
+        fn_laz = os.path.join(out_dir, '%s_shifted.laz' % name)
+        pipeline = point_cloud_pipeline(template, flight['laz'], fn_laz, shift, flight['index'])
+        shift['pipeline'] = os.path.join(out_dir, '%s_shift.json' % name)
+        with open(shift['pipeline'], 'w') as f:
+            json.dump(pipeline, f, indent=4)
+        print('%s: [%.2f, %.2f, %.2f] (via %s)' % (name, shift['shift_x'], shift['shift_y'],
+                                                    shift['shift_z'], shift['parent']))
+
+    with open(os.path.join(out_dir, 'shifts.json'), 'w') as f:
+        json.dump({'reference': reference,
+                   'pairs': [{'reference': parent, 'sensed': child, **pair_shifts[(parent, child)]}
+                             for parent, child in edges],
+                   'flights': shifts}, f, indent=4)
+    # endregion
+
+    if transform_rasters:
+        from transform_image_horizontal import transform_image
+        from transform_image_vertical import transform_image_vertical
+
+        for name, shift in shifts.items():
+            flight = by_name[name]
+            transform_image(flight['chm'], os.path.join(out_dir, '%s_chm.tif' % name),
+                            (shift['shift_x'], shift['shift_y']), mode='copy')
+            fn_dtm = os.path.join(work_dir, '%s_dtm_h.tif' % name)
+            transform_image(flight['dtm'], fn_dtm, (shift['shift_x'], shift['shift_y']), mode='copy')
+            transform_image_vertical(fn_dtm, os.path.join(out_dir, '%s_dtm.tif' % name), [shift['shift_z']])
+
+    if shift_point_clouds:
+        from shift_point_cloud import shift_point_clouds as apply_shifts
+
+        apply_shifts([(by_name[name]['laz'], os.path.join(out_dir, '%s_shifted.laz' % name),
+                       (shift['shift_x'], shift['shift_y'], shift['shift_z']), by_name[name]['index'])
+                      for name, shift in shifts.items()], workers=workers)
+
+    return shifts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register adjacent UAS flights to a reference flight.')
+    parser.add_argument('manifest', help='manifest of the flights (.json)')
+    parser.add_argument('--out-dir', default='registered', help='output directory')
+    parser.add_argument('--workers', type=int, default=1, help='number of flight pairs estimated in parallel')
+    parser.add_argument('--min-overlap', type=float, default=10000, help='minimum overlap of a pair (unit: square meter)')
+    parser.add_argument('--template', default=None, help='PDAL pipeline template (default: point_cloud_shift.json)')
+    parser.add_argument('--transform-rasters', action='store_true',
+                        help='also write the aligned CHMs and DTMs to the output directory')
+    parser.add_argument('--shift-point-clouds', action='store_true',
+                        help='also write the shifted point clouds with laspy (no PDAL run needed)')
+    parser.add_argument('--plots', action='store_true',
+                        help='write diagnostics figures (MI surface, shift arrows, DTM differences) to <out-dir>/plots')
+    args = parser.parse_args()
+
+    register_flights(args.manifest, args.out_dir, workers=args.workers, min_overlap=args.min_overlap,
+                     fn_template=args.template, transform_rasters=args.transform_rasters,
+                     shift_point_clouds=args.shift_point_clouds, plots=args.plots)
@@ -0,0 +1,130 @@
+'''
+    PNG figures of the diagnostics returned by 'estimate_horizontal_shift' and
+    'estimate_vertical_shift' with display=False, return_diagnostics=True.
+    The estimators then never import matplotlib; the figures are drawn afterwards, here, with
+    matplotlib's object-oriented API on an Agg canvas (no pyplot state, no display), so
+    DiagnosticsRenderer can write them in background threads while a batch run goes on.
+
+    with DiagnosticsRenderer('plots') as renderer:
+        shifts_h, lut, diagnostics = estimate_horizontal_shift(fn_ref, fn_sen, display=False, return_diagnostics=True)
+        renderer.submit('F02_to_F01', diagnostics)
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def _figure(size):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=size)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def render_horizontal(diagnostics, fn_png, scale=10, clim=(0, 55), dpi=100):
+    '''
+    MI surface of the best patch and the estimated shift of every patch (arrows, scaled by
+    'scale') over the reference overlap image, as drawn by 'estimate_horizontal_shift'.
+    The overlap image may be downsampled; it is drawn over the pixels of the full one ('img_ref_shape').
+    '''
+    fig = _figure((12, 5))
+    ax = fig.add_subplot(1, 2, 1)
+    tmp_img = ax.imshow(diagnostics['mi_surface'])
+    fig.colorbar(tmp_img, ax=ax)
+    ax.set_title('MI surface at patch [%d, %d]' % tuple(diagnostics['mi_location']))
+    ax.axis('off')
+
+    ax = fig.add_subplot(1, 2, 2)
+    size_y, size_x = diagnostics.get('img_ref_shape', diagnostics['img_ref'].shape)
+    ax.imshow(diagnostics['img_ref'], clim=clim, extent=(-0.5, size_x-0.5, size_y-0.5, -0.5))
+    for tmp in diagnostics['lut']:
+        ax.arrow(tmp[0], size_y-tmp[1], tmp[2]*scale, -tmp[3]*scale, ec='red')
+    ax.set_title('Shift [%.2f, %.2f]' % tuple(diagnostics['shift']))
+    ax.axis('off')
+    fig.savefig(fn_png, dpi=dpi)
+    return fn_png
+
+
+def render_vertical(diagnostics, fn_png, dpi=100):
+    '''Histogram of the DTM differences and the estimated vertical shift.'''
+    fig = _figure((6, 4))
+    ax = fig.add_subplot(1, 1, 1)
+    bin_edges = diagnostics['bin_edges']
+    ax.bar(bin_edges[:-1], diagnostics['hist'], width=np.diff(bin_edges), align='edge')
+    shift_z = float(np.ravel(diagnostics['shift_z'])[0])
+    ax.axvline(shift_z, color='red')
+    ax.set_xlim(shift_z - 5, shift_z + 5)
+    ax.set_xlabel('Reference - sensed (m)')
+    ax.set_title('Vertical shift %.2f (%d pixels)' % (shift_z, diagnostics['count']))
+    fig.savefig(fn_png, dpi=dpi)
+    return fn_png
+
+
+RENDERERS = {'horizontal': render_horizontal, 'vertical': render_vertical}
+
+
+def render(diagnostics, fn_png, **options):
+    '''Figure of any diagnostics dict (by its 'kind').'''
+    return RENDERERS[diagnostics['kind']](diagnostics, fn_png, **options)
+
+
+class DiagnosticsRenderer:
+    '''
+    Writes '<out_dir>/<name>_<kind>.png' of submitted diagnostics in background threads.
+    Only the outcome of a figure (its file or error) is kept once it is written, not its diagnostics.
+
+    workers: number of rendering threads
+    '''
+
+    def __init__(self, out_dir, workers=1):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._fns = []
+        self._errors = []  # (file, exception) of the figures that failed
+
+    def _collect(self, fn_png, future):
+        try:
+            self._fns.append(future.result())
+        except Exception as e:
+            self._errors.append((fn_png, e))
+
+    def submit(self, name, diagnostics, **options):
+        '''Queue a figure; returns a future of its file name.'''
+        fn_png = os.path.join(self.out_dir, '%s_%s.png' % (name, diagnostics['kind']))
+        future = self._executor.submit(render, diagnostics, fn_png, **options)
+        future.add_done_callback(lambda future: self._collect(fn_png, future))
+        return future
+
+    def close(self):
+        '''
+        Wait for the queued figures.
+
+        Returns
+        -------
+        files written; raises a RuntimeError (from the first error) if a figure failed
+        '''
+        self._executor.shutdown(wait=True)
+        fns, errors = self._fns, self._errors
+        self._fns, self._errors = [], []
+        if errors:
+            raise RuntimeError('%d diagnostics figure(s) failed, first %s: %s' %
+                               (len(errors), errors[0][0], errors[0][1])) from errors[0][1]
+        return fns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            # keep the error of the block; the figures queued so far are still written
+            self._executor.shutdown(wait=True)
+            return False
+        fns = self.close()
+        if fns:
+            print('Check: ', self.out_dir, '(%d figures)' % len(fns))
+        return False
@@ -0,0 +1,135 @@
+'''
+    Apply estimated shifts to point clouds (.las/.laz) with laspy, as an alternative to running
+    the 'point_cloud_shift.json' PDAL pipeline.
+    The shifts follow the pipeline: X = X - shift_x, Y = Y - shift_y, Z = Z - shift_z.
+
+    The shift is applied through the header offsets: the stored integer coordinates are kept
+    and only the offsets (and bounds) change, which is exact up to the float64 offsets.
+    - Without an OriginalCloudIndex, the file is copied and its header patched in place;
+      no point is decoded or re-encoded.
+    - With an OriginalCloudIndex, the points are streamed in chunks and written with the
+      extra dimension (int8), as 'filters.ferry' and 'filters.assign' do in the pipeline.
+    - With keep_offsets, the original offsets are kept and the integer coordinates are moved
+      instead, by whole scale steps when the shift is a multiple of the scale and by
+      rescaling (rounding to the scale) otherwise.
+'''
+
+import struct
+
+import numpy as np
+
+
+# byte positions of the scales, offsets and bounds in the LAS public header block (all versions)
+HEADER_SCALES = 131
+HEADER_OFFSETS = 155
+HEADER_BOUNDS = 179  # max X, min X, max Y, min Y, max Z, min Z
+
+
+def patch_header_offsets(fn, shifts):
+    '''Subtract shifts from the offsets and bounds of a LAS/LAZ header, in place.'''
+    with open(fn, 'r+b') as f:
+        f.seek(HEADER_OFFSETS)
+        offsets = np.array(struct.unpack('<3d', f.read(24)))
+        bounds = np.array(struct.unpack('<6d', f.read(48)))
+        f.seek(HEADER_OFFSETS)
+        f.write(struct.pack('<3d', *(offsets - shifts)))
+        f.write(struct.pack('<6d', *(bounds - np.repeat(shifts, 2))))
+
+
+def shift_integers(values, scale, shift):
+    '''Integer coordinates moved by -shift at the given scale (offsets unchanged).'''
+    steps = shift / scale
+    if abs(steps - round(steps)) < 1e-6:
+        shifted = values.astype(np.int64) - int(round(steps))
+    else:
+        shifted = np.round((values * scale - shift) / scale).astype(np.int64)
+    if shifted.size and (shifted.min() < np.iinfo(np.int32).min or shifted.max() > np.iinfo(np.int32).max):
+        raise OverflowError('Shifted coordinates do not fit the header offsets; use keep_offsets=False')
+    return shifted.astype(np.int32)
+
+
+def shift_point_cloud(fn_in, fn_out, shifts, index=None, keep_offsets=False, chunk_size=5_000_000):
+    '''
+    Shift a point cloud.
+
+    shifts: (shift_x, shift_y, shift_z), subtracted from X, Y and Z (unit: meter)
+    index: OriginalCloudIndex of every point (int8); None keeps the point format unchanged
+    keep_offsets: keep the header offsets and move the integer coordinates instead
+    chunk_size: points per chunk when the points are rewritten
+    '''
+    import copy
+    import shutil
+    import laspy as lp
+
+    shifts = np.asarray(shifts, dtype=np.float64)
+
+    with lp.open(fn_in) as reader:
+        header = copy.deepcopy(reader.header)
+    is_copc = any(vlr.user_id == 'copc' for vlr in header.vlrs)
+
+    # region - Header-only shift (COPC files also index the coordinates, so they are rewritten)
+    if index is None and not keep_offsets and not is_copc:
+        shutil.copyfile(fn_in, fn_out)
+        patch_header_offsets(fn_out, shifts)
+        print('Check: ', fn_out)
+        return
+    # endregion
+
+    out_header = copy.deepcopy(header)
+    if not keep_offsets:
+        out_header.offsets = header.offsets - shifts
+    if index is not None and 'OriginalCloudIndex' not in header.point_format.extra_dimension_names:
+        out_header.add_extra_dims([lp.ExtraBytesParams(name='OriginalCloudIndex', type=np.int8)])
+
+    with lp.open(fn_in) as reader, lp.open(fn_out, mode='w', header=out_header,
+                                           do_compress=fn_out.lower().endswith('.laz')) as writer:
+        for points in reader.chunk_iterator(chunk_size):
+            tmp_points = lp.ScaleAwarePointRecord.zeros(len(points), header=out_header)
+            for name in points.point_format.dimension_names:
+                tmp_points[name] = points[name]
+            if keep_offsets:
+                for n_d, name in enumerate(('X', 'Y', 'Z')):
+                    tmp_points[name] = shift_integers(points[name], header.scales[n_d], shifts[n_d])
+            if index is not None:
+                tmp_points['OriginalCloudIndex'] = np.full(len(tmp_points), index, dtype=np.int8)
+            writer.write_points(tmp_points)
+            del points, tmp_points
+    print('Check: ', fn_out)
+
+
+def _shift_point_cloud(args):
+    return shift_point_cloud(*args)
+
+
+def shift_point_clouds(jobs, workers=1, chunk_size=5_000_000):
+    '''
+    Shift several point clouds, workers flights at a time.
+
+    jobs: list of (fn_in, fn_out, shifts, index)
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    tasks = [(fn_in, fn_out, shifts, index, False, chunk_size) for fn_in, fn_out, shifts, index in jobs]
+    if workers > 1:
+        # spawn: forking a process whose LAZ decoder threads are running can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            list(executor.map(_shift_point_cloud, tasks))
+    else:
+        for task in tasks:
+            _shift_point_cloud(task)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Shift a point cloud: X = X - dx, Y = Y - dy, Z = Z - dz.')
+    parser.add_argument('las', help='input point cloud (.las/.laz)')
+    parser.add_argument('out', help='output point cloud (.las/.laz)')
+    parser.add_argument('--shift', type=float, nargs=3, required=True, metavar=('DX', 'DY', 'DZ'))
+    parser.add_argument('--index', type=int, default=None, help='OriginalCloudIndex of the points')
+    parser.add_argument('--keep-offsets', action='store_true',
+                        help='keep the header offsets and move the integer coordinates instead')
+    args = parser.parse_args()
+
+    shift_point_cloud(args.las, args.out, args.shift, index=args.index, keep_offsets=args.keep_offsets)
@@ -3,40 +3,83 @@
     Created by Minyoung Jung (jung411@purdue.edu) 
 '''    
 
-def transform_image(fn_in, fn_out, shifts):
+import os, sys
+# stage_profiler.py (stage_of) is in ../Instrumentation, next to this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Instrumentation'))
+
+
+def transform_image(fn_in, fn_out, shifts, mode='full', profiler=None):
+    '''
+    mode: 'full' reads and rewrites every band as Float32 GTiff (original behavior, default)
+          'copy' copies the file(s) as they are and only updates the geotransform
+                 (no pixel decoding; data type, compression, tiling and overviews are kept)
+          'vrt'  writes a VRT (fn_out, e.g. '.vrt') that points at fn_in with the shifted geotransform
+    profiler: StageProfiler (Instrumentation/stage_profiler.py) recording the open, read and
+              write stages, or None
+    '''
     from osgeo import gdal
+    from stage_profiler import stage_of
+
+    stage = stage_of(profiler)
 
     shift_x, shift_y = shifts
 
+    with stage('open'):
+        input_raster = gdal.Open(fn_in)
+        tmp = input_raster.GetGeoTransform()
+    out_transform = (tmp[0]-shift_x, tmp[1], tmp[2], tmp[3]-shift_y, tmp[4], tmp[5]); del tmp
+
+    if mode == 'copy':
+        with stage('write'):
+            driver = input_raster.GetDriver()
+            input_raster = None
+            if driver.CopyFiles(fn_out, fn_in) != 0:
+                raise RuntimeError('Cannot copy %s to %s' % (fn_in, fn_out))
+            tar_ds = gdal.Open(fn_out, gdal.GA_Update)
+            tar_ds.SetGeoTransform(out_transform)
+            tar_ds = None
+        print('Check: ', fn_out)
+        return
+
+    if mode == 'vrt':
+        with stage('write'):
+            tar_ds = gdal.Translate(fn_out, input_raster, format='VRT')
+            tar_ds.SetGeoTransform(out_transform)
+            tar_ds = None
+        print('Check: ', fn_out)
+        return
+
+    if mode != 'full':
+        raise ValueError('Unknown transform mode: %s' % mode)
+
     out_format = 'GTiff'
     driver = gdal.GetDriverByName(out_format)
 
-    input_raster = gdal.Open(fn_in)
-
-    tmp_img = input_raster.ReadAsArray()
+    with stage('read', input_raster.RasterXSize * input_raster.RasterYSize * input_raster.RasterCount):
+        tmp_img = input_raster.ReadAsArray()
 
-    if len(tmp_img.shape) > 2: 
-        tar_ds = driver.Create(fn_out, tmp_img.shape[2], tmp_img.shape[1], tmp_img.shape[0], gdal.GDT_Float32)
-    else:
-        tar_ds = driver.Create(fn_out, tmp_img.shape[1], tmp_img.shape[0], 1, gdal.GDT_Float32)
-    
-    tmp = input_raster.GetGeoTransform()
-    out_transform = (tmp[0]-shift_x, tmp[1], tmp[2], tmp[3]-shift_y, tmp[4], tmp[5]); del tmp
-    
-    tar_ds.SetGeoTransform(out_transform)
-    tar_ds.SetProjection(input_raster.GetProjection())
-    
-    if len(tmp_img.shape) > 2:
-        for n_band in range(len(tmp_img.shape)-1):
-            tar_ds.GetRasterBand(n_band+1).WriteArray(tmp_img[n_band, :, :])
-            tar_ds.GetRasterBand(n_band+1).SetNoDataValue(input_raster.GetRasterBand(n_band+1).GetNoDataValue())
-    else:
-        tar_ds.GetRasterBand(1).WriteArray(tmp_img)
-        tar_ds.GetRasterBand(1).SetNoDataValue(input_raster.GetRasterBand(1).GetNoDataValue())
-    tar_ds = None
+    with stage('write', tmp_img.size):
+        if len(tmp_img.shape) > 2: 
+            tar_ds = driver.Create(fn_out, tmp_img.shape[2], tmp_img.shape[1], tmp_img.shape[0], gdal.GDT_Float32)
+        else:
+            tar_ds = driver.Create(fn_out, tmp_img.shape[1], tmp_img.shape[0], 1, gdal.GDT_Float32)
+        
+        tar_ds.SetGeoTransform(out_transform)
+        tar_ds.SetProjection(input_raster.GetProjection())
+        
+        if len(tmp_img.shape) > 2:
+            for n_band in range(len(tmp_img.shape)-1):
+                tar_ds.GetRasterBand(n_band+1).WriteArray(tmp_img[n_band, :, :])
+                tar_ds.GetRasterBand(n_band+1).SetNoDataValue(input_raster.GetRasterBand(n_band+1).GetNoDataValue())
+        else:
+            tar_ds.GetRasterBand(1).WriteArray(tmp_img)
+            tar_ds.GetRasterBand(1).SetNoDataValue(input_raster.GetRasterBand(1).GetNoDataValue())
+        tar_ds = None
     print('Check: ', fn_out)
     
 
 
 # # # # Example code to run # # # #
 # transform_image(filepath_sensed_raster, filepath_shifted_raster, shifts_h)
+# transform_image(filepath_sensed_raster, filepath_shifted_raster_copy, shifts_h, mode='copy')
+# transform_image(filepath_sensed_raster, filepath_shifted_raster_vrt, shifts_h, mode='vrt')
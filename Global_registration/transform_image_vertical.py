@@ -1,45 +1,165 @@
 '''
     Transform a digital elevation model using a shift estimated by 'estimate_vertical_shift.py'.
     Created by Minyoung Jung (jung411@purdue.edu)
-'''  
+'''
+
+import os, sys
+# stage_profiler.py (stage_of) is in ../Instrumentation, next to this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Instrumentation'))
+
 
+def transform_image_vertical(fn_in, fn_out, shift_vertical, workers=1, profiler=None):
+    '''
+    The input is processed block by block (its native blocks; strips are grouped into windows
+    of a few million pixels), so peak memory is a few blocks whatever the DTM size.
+    The output keeps the input's layout and compression (see creation_options), band count,
+    nodata values and overview levels. Float inputs keep their data type; integer inputs
+    are written as Float32.
 
-def transform_image_vertical(fn_in, fn_out, shift_vertical):
+    workers: number of threads reading and shifting blocks (the blocks are written in order
+             by the calling thread, window by window with every band of a window in turn)
+    profiler: StageProfiler (Instrumentation/stage_profiler.py) recording the stages, or None.
+              The blocks are read, shifted and written in one 'blocks' stage; its record also
+              holds the seconds spent in each step ('read_s', 'shift_s', 'write_s', summed
+              over the threads)
+    '''
     from osgeo import gdal
     import numpy as np
+    import time
+    import threading
+    from stage_profiler import stage_of
+    from concurrent.futures import ThreadPoolExecutor
 
-    shift_z = float(shift_vertical[0])
+    stage = stage_of(profiler)
 
-    out_format = 'GTiff'
-    driver = gdal.GetDriverByName(out_format)
+    shift_z = float(np.ravel(shift_vertical)[0])
+
+    with stage('open'):
+        input_raster = gdal.Open(fn_in)
+        n_bands = input_raster.RasterCount
+        data_type = input_raster.GetRasterBand(1).DataType
+        if data_type not in (gdal.GDT_Float32, gdal.GDT_Float64):
+            data_type = gdal.GDT_Float32
+        out_dtype = np.float64 if data_type == gdal.GDT_Float64 else np.float32
+
+        out_format = 'GTiff'
+        driver = gdal.GetDriverByName(out_format)
+        tar_ds = driver.Create(fn_out, input_raster.RasterXSize, input_raster.RasterYSize, n_bands, data_type,
+                               options=creation_options(input_raster, data_type))
+        tar_ds.SetGeoTransform(input_raster.GetGeoTransform())
+        tar_ds.SetProjection(input_raster.GetProjection())
+
+        no_data = []
+        for n_band in range(n_bands):
+            tmp_band = input_raster.GetRasterBand(n_band+1)
+            no_data.append(tmp_band.GetNoDataValue())
+            if no_data[-1] is not None:
+                tar_ds.GetRasterBand(n_band+1).SetNoDataValue(no_data[-1])
+            if tmp_band.GetDescription():
+                tar_ds.GetRasterBand(n_band+1).SetDescription(tmp_band.GetDescription())
+
+    # GDAL datasets must not be shared between threads: every thread reads through its own handle
+    local = threading.local()
+
+    def shift_block(task):
+        n_band, (x_off, y_off, x_size, y_size) = task
+        if not hasattr(local, 'ds'):
+            local.ds = gdal.Open(fn_in)
+        tic = time.perf_counter()
+        tmp_img = local.ds.GetRasterBand(n_band+1).ReadAsArray(x_off, y_off, x_size, y_size)
+        toc = time.perf_counter()
+        final_img = (tmp_img-shift_z).astype(out_dtype, copy=False)
+        if no_data[n_band] is not None:
+            final_img[tmp_img==no_data[n_band]] = no_data[n_band]
+        return final_img, toc - tic, time.perf_counter() - toc
+
+    windows = block_windows(input_raster.GetRasterBand(1))
+    # every band of a window is written before the next window, so a pixel-interleaved block
+    # is complete when GDAL flushes it and is compressed once
+    tasks = [(n_band, window) for window in windows for n_band in range(n_bands)]
+
+    with stage('blocks', input_raster.RasterXSize * input_raster.RasterYSize * n_bands) as record:
+        seconds = {'read_s': 0., 'shift_s': 0., 'write_s': 0.}
+
+        def write(task, result):
+            n_band, (x_off, y_off, _, _) = task
+            final_img, seconds_read, seconds_shift = result
+            tic = time.perf_counter()
+            tar_ds.GetRasterBand(n_band+1).WriteArray(final_img, x_off, y_off)
+            seconds['read_s'] += seconds_read
+            seconds['shift_s'] += seconds_shift
+            seconds['write_s'] += time.perf_counter() - tic
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # keep at most 2 * workers blocks in memory
+                for n_t in range(0, len(tasks), 2*workers):
+                    batch = tasks[n_t:n_t+2*workers]
+                    for task, result in zip(batch, executor.map(shift_block, batch)):
+                        write(task, result)
+        else:
+            for task in tasks:
+                write(task, shift_block(task))
+        record.update(seconds)
+
+    # region - Overviews at the input's levels
+    with stage('write'):
+        tmp_band = input_raster.GetRasterBand(1)
+        factors = [int(round(input_raster.RasterXSize / tmp_band.GetOverview(n_o).XSize))
+                   for n_o in range(tmp_band.GetOverviewCount())]
+        if factors:
+            tar_ds.BuildOverviews('AVERAGE', factors)
+        tar_ds = None
+    # endregion
 
-    input_raster = gdal.Open(fn_in)
-    tmp_img = input_raster.ReadAsArray()
-    if len(tmp_img.shape) > 2: 
-        # tar_ds = driver.Create(fn_out, tmp_img.shape[2], tmp_img.shape[1], tmp_img.shape[0], gdal.GDT_Float32)
-        tmp_f = 'Check the number of the input image bands'
-        return tmp_f
-    else:
-        tar_ds = driver.Create(fn_out, tmp_img.shape[1], tmp_img.shape[0], 1, gdal.GDT_Float32)
-
-    tar_ds.SetGeoTransform(input_raster.GetGeoTransform())
-    tar_ds.SetProjection(input_raster.GetProjection())
-    
-    if len(tmp_img.shape) > 2:
-        tmp_f = 'Check the number of the input image bands'
-        return tmp_f
-        # for n_band in range(len(tmp_img.shape)-1):
-        #     tar_ds.GetRasterBand(n_band+1).WriteArray(tmp_img[n_band, :, :])
-        #     tar_ds.GetRasterBand(n_band+1).SetNoDataValue(input_raster.GetRasterBand(n_band+1).GetNoDataValue())
-    else:
-        no_data = input_raster.GetRasterBand(1).GetNoDataValue()
-        final_img = tmp_img-shift_z
-        final_img[tmp_img==no_data] = no_data
-        tar_ds.GetRasterBand(1).WriteArray(final_img)
-        tar_ds.GetRasterBand(1).SetNoDataValue(input_raster.GetRasterBand(1).GetNoDataValue())
-    tar_ds = None
     print('Check: ', fn_out)
 
 
-# # # # Example code to run # # # # 
-# transform_image_vertical(filepath_sensed_horizontallyshifted_DTM, filepath_out_DEM, -shift_v)
\ No newline at end of file
+def creation_options(ds, data_type):
+    '''
+    GTiff creation options reproducing the layout and compression of a dataset:
+    tiling and block size, COMPRESS, PREDICTOR and INTERLEAVE.
+    '''
+    from osgeo import gdal
+
+    band = ds.GetRasterBand(1)
+    block_x, block_y = band.GetBlockSize()
+    options = ['BIGTIFF=IF_SAFER']
+    if block_x < ds.RasterXSize:
+        options += ['TILED=YES', 'BLOCKXSIZE=%d' % block_x, 'BLOCKYSIZE=%d' % block_y]
+    else:
+        options += ['BLOCKYSIZE=%d' % block_y]
+
+    structure = ds.GetMetadata('IMAGE_STRUCTURE') or {}
+    compression = structure.get('COMPRESSION')
+    if compression:
+        options.append('COMPRESS=%s' % compression)
+        predictor = structure.get('PREDICTOR')
+        # the floating point predictor needs a float output, which it always is here
+        if predictor in ('2', '3'):
+            options.append('PREDICTOR=%s' % predictor)
+    if structure.get('INTERLEAVE') in ('BAND', 'PIXEL') and ds.RasterCount > 1:
+        options.append('INTERLEAVE=%s' % structure['INTERLEAVE'])
+    return options
+
+
+def block_windows(band, max_pixels=2**22):
+    '''
+    (x_off, y_off, x_size, y_size) windows following the band's native blocks.
+    Strip blocks (full-width) are grouped into windows of about max_pixels pixels.
+    '''
+    block_x, block_y = band.GetBlockSize()
+    size_x, size_y = band.XSize, band.YSize
+    if block_x >= size_x:
+        block_y = max(max_pixels // max(size_x, 1) // block_y, 1) * block_y
+        block_x = size_x
+
+    windows = []
+    for y_off in range(0, size_y, block_y):
+        for x_off in range(0, size_x, block_x):
+            windows.append((x_off, y_off, min(block_x, size_x - x_off), min(block_y, size_y - y_off)))
+    return windows
+
+
+# # # # Example code to run # # # #
+# transform_image_vertical(filepath_sensed_horizontallyshifted_DTM, filepath_out_DEM, -shift_v)
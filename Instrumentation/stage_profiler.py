@@ -0,0 +1,137 @@
+'''
+    Stage-level instrumentation of the CHM generation and global registration code.
+    The scripts accept a 'profiler' (None by default) and wrap their stages in
+    'with profiler.stage(name, items):'. For every stage, StageProfiler records the wall and CPU
+    time (of this process and of its finished child processes), the resident memory at the end,
+    the peak resident memory of the process so far and whether the stage raised it, and the
+    number of items processed (points, pixels, ...).
+    Records are printed as a table and saved as JSON; optionally, the whole run is profiled with
+    cProfile and the statistics are dumped for 'python -m pstats' or snakeviz.
+    Without a profiler, the stages of stage_of(None) (see NullProfiler) record nothing.
+
+    with StageProfiler('registration', fn_json='profile.json', fn_cprofile='profile.prof') as profiler:
+        estimate_horizontal_shift(fn_ref, fn_sen, display=False, profiler=profiler)
+'''
+
+import os, sys, json, time, resource
+from contextlib import contextmanager, nullcontext
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process so far (unit: MB).'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    '''Resident set size of this process (unit: MB), or None where /proc is not available.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def children_cpu_s():
+    '''CPU time of the finished child processes (e.g. process pool workers).'''
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageProfiler:
+    '''
+    Records of named pipeline stages; nested stages are named 'parent/child'.
+
+    name: name of the run, saved with the records
+    fn_json: file the records are saved to when the profiler is used as a context manager
+    fn_cprofile: file the cProfile statistics of the context are dumped to
+    '''
+
+    def __init__(self, name=None, fn_json=None, fn_cprofile=None, verbose=True):
+        self.name = name
+        self.fn_json = fn_json
+        self.fn_cprofile = fn_cprofile
+        self.verbose = verbose
+        self.records = []
+        self._stack = []
+        self._cprofile = None
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        '''
+        Record a stage. The yielded record is a dict; 'items' can be set inside the block
+        when the count is only known there.
+        '''
+        self._stack.append(name)
+        record = {'stage': '/'.join(self._stack), 'items': items,
+                  'start_s': time.perf_counter() - self._t0}
+        peak0 = peak_rss_mb()
+        wall0, cpu0, children0 = time.perf_counter(), time.process_time(), children_cpu_s()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall0
+            record['cpu_s'] = time.process_time() - cpu0
+            record['cpu_children_s'] = children_cpu_s() - children0
+            record['rss_mb'] = current_rss_mb()
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['raised_peak'] = record['peak_rss_mb'] > peak0
+            if record['items'] and record['wall_s'] > 0:
+                record['items_per_s'] = record['items'] / record['wall_s']
+            self._stack.pop()
+            self.records.append(record)
+            if self.verbose:
+                print('[%s] %.2f s' % (record['stage'], record['wall_s']))
+
+    def to_dict(self):
+        return {'name': self.name, 'total_wall_s': time.perf_counter() - self._t0,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': sorted(self.records, key=lambda record: record['start_s'])}
+
+    def save(self, fn_json):
+        with open(fn_json, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print('Check: ', fn_json)
+
+    def report(self):
+        '''Print the records as a table, in the order the stages started.'''
+        print('\n%-40s %9s %9s %9s %10s %14s' % ('stage', 'wall (s)', 'cpu (s)', 'child cpu', 'peak (MB)', 'items/s'))
+        for record in self.to_dict()['stages']:
+            print('%-40s %9.2f %9.2f %9.2f %9.0f%s %14s' % (
+                record['stage'], record['wall_s'], record['cpu_s'], record['cpu_children_s'],
+                record['peak_rss_mb'], '*' if record['raised_peak'] else ' ',
+                '%.0f' % record['items_per_s'] if 'items_per_s' in record else '-'))
+        print('(*: the stage raised the peak memory of the process)')
+
+    def __enter__(self):
+        if self.fn_cprofile is not None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.fn_cprofile)
+            self._cprofile = None
+            print('Check: ', self.fn_cprofile)
+        if self.verbose:
+            self.report()
+        if self.fn_json is not None:
+            self.save(self.fn_json)
+        return False
+
+
+class NullProfiler:
+    '''Stand-in for StageProfiler when profiling is off: stages yield a record that is not kept.'''
+
+    def stage(self, name, items=None):
+        return nullcontext({'stage': name, 'items': items})
+
+
+def stage_of(profiler):
+    '''The stage context manager of a profiler, or that of NullProfiler for None.'''
+    return (profiler if profiler is not None else NullProfiler()).stage
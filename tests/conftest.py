@@ -0,0 +1,6 @@
+import os, sys
+
+# the scripts are run from their folders and import their neighbours as top-level modules
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+for folder in ('CHM_generation', 'Global_registration', 'Instrumentation'):
+    sys.path.insert(0, os.path.abspath(os.path.join(ROOT, folder)))
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('rasterio')
+
+from chm_fill import fill_tiles, StreamingFiller
+
+
+def holey_image(rng, shape):
+    img = (rng.random(shape) * 30).astype(np.float32)
+    img[rng.random(shape) < 0.3] = -9999
+    img[20:30, 10:40] = -9999
+    return img
+
+
+@pytest.mark.parametrize('band_rows', [1, 3, 7, 25, 64])
+@pytest.mark.parametrize('smoothing_iterations', [0, 2])
+def test_streaming_filler_matches_fill_tiles(band_rows, smoothing_iterations):
+    rng = np.random.default_rng(band_rows)
+    img = holey_image(rng, (61, 47))
+    count = (img != -9999).astype(np.uint32)
+    expected = fill_tiles(img, img != -9999, 5, smoothing_iterations, tile_size=16)
+
+    filler = StreamingFiller({'chm': -9999, 'count': None}, img.shape[0], 5, smoothing_iterations, tile_size=16)
+    out = {'chm': np.zeros_like(img), 'count': np.zeros_like(count)}
+    next_row = 0
+    for row0 in range(0, img.shape[0], band_rows):
+        row1 = min(row0 + band_rows, img.shape[0])
+        for grids, tmp_row0 in filler.push({'chm': img[row0:row1], 'count': count[row0:row1]}, row0):
+            assert tmp_row0 == next_row
+            next_row += len(grids['chm'])
+            for name in out:
+                out[name][tmp_row0:tmp_row0+len(grids[name])] = grids[name]
+    assert next_row == img.shape[0]
+    np.testing.assert_array_equal(out['chm'], expected)
+    np.testing.assert_array_equal(out['count'], count)
+
+
+def test_streaming_filler_needs_bands_in_order():
+    filler = StreamingFiller({'chm': -9999}, 20, 2)
+    filler.push({'chm': np.zeros((5, 4), dtype=np.float32)}, 0)
+    with pytest.raises(ValueError):
+        filler.push({'chm': np.zeros((5, 4), dtype=np.float32)}, 10)
+
+
+@pytest.mark.parametrize('tile_size', [3, 7, 16, 64])
+@pytest.mark.parametrize('max_search_distance', [4, 5.5])
+@pytest.mark.parametrize('smoothing_iterations', [0, 1, 3])
+def test_fill_tiles_matches_whole_image(tile_size, max_search_distance, smoothing_iterations):
+    from rasterio.fill import fillnodata
+
+    # tiles smaller than the halo, and sizes that do not divide the image
+    rng = np.random.default_rng(tile_size)
+    img = holey_image(rng, (61, 47))
+    valid = img != -9999
+    expected = fillnodata(img.copy(), mask=valid.astype(np.uint8), max_search_distance=max_search_distance,
+                          smoothing_iterations=smoothing_iterations)
+
+    out = fill_tiles(img, valid, max_search_distance, smoothing_iterations, tile_size=tile_size)
+    np.testing.assert_array_equal(out, expected)
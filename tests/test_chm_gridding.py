@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from chm_gridding import pixel_index, grid_cells, grid_points
+
+
+def reference_grids(cell, z, n_cells, q):
+    '''Per-cell statistics the way the original script computed them, one cell at a time.'''
+    expected = {name: np.full(n_cells, -9999, dtype=np.float32) for name in ('p', 'min', 'max', 'mean')}
+    expected['count'] = np.zeros(n_cells, dtype=np.uint32)
+    for tmp_cell in np.unique(cell):
+        values = z[cell == tmp_cell]
+        expected['p'][tmp_cell] = np.percentile(values, q)
+        expected['min'][tmp_cell] = values.min()
+        expected['max'][tmp_cell] = values.max()
+        expected['mean'][tmp_cell] = values.mean()
+        expected['count'][tmp_cell] = len(values)
+    return expected
+
+
+def random_cloud(rng, n_points, n_cells, dtype):
+    cell = rng.integers(0, n_cells, n_points)
+    # tied heights: a coarse grid of values
+    z = (np.round(rng.random(n_points) * 40, 1)).astype(dtype)
+    # single-point cells
+    cell[:5] = n_cells + np.arange(5)
+    return cell, z
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('q', [98, 50, 0, 100, 99.5])
+def test_grid_cells_matches_per_cell_numpy(dtype, q):
+    rng = np.random.default_rng(int(q * 10))
+    img_shape = (9, 8)
+    n_cells = img_shape[0] * img_shape[1]
+    cell, z = random_cloud(rng, 2000, n_cells - 5, dtype)
+    name = 'p%g' % q
+
+    grids = grid_cells(cell, z, img_shape, products=[name, 'count', 'min', 'max', 'mean'])
+    expected = reference_grids(cell, z, n_cells, q)
+
+    # bit for bit, as the rasters of the original script
+    np.testing.assert_array_equal(grids[name].ravel(), expected['p'])
+    np.testing.assert_array_equal(grids['count'].ravel(), expected['count'])
+    np.testing.assert_array_equal(grids['min'].ravel(), expected['min'])
+    np.testing.assert_array_equal(grids['max'].ravel(), expected['max'])
+    np.testing.assert_allclose(grids['mean'].ravel(), expected['mean'], rtol=1e-6)
+    assert grids['count'].dtype == np.uint32
+    assert (grids['count'].ravel()[n_cells-5:] == 1).all()
+
+
+def test_grid_cells_integer_values():
+    grids = grid_cells(np.array([0, 0, 0, 3]), np.array([1, 2, 4, 7], dtype=np.uint8), (2, 2),
+                       products=['p50', 'count'])
+    np.testing.assert_array_equal(grids['p50'], [[2., -9999], [-9999, 7.]])
+    np.testing.assert_array_equal(grids['count'], [[3, 0], [0, 1]])
+
+
+def test_pixel_index_drops_points_outside():
+    boundary_tl, resolution, img_shape = [100., 200.], 0.5, (4, 6)
+    # nearest pixel: column round((x - 100) / 0.5), row round((200 - y) / 0.5)
+    x = np.array([100., 102.6, 99.7, 103.3, 102.74, 101.])
+    y = np.array([200., 198.6, 199., 199., 198.3, 198.24])
+    cell, inside = pixel_index(x, y, boundary_tl, resolution, img_shape)
+    np.testing.assert_array_equal(inside, [True, True, False, False, True, False])
+    np.testing.assert_array_equal(cell, [0, 3 * 6 + 5, 3 * 6 + 5])
+
+
+def test_grid_points_matches_original_loop():
+    rng = np.random.default_rng(7)
+    boundary_tl, resolution, img_shape = [1000., 2000.], 0.25, (40, 50)
+    x = boundary_tl[0] + rng.random(5000) * 13 - 0.3
+    y = boundary_tl[1] - rng.random(5000) * 10.5 + 0.3
+    z = (rng.random(5000) * 30).astype(np.float32)
+
+    grids = grid_points(x, y, z, boundary_tl, resolution, img_shape, products=('p98', 'count'))
+
+    expected_chm = np.full(img_shape, -9999, dtype=np.float32)
+    expected_nop = np.zeros(img_shape, dtype=np.uint32)
+    col = np.round((x - boundary_tl[0]) / resolution)
+    row = np.round((boundary_tl[1] - y) / resolution)
+    pixels = {}
+    for tmp_row, tmp_col, tmp_z in zip(row, col, z):
+        if 0 <= tmp_row < img_shape[0] and 0 <= tmp_col < img_shape[1]:
+            pixels.setdefault((int(tmp_row), int(tmp_col)), []).append(tmp_z)
+    for (tmp_row, tmp_col), values in pixels.items():
+        expected_chm[tmp_row, tmp_col] = np.percentile(np.array(values), 98)
+        expected_nop[tmp_row, tmp_col] = len(values)
+    assert expected_nop.sum() < len(z)
+    np.testing.assert_array_equal(grids['p98'], expected_chm)
+    np.testing.assert_array_equal(grids['count'], expected_nop)
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from chm_sketch import TopKSketch, HistogramSketch
+
+
+def random_cells(rng, n_cells, max_points, dtype, z_max=80.):
+    '''Random heights in [0, z_max) for cells with 1..max_points values, in shuffled order.'''
+    counts = rng.integers(1, max_points + 1, n_cells)
+    cell = np.repeat(np.arange(n_cells), counts)
+    z = (rng.random(len(cell)) * z_max).astype(dtype)
+    order = rng.permutation(len(cell))
+    return cell[order], z[order]
+
+
+def exact_percentiles(cell, z, n_cells, q):
+    return np.array([np.percentile(z[cell == i], q) for i in range(n_cells)])
+
+
+def update_in_chunks(sketch, cell, z, n_chunks=3):
+    for tmp_cell, tmp_z in zip(np.array_split(cell, n_chunks), np.array_split(z, n_chunks)):
+        sketch.update(tmp_cell, tmp_z)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('q', [98, 50, 0, 100, 99.5])
+def test_topk_exact_up_to_k_points(dtype, q):
+    rng = np.random.default_rng(0)
+    n_cells, k = 200, 16
+    cell, z = random_cells(rng, n_cells, k, dtype)
+
+    sketch = TopKSketch(n_cells, k)
+    update_in_chunks(sketch, cell, z)
+    values, cells, exact = sketch.percentile(q)
+
+    assert sketch.top.dtype == dtype
+    assert values.dtype == dtype
+    np.testing.assert_array_equal(cells, np.arange(n_cells))
+    assert exact.all()
+    np.testing.assert_array_equal(values, exact_percentiles(cell, z, n_cells, q))
+
+
+def test_topk_inexact_is_upper_bound():
+    rng = np.random.default_rng(1)
+    n_cells, k = 100, 8
+    cell, z = random_cells(rng, n_cells, 200, np.float64)
+
+    sketch = TopKSketch(n_cells, k)
+    update_in_chunks(sketch, cell, z)
+    values, cells, exact = sketch.percentile(50)
+
+    expected = exact_percentiles(cell, z, n_cells, 50)
+    counts = np.bincount(cell, minlength=n_cells)
+    np.testing.assert_array_equal(exact, counts - np.floor((counts - 1) * 0.5) <= k)
+    np.testing.assert_array_equal(values[exact], expected[exact])
+    assert (values[~exact] >= expected[~exact]).all()
+
+
+def test_topk_integer_values_in_float64():
+    sketch = TopKSketch(2, 4)
+    sketch.update(np.array([0, 0, 1]), np.array([3, 5, 7], dtype=np.uint16))
+    values, cells, exact = sketch.percentile(50)
+    assert sketch.top.dtype == np.float64
+    np.testing.assert_array_equal(values, [4., 7.])
+
+
+@pytest.mark.parametrize('bin_width', [1., 0.25])
+@pytest.mark.parametrize('q', [98, 50, 5])
+def test_histogram_within_half_a_bin(bin_width, q):
+    rng = np.random.default_rng(2)
+    n_cells = 300
+    cell, z = random_cells(rng, n_cells, 300, np.float32)
+
+    sketch = HistogramSketch(n_cells, 0., 80., bin_width)
+    update_in_chunks(sketch, cell, z)
+    values, cells = sketch.percentile(q)
+
+    np.testing.assert_array_equal(cells, np.arange(n_cells))
+    error = np.abs(values - exact_percentiles(cell, z, n_cells, q))
+    assert error.max() <= bin_width / 2 + 1e-6
+    assert len(sketch.out_of_range()) == 0
+
+
+def test_histogram_reports_out_of_range():
+    sketch = HistogramSketch(3, 0., 80., 1.)
+    sketch.update(np.array([0, 0, 1, 2]), np.array([10., 95., 20., -1.]))
+    np.testing.assert_array_equal(sketch.out_of_range(), [0, 2])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from chm_writer import overview_levels
+
+
+def test_overview_levels():
+    assert overview_levels((100, 300)) == []
+    assert overview_levels((1100, 1300)) == [2, 4]
+
+
+@pytest.mark.parametrize('cog', [False, True])
+def test_finalize_raster(tmp_path, cog):
+    gdal = pytest.importorskip('osgeo.gdal')
+    from chm_writer import create_chm_raster, write_windowed, finalize_raster
+
+    fn = str(tmp_path / 'chm.tif')
+    img = (np.random.default_rng(0).random((1100, 1300)) * 30).astype(np.float32)
+    img[:100] = -9999
+    ds = create_chm_raster(fn, img.shape, [1000., 2000.], 0.25, -9999)
+    write_windowed(ds.GetRasterBand(1), img)
+    ds = None
+    finalize_raster(fn, overviews=True, cog=cog)
+
+    ds = gdal.Open(fn)
+    structure = ds.GetMetadata('IMAGE_STRUCTURE')
+    assert structure['COMPRESSION'] == 'DEFLATE'
+    assert structure['PREDICTOR'] == '3'
+    assert (structure.get('LAYOUT') == 'COG') == cog
+    band = ds.GetRasterBand(1)
+    assert band.GetBlockSize() == [512, 512]
+    assert band.GetOverviewCount() == 2
+    assert band.GetNoDataValue() == -9999
+    np.testing.assert_array_equal(band.ReadAsArray(), img)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+import mi_search
+from mi_search import patch_mi_surface, batched_mutual_information
+from estimate_horizontal_shift import grid_patch_mis, mutual_information_2d
+
+
+def surface_kernel(surface, shifts_x, shifts_y):
+    '''evaluate_shifts stand-in reading the MI of every shift from a known surface.'''
+    index_x = {dx: n for n, dx in enumerate(shifts_x)}
+    index_y = {dy: n for n, dy in enumerate(shifts_y)}
+
+    def evaluate_shifts(*args, **kwargs):
+        shifts = args[9]
+        return np.array([surface[index_y[dy], index_x[dx]] for dx, dy in shifts])
+    return evaluate_shifts
+
+
+def smooth_surface(shifts_x, shifts_y, peak, width):
+    xx, yy = np.meshgrid(shifts_x, shifts_y)
+    return np.exp(-((xx - peak[0]) ** 2 + (yy - peak[1]) ** 2) / (2 * width ** 2))
+
+
+def pyramid(shifts_x, shifts_y, **kwargs):
+    return patch_mi_surface(None, None, 0, 0, 0, 0, 0, 0, 0, shifts_x, shifts_y, -9999,
+                            search='pyramid', **kwargs)
+
+
+def test_pyramid_finds_wide_peak(monkeypatch):
+    shifts_x = shifts_y = np.arange(-40, 41)
+    surface = smooth_surface(shifts_x, shifts_y, (13, -27), 6.)
+    monkeypatch.setattr(mi_search, 'evaluate_shifts', surface_kernel(surface, shifts_x, shifts_y))
+
+    patch_mis = pyramid(shifts_x, shifts_y)
+    assert np.nanargmax(patch_mis) == np.argmax(surface)
+    assert np.isfinite(patch_mis).sum() < surface.size / 10
+
+
+def test_pyramid_checks_neighbourhood_of_maximum(monkeypatch):
+    # a narrow peak next to the broad maximum, between the shifts the refinement evaluates
+    shifts_x = shifts_y = np.arange(-40, 41)
+    surface = smooth_surface(shifts_x, shifts_y, (0, 0), 10.)
+    surface[np.searchsorted(shifts_y, 3), np.searchsorted(shifts_x, -4)] = 2.
+    monkeypatch.setattr(mi_search, 'evaluate_shifts', surface_kernel(surface, shifts_x, shifts_y))
+
+    assert np.nanargmax(pyramid(shifts_x, shifts_y, verify_radius=1)) != np.argmax(surface)
+    patch_mis = pyramid(shifts_x, shifts_y)
+    assert np.nanargmax(patch_mis) == np.argmax(surface)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_pyramid_maximum_is_local_maximum_of_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    img_ref = rng.random((120, 120)).cumsum(axis=0).cumsum(axis=1)
+    img_ref = (img_ref / img_ref.max() * 30).astype(np.float32)
+    img_sen = np.roll(img_ref, (3, -2), axis=(0, 1)) + rng.normal(0, 0.5, img_ref.shape).astype(np.float32)
+    shifts_x = shifts_y = np.arange(-16, 17)
+    x1, x2, y1, y2 = 20, 100, 20, 100
+    seed_x = seed_y = 40
+    size_patch_img = 12
+    patch_img_ref = img_ref[y1:y2, x1:x2][seed_y-size_patch_img:seed_y+size_patch_img,
+                                        seed_x-size_patch_img:seed_x+size_patch_img]
+
+    args = (patch_img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img, shifts_x, shifts_y, -9999)
+    brute = patch_mi_surface(*args, search='batched')
+    patch_mis = patch_mi_surface(*args, search='pyramid')
+
+    evaluated = np.isfinite(patch_mis)
+    np.testing.assert_array_equal(patch_mis[evaluated], brute[evaluated])
+    best_dy, best_dx = np.unravel_index(np.nanargmax(patch_mis), patch_mis.shape)
+    radius = 2 ** (max(1, int(np.log2(len(shifts_x) / 8)) + 1) - 2)
+    window = brute[max(0, best_dy-radius):best_dy+radius+1, max(0, best_dx-radius):best_dx+radius+1]
+    assert patch_mis[best_dy, best_dx] == window.max()
+
+
+def random_images(seed, dtype, shape=(80, 80), nodata=-9999, nodata_fraction=0.2):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(2):
+        img = (rng.random(shape) * 30).astype(dtype)
+        img[rng.random(shape) < nodata_fraction] = nodata
+        images.append(img)
+    return images
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_batched_mutual_information_equals_mutual_information_2d(seed, dtype):
+    rng = np.random.default_rng(seed)
+    values_ref = (rng.random((5, 300)) * 30).astype(dtype)
+    values_sen = (rng.random((5, 300)) * 30).astype(dtype)
+    values_sen[3] = 7.  # constant pair: the bins span value +- 0.5
+    valid = rng.random(values_ref.shape) > 0.2
+
+    mis = batched_mutual_information(values_ref, values_sen, valid)
+    brute = [mutual_information_2d(values_ref[n][valid[n]], values_sen[n][valid[n]]) for n in range(len(valid))]
+    np.testing.assert_array_equal(mis, brute)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_batched_surface_equals_brute_force(seed, dtype):
+    img_ref, img_sen = random_images(seed, dtype)
+    shifts_x = shifts_y = np.arange(-6, 7)
+    x1, x2, y1, y2 = 10, 70, 10, 70
+    seed_x, seed_y = [20, 35], [25, 30]
+    size_patch_img = 8
+
+    # the 'mutual_information_2d' loop of estimate_horizontal_shift
+    brute = grid_patch_mis(img_ref, img_sen, x1, x2, y1, y2, seed_x, seed_y, size_patch_img,
+                           shifts_x, shifts_y, -9999, search='brute')
+    for n_p in range(len(seed_x)):
+        patch_img_ref = img_ref[y1:y2, x1:x2][seed_y[n_p]-size_patch_img:seed_y[n_p]+size_patch_img,
+                                            seed_x[n_p]-size_patch_img:seed_x[n_p]+size_patch_img]
+        patch_mis = patch_mi_surface(patch_img_ref, img_sen, x1, x2, y1, y2, seed_x[n_p], seed_y[n_p],
+                                     size_patch_img, shifts_x, shifts_y, -9999, search='batched')
+        np.testing.assert_array_equal(patch_mis, brute[n_p])
@@ -0,0 +1,19 @@
+from raster_overlap import strip_rows
+
+
+class Band:
+    '''Stand-in for a GDAL band with the given block size.'''
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+
+def test_strips_follow_block_rows():
+    strips = list(strip_rows(Band((512, 256)), 300, 1500, rows=600))
+    assert strips[0] == (300, 512)
+    assert all(row0 % 512 == 0 for row0, _ in strips[1:])
+    assert [row0 for row0, _ in strips[1:]] == [row1 for _, row1 in strips[:-1]]
+    assert strips[-1][1] == 1500
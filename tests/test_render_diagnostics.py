@@ -0,0 +1,47 @@
+import gc
+import weakref
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+
+from render_diagnostics import DiagnosticsRenderer
+
+
+class Diagnostics(dict):
+    '''dict that can be weakly referenced.'''
+
+
+def horizontal_diagnostics(rng, shape=(300, 200), step=3):
+    img_ref = (rng.random(shape) * 40).astype(np.float32)
+    lut = np.column_stack([rng.random(5) * shape[1], rng.random(5) * shape[0], rng.normal(size=(5, 2))])
+    return Diagnostics(kind='horizontal', shift=(1.5, -0.5), mi_surface=rng.random((11, 11)), mi_location=(2, 3),
+                       lut=lut, img_ref=img_ref[::step, ::step].copy(), img_ref_shape=shape)
+
+
+def test_renderer_releases_diagnostics(tmp_path):
+    rng = np.random.default_rng(0)
+    renderer = DiagnosticsRenderer(str(tmp_path))
+    diagnostics = horizontal_diagnostics(rng)
+    reference = weakref.ref(diagnostics)
+    renderer.submit('F02_to_F01', diagnostics)
+    del diagnostics
+    # the rendering thread has dropped the first figure once it is done with the next one
+    renderer.submit('F03_to_F01', horizontal_diagnostics(rng)).result()
+    gc.collect()
+    assert reference() is None
+
+    assert sorted(renderer.close()) == [str(tmp_path / 'F02_to_F01_horizontal.png'),
+                                        str(tmp_path / 'F03_to_F01_horizontal.png')]
+
+
+def test_renderer_raises_failures(tmp_path):
+    rng = np.random.default_rng(1)
+    broken = horizontal_diagnostics(rng)
+    del broken['lut']
+    with pytest.raises(RuntimeError, match='1 diagnostics figure'):
+        with DiagnosticsRenderer(str(tmp_path)) as renderer:
+            renderer.submit('ok', horizontal_diagnostics(rng))
+            renderer.submit('broken', broken)
+    assert (tmp_path / 'ok_horizontal.png').exists()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+lp = pytest.importorskip('laspy')
+
+from shift_point_cloud import shift_point_cloud, shift_integers
+
+
+SCALES = np.array([0.01, 0.01, 0.001])
+OFFSETS = np.array([500000., 4400000., 200.])
+SHIFTS = np.array([1.23, -0.57, 0.125])
+
+
+@pytest.fixture(params=['las', 'laz'])
+def fn_in(tmp_path, request):
+    '''Small point cloud with a classification, as LAS and LAZ.'''
+    fn = str(tmp_path / ('in.' + request.param))
+    rng = np.random.default_rng(0)
+    header = lp.LasHeader(point_format=3, version='1.2')
+    header.scales, header.offsets = SCALES, OFFSETS
+    points = lp.LasData(header)
+    points.x = OFFSETS[0] + rng.random(1000) * 100
+    points.y = OFFSETS[1] + rng.random(1000) * 100
+    points.z = OFFSETS[2] + rng.random(1000) * 30
+    points.classification = rng.integers(1, 6, 1000).astype(np.uint8)
+    points.write(fn)
+    return fn
+
+
+def check_shifted(fn_in, fn_out, shifts, atol=1e-9):
+    points_in, points_out = lp.read(fn_in), lp.read(fn_out)
+    for name, shift in zip('xyz', shifts):
+        np.testing.assert_allclose(points_out[name], points_in[name] - shift, rtol=0, atol=atol)
+    np.testing.assert_allclose(points_out.header.mins, points_in.header.mins - shifts, rtol=0, atol=atol)
+    np.testing.assert_allclose(points_out.header.maxs, points_in.header.maxs - shifts, rtol=0, atol=atol)
+    np.testing.assert_array_equal(points_out.classification, points_in.classification)
+    return points_in, points_out
+
+
+def test_header_patch(fn_in, tmp_path):
+    fn_out = str(tmp_path / ('out' + fn_in[-4:]))
+    shift_point_cloud(fn_in, fn_out, SHIFTS)
+
+    points_in, points_out = check_shifted(fn_in, fn_out, SHIFTS)
+    # the integer coordinates are untouched, only the offsets moved
+    np.testing.assert_allclose(points_out.header.offsets, OFFSETS - SHIFTS, rtol=0, atol=1e-9)
+    for name in 'XYZ':
+        np.testing.assert_array_equal(points_out[name], points_in[name])
+    assert 'OriginalCloudIndex' not in points_out.point_format.dimension_names
+
+
+@pytest.mark.parametrize('shifts', [SHIFTS, SHIFTS + SCALES / 3])
+def test_keep_offsets(fn_in, tmp_path, shifts):
+    fn_out = str(tmp_path / ('out' + fn_in[-4:]))
+    shift_point_cloud(fn_in, fn_out, shifts, keep_offsets=True)
+
+    # shifts that are not multiples of the scales are rounded to them
+    exact = np.allclose(shifts / SCALES, np.round(shifts / SCALES))
+    _, points_out = check_shifted(fn_in, fn_out, shifts, atol=1e-9 if exact else SCALES.max() / 2)
+    np.testing.assert_array_equal(points_out.header.offsets, OFFSETS)
+
+
+def test_index(fn_in, tmp_path):
+    fn_out = str(tmp_path / ('out' + fn_in[-4:]))
+    shift_point_cloud(fn_in, fn_out, SHIFTS, index=3, chunk_size=300)
+
+    _, points_out = check_shifted(fn_in, fn_out, SHIFTS)
+    assert len(points_out) == 1000
+    np.testing.assert_array_equal(points_out['OriginalCloudIndex'], np.full(1000, 3, dtype=np.int8))
+
+
+def test_shift_integers_overflow():
+    values = np.array([0, np.iinfo(np.int32).max - 10], dtype=np.int32)
+    np.testing.assert_array_equal(shift_integers(values, 0.01, 0.05), values - 5)
+    with pytest.raises(OverflowError):
+        shift_integers(values, 0.01, -1.)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from transform_image_horizontal import transform_image
+
+
+SHIFTS = (1.5, -1.0)
+GEOTRANSFORM = (1000., 0.5, 0., 2000., 0., -0.5)
+
+
+@pytest.fixture
+def fn_in(tmp_path):
+    '''Tiled, DEFLATE-compressed Int16 raster with overviews.'''
+    fn = str(tmp_path / 'in.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(fn, 300, 200, 1, gdal.GDT_Int16,
+                                              options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.GetRasterBand(1).SetNoDataValue(-9999)
+    ds.GetRasterBand(1).WriteArray(np.arange(200 * 300, dtype=np.int16).reshape(200, 300))
+    ds.BuildOverviews('AVERAGE', [2, 4])
+    ds = None
+    return fn
+
+
+def shifted_geotransform():
+    return (GEOTRANSFORM[0] - SHIFTS[0], GEOTRANSFORM[1], GEOTRANSFORM[2],
+            GEOTRANSFORM[3] - SHIFTS[1], GEOTRANSFORM[4], GEOTRANSFORM[5])
+
+
+def check_pixels(fn_out, fn_in):
+    ds_in, ds_out = gdal.Open(fn_in), gdal.Open(fn_out)
+    np.testing.assert_array_equal(ds_out.ReadAsArray(), ds_in.ReadAsArray())
+    assert ds_out.GetRasterBand(1).GetNoDataValue() == -9999
+    assert ds_out.GetGeoTransform() == pytest.approx(shifted_geotransform())
+
+
+def test_full_is_default(fn_in, tmp_path):
+    fn_out = str(tmp_path / 'out.tif')
+    transform_image(fn_in, fn_out, SHIFTS)
+    check_pixels(fn_out, fn_in)
+    assert gdal.Open(fn_out).GetRasterBand(1).DataType == gdal.GDT_Float32
+
+
+def test_copy_keeps_layout(fn_in, tmp_path):
+    fn_out = str(tmp_path / 'out.tif')
+    transform_image(fn_in, fn_out, SHIFTS, mode='copy')
+    check_pixels(fn_out, fn_in)
+    ds = gdal.Open(fn_out)
+    assert ds.GetRasterBand(1).DataType == gdal.GDT_Int16
+    assert ds.GetRasterBand(1).GetOverviewCount() == 2
+    assert ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION') == 'DEFLATE'
+    assert gdal.Open(fn_in).GetGeoTransform() == pytest.approx(GEOTRANSFORM)
+
+
+def test_vrt_points_at_input(fn_in, tmp_path):
+    # the geotransform is set on the open result of gdal.Translate and must reach the file
+    fn_out = str(tmp_path / 'out.vrt')
+    transform_image(fn_in, fn_out, SHIFTS, mode='vrt')
+    check_pixels(fn_out, fn_in)
+    assert gdal.Open(fn_out).GetDriver().ShortName == 'VRT'
+    assert gdal.Open(fn_in).GetGeoTransform() == pytest.approx(GEOTRANSFORM)
+
+
+def test_unknown_mode(fn_in, tmp_path):
+    with pytest.raises(ValueError):
+        transform_image(fn_in, str(tmp_path / 'out.tif'), SHIFTS, mode='move')